@@ -0,0 +1,7 @@
+"""
+End-to-end benchmarks for splitcpy
+
+'python -m benchmarks.run' times real downloads over ssh through the
+per-connection shaper in benchmarks.shaper. It is not installed with the
+package.
+"""
@@ -0,0 +1,218 @@
+"""
+Time splitcpy downloads through the shaper, over a sweep of -n and -b
+
+Each download runs the splitcpy in this tree against an sshd, by way of
+a benchmarks.shaper.Shaper on the loopback, so that every ssh stream
+gets its own rate limit and latency. Every -b is timed with one stream
+first, as the baseline that the rest are compared with.
+
+The source file is made in a local temporary directory, so the sshd
+must share this filesystem, and run a 'splitcpy' of its own. It must
+let the user in without a prompt, and the host key for the shaper's
+address must already be known - splitcpy fails rather than accept a new
+one. The shaper listens on a fixed port, so that the key can be added
+once, with the shaper running:
+
+    python -m benchmarks.shaper 20022 localhost:22 &
+    ssh-keyscan -p 20022 127.0.0.1 >> ~/.ssh/known_hosts
+
+    python -m benchmarks.run --rate 1000000 --latency 0.02 -o out.json
+"""
+
+import argparse
+import getpass
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import splitcpy
+from .shaper import Shaper, parse_addr
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# where the shaper listens, for a host key that only has to be known once
+LISTEN = '127.0.0.1:20022'
+
+
+def int_list(text):
+    return [int(x) for x in text.split(',')]
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    if len(values) % 2:
+        return values[mid]
+    return (values[mid - 1] + values[mid]) / 2.0
+
+
+def file_digest(path):
+    hash = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for buf in iter(lambda: fp.read(1 << 20), b''):
+            hash.update(buf)
+
+    return hash.hexdigest()
+
+
+def make_source(path, size):
+    with open(path, 'wb') as fp:
+        while size > 0:
+            buf = os.urandom(min(size, 1 << 20))
+            fp.write(buf)
+            size -= len(buf)
+
+
+def splitcpy_argv(port, num_slices, bytes, options, src, dest):
+    return [sys.executable, '-m', 'splitcpy', '-p', str(port),
+            '-n', str(num_slices), '-b', str(bytes)] + options + [src, dest]
+
+
+def time_download(argv, dest, digest):
+    """Run one download, returning its duration in seconds"""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [ROOT] + [x for x in [os.environ.get('PYTHONPATH')] if x]))
+
+    start = time.time()
+    status = subprocess.call(argv, env=env)
+    elapsed = time.time() - start
+
+    if status:
+        raise RuntimeError("'%s' exited with status %d" %
+                           (' '.join(argv), status))
+    if file_digest(dest) != digest:
+        raise RuntimeError("'%s' corrupted the copy" % ' '.join(argv))
+
+    os.remove(dest)
+    return elapsed
+
+
+def run_case(shaper, args, num_slices, bytes, src, dest, digest):
+    """Time a case 'repeat' times, returning its result record"""
+    argv = splitcpy_argv(shaper.address[1], num_slices, bytes,
+                         args.options.split(), src, dest)
+
+    flows = len(shaper.flows)
+    seconds = [time_download(argv, dest, digest)
+               for n in range(args.repeat)]
+
+    return {
+        'slices': num_slices,
+        'bytes': bytes,
+        'seconds': seconds,
+        'median': median(seconds),
+        'rate': args.size / median(seconds),
+        'flows': (len(shaper.flows) - flows) // args.repeat,
+    }
+
+
+def run_sweep(shaper, args, src, dest, digest):
+    results = []
+    for bytes in args.bytes:
+        base = run_case(shaper, args, 1, bytes, src, dest, digest)
+        base['speedup'] = 1.0
+        results.append(base)
+        report(base)
+
+        for num_slices in [x for x in args.slices if x != 1]:
+            result = run_case(shaper, args, num_slices, bytes, src, dest,
+                              digest)
+            result['speedup'] = base['median'] / result['median']
+            results.append(result)
+            report(result)
+
+    return results
+
+
+def report(result):
+    sys.stderr.write("-n %(slices)-4d -b %(bytes)-9d %(median)8.2fs "
+                     "%(rate)12.0f B/s  x%(speedup).2f\n" % result)
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark splitcpy downloads through a per-flow "
+                    "shaper.")
+
+    parser.add_argument('--sshd', default='localhost:22',
+                        help="host:port of the sshd (default=localhost:22)")
+    parser.add_argument('--user', default=getpass.getuser(),
+                        help="ssh user name")
+    parser.add_argument('--listen', default=LISTEN,
+                        help="[host:]port for the shaper, with a known host "
+                             "key (default=%s)" % LISTEN)
+    parser.add_argument('--rate', type=float, default=1000000.0,
+                        help="bytes per second, per stream (default=1e6)")
+    parser.add_argument('--burst', type=int,
+                        help="bytes passed at once by the shaper")
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help="seconds added each way (default=0.02)")
+    parser.add_argument('--size', type=int, default=16000000,
+                        help="source file size (default=16,000,000)")
+    parser.add_argument('-n', dest='slices', type=int_list,
+                        default=[1, 2, 4, 8],
+                        help="comma-separated stream counts (default=1,2,4,8)")
+    parser.add_argument('-b', dest='bytes', type=int_list,
+                        default=[10000, 100000],
+                        help="comma-separated chunk sizes "
+                             "(default=10000,100000)")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="runs per case, of which the median is kept "
+                             "(default=3)")
+    parser.add_argument('--options', default='',
+                        help="other splitcpy options, e.g. '--engine async'")
+    parser.add_argument('-o', dest='output', default='-',
+                        help="JSON results file (default=stdout)")
+    parser.add_argument('--expect', type=float,
+                        help="fail unless some -n beats one stream by this "
+                             "factor")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    tmpdir = tempfile.mkdtemp(prefix='splitcpy-bench-')
+    try:
+        src = os.path.join(tmpdir, 'src')
+        dest = os.path.join(tmpdir, 'dest')
+        make_source(src, args.size)
+        digest = file_digest(src)
+
+        with Shaper(parse_addr(args.sshd), args.rate, args.burst,
+                    args.latency, parse_addr(args.listen)) as shaper:
+            spec = "%s@%s:%s" % (args.user, shaper.address[0], src)
+            results = run_sweep(shaper, args, spec, dest, digest)
+    except RuntimeError as e:
+        sys.exit(str(e))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    config = dict((x, getattr(args, x)) for x in
+                  ['rate', 'burst', 'latency', 'size', 'repeat', 'options'])
+    doc = {'version': splitcpy.__version__, 'config': config,
+           'results': results}
+
+    text = json.dumps(doc, indent=2, sort_keys=True) + "\n"
+    if args.output == '-':
+        sys.stdout.write(text)
+    else:
+        with open(args.output, 'w') as fp:
+            fp.write(text)
+
+    if args.expect is not None:
+        best = max(x['speedup'] for x in results)
+        if best < args.expect:
+            sys.exit("the best speedup was x%.2f, under x%.2f" %
+                     (best, args.expect))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+"""
+A userspace TCP proxy, limiting each connection separately
+
+Every connection accepted is forwarded to the target, with its own token
+bucket in each direction, and with 'latency' seconds added to everything
+it carries. This is how a per-flow policer or a long path treats an ssh
+stream, which is what multiple streams are meant to get around.
+
+    python -m benchmarks.shaper --rate 1000000 --latency 0.05 2222 host:22
+"""
+
+import argparse
+import queue
+import socket
+import threading
+import time
+
+
+CHUNK = 16384
+
+
+class TokenBucket(object):
+    """Pace a byte stream to 'rate' bytes per second
+
+    Up to 'burst' bytes pass at once, after an idle spell. A rate of None
+    is unlimited.
+    """
+
+    def __init__(self, rate=None, burst=None, clock=time.time):
+        self.rate = rate
+        self.burst = burst if burst is not None else CHUNK
+        self.clock = clock
+        self.tokens = self.burst
+        self.stamp = clock()
+
+    def reserve(self, count):
+        """Claim 'count' bytes, returning the seconds to wait to send them"""
+        if self.rate is None:
+            return 0.0
+
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.stamp)*self.rate) - count
+        self.stamp = now
+
+        return max(0.0, -self.tokens/self.rate)
+
+
+def parse_addr(spec):
+    """Return (host, port) for 'host:port', or for a bare port"""
+    host, sep, port = spec.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def shutdown(sock, how=socket.SHUT_RDWR):
+    try:
+        sock.shutdown(how)
+    except (IOError, OSError):
+        pass
+
+
+class Flow(object):
+    """One forwarded connection
+
+    Each direction has a reader, which stamps the chunks with the time
+    they are due, and a sender, which holds them until then, and until
+    the bucket allows them.
+    """
+
+    def __init__(self, client, server, rate=None, burst=None, latency=0.0):
+        self.socks = [client, server]
+        self.latency = latency
+        self.sent = [0, 0]      # bytes to the server, and to the client
+
+        self.threads = []
+        for n, (src, dst) in enumerate([(client, server),
+                                        (server, client)]):
+            line = queue.Queue()
+            self.threads += [
+                threading.Thread(target=self.read, args=(src, line)),
+                threading.Thread(target=self.send,
+                                 args=(dst, line, TokenBucket(rate, burst),
+                                       n)),
+            ]
+
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def read(self, src, line):
+        while True:
+            try:
+                data = src.recv(CHUNK)
+            except (IOError, OSError):
+                data = b''
+
+            line.put((time.time() + self.latency, data))
+            if not data:
+                break
+
+    def send(self, dst, line, bucket, n):
+        while True:
+            due, data = line.get()
+            if not data:
+                shutdown(dst, socket.SHUT_WR)
+                break
+
+            time.sleep(max(0.0, due - time.time()))
+            time.sleep(bucket.reserve(len(data)))
+
+            try:
+                dst.sendall(data)
+            except (IOError, OSError):
+                self.close()
+                break
+            self.sent[n] += len(data)
+
+    def close(self):
+        for sock in self.socks:
+            shutdown(sock)
+
+    def join(self, timeout=None):
+        for thread in self.threads:
+            thread.join(timeout)
+
+        for sock in self.socks:
+            sock.close()
+
+
+class Shaper(object):
+    """Accept connections on 'listen', and forward them to 'target'
+
+    The address actually bound is in 'address', for a listen port of 0.
+    The Flows are kept in 'flows', to be counted.
+    """
+
+    def __init__(self, target, rate=None, burst=None, latency=0.0,
+                 listen=('127.0.0.1', 0)):
+        self.target = target
+        self.rate = rate
+        self.burst = burst
+        self.latency = latency
+        self.flows = []
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(listen)
+        self.sock.listen(128)
+        self.address = self.sock.getsockname()
+
+        self.thread = threading.Thread(target=self.accept)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def accept(self):
+        while True:
+            try:
+                client, addr = self.sock.accept()
+            except (IOError, OSError):
+                break
+
+            try:
+                server = socket.create_connection(self.target)
+            except (IOError, OSError):
+                client.close()
+                continue
+
+            for sock in (client, server):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self.flows.append(Flow(client, server, self.rate, self.burst,
+                                   self.latency))
+
+    def stop(self):
+        shutdown(self.sock)
+        self.sock.close()
+        self.thread.join()
+
+        for flow in self.flows:
+            flow.close()
+        for flow in self.flows:
+            flow.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description="Forward TCP connections, limiting each one.")
+
+    parser.add_argument('listen', help="[host:]port to accept connections on")
+    parser.add_argument('target', help="host:port to forward them to")
+    parser.add_argument('--rate', type=float,
+                        help="bytes per second, per connection and direction")
+    parser.add_argument('--burst', type=int,
+                        help="bytes passed at once after an idle spell "
+                             "(default=%d)" % CHUNK)
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added in each direction")
+
+    return parser.parse_args(args)
+
+
+def main(args=None):
+    args = parse_args(args)
+
+    shaper = Shaper(parse_addr(args.target), args.rate, args.burst,
+                    args.latency, parse_addr(args.listen))
+    shaper.start()
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shaper.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -143,12 +143,18 @@ setup(name='splitcpy',
           'Natural Language :: English',
           'Operating System :: POSIX',
           'Programming Language :: Python',
+          'Programming Language :: Python :: 3',
           'Topic :: Utilities',
       ],
       entry_points={
           'console_scripts': ['splitcpy=splitcpy.splitcpy:main'],
       },
+      python_requires='>=3.3',
       install_requires=['pexpect', ],
+      extras_require={
+          'zstd': ['zstandard'],
+          'lz4': ['lz4'],
+      },
       tests_require=['pytest', 'mock'],
       cmdclass={
           'test': PyTest,
@@ -0,0 +1,202 @@
+"""
+asyncio download engine, for '--engine async'
+
+Every slice's ssh process is read by one event loop, in the calling
+process, in place of a Process, FIFO and Queue feeder thread per slice.
+The chunks are written straight to their offsets in the destination.
+
+This module needs Python 3.5 or later, and is only imported when the
+engine is selected.
+"""
+
+import asyncio
+import itertools
+import os
+
+from .splitcpy import _, RETRY_LIMIT, SSH_FAILED, START_RETRIES, TRAILER, \
+    StartLimiter, StreamError, TransferError, check_trailer, chunk_offset, \
+    make_stripes, parse_net_spec, preallocate, remote_argv, resume_extent, \
+    retry_delay, slice_args, slice_length, stripe_hash
+
+
+async def read_exactly(fp, count, stall=None):
+    """Read 'count' bytes from fp, or fewer at EOF
+
+    Raises asyncio.TimeoutError if nothing arrives for 'stall' seconds.
+    """
+    buf = bytearray()
+    while len(buf) < count:
+        data = await asyncio.wait_for(fp.read(count - len(buf)), stall)
+        if not data:
+            break
+        buf += data
+
+    return bytes(buf)
+
+
+async def read_slice(fp, fd, num_slices, slice, bytes, offset=0, length=None,
+                     stall=None):
+    """Write the chunks of an interleave slice read from fp to fd
+
+    With a 'length', exactly that many bytes are read, and then checked
+    against the trailer that follows them.
+
+    Returns the byte count, and an error message if the check failed.
+    Raises StreamError if nothing arrives for 'stall' seconds.
+    """
+    hash = stripe_hash() if length is not None else None
+    count = 0
+    for k in itertools.count():
+        want = bytes if length is None else min(bytes, length - count)
+        if not want:
+            break
+
+        try:
+            buf = await read_exactly(fp, want, stall)
+        except asyncio.TimeoutError:
+            raise StreamError(_("The stream stalled"), count)
+
+        if buf:
+            os.pwrite(fd, buf,
+                      chunk_offset(num_slices, slice, bytes, k, offset))
+            count += len(buf)
+            if hash:
+                hash.update(buf)
+
+        if len(buf) < want:
+            break
+
+    if length is not None:
+        try:
+            trailer = await read_exactly(fp, TRAILER.size, stall)
+        except asyncio.TimeoutError:
+            raise StreamError(_("The stream stalled"), count)
+
+        error = check_trailer(trailer, count, hash.digest())
+        if error is None and count != length:
+            error = _("received %d bytes of %d") % (count, length)
+        return count, error
+
+    return count, None
+
+
+async def run_slice(ns, num_slices, slice, extent, fd, bytes, pw, port,
+                    control, length, limiter, procs, stall, transport):
+    """Run one stream of a remote slice, writing it to fd
+
+    The connection is paced by the StartLimiter, and retried if ssh fails
+    before any data arrives. A StreamError is raised if it fails later,
+    or stalls.
+    """
+    argv, env = remote_argv(ns.user, ns.host, port, pw, control,
+                            slice_args(ns.path, num_slices, slice, bytes,
+                                       extent, length is not None),
+                            transport)
+
+    for attempt in range(START_RETRIES):
+        await asyncio.sleep(limiter.reserve())
+
+        p = await asyncio.create_subprocess_exec(
+            *argv, env=env, stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE)
+        procs.append(p)
+
+        try:
+            count, error = await read_slice(p.stdout, fd, num_slices, slice,
+                                            bytes, extent[0] if extent else 0,
+                                            length, stall)
+        except StreamError:
+            p.kill()
+            await p.wait()
+            raise
+
+        status = await p.wait()
+        if count or status != SSH_FAILED:
+            break
+
+        limiter.rejected()
+    else:
+        raise TransferError(_("The server refused %d connections") %
+                            START_RETRIES)
+
+    limiter.accepted()
+    if status == SSH_FAILED:
+        raise StreamError(_("The connection was lost"), count)
+    if status:
+        raise TransferError(_("A slice exited with status %d") % status)
+    if error:
+        raise TransferError(error)
+
+
+async def fetch_slice(ns, stripe, fd, bytes, pw, port, control, size, verify,
+                      limiter, procs, stall=None, transport=None):
+    """Fetch a slice, resuming it after a lost connection if size is known"""
+    num_slices, slice, extent = stripe
+    for attempt in itertools.count():
+        length = None
+        if verify:
+            length = slice_length(size, num_slices, slice, bytes, extent)
+
+        try:
+            await run_slice(ns, num_slices, slice, extent, fd, bytes, pw,
+                            port, control, length, limiter, procs, stall,
+                            transport)
+            return
+        except StreamError as e:
+            if size is None or attempt >= RETRY_LIMIT:
+                raise
+
+            extent = resume_extent(size, num_slices, bytes, extent,
+                                   e.count // bytes)
+            await asyncio.sleep(retry_delay(attempt))
+
+
+async def download(src, dest, num_slices, bytes, pw, port, size=None,
+                   layout='interleave', control=None, verify=False,
+                   stall=None, transport=None):
+    ns = parse_net_spec(src)
+    preallocate(dest, size)
+
+    procs = []
+    limiter = StartLimiter()
+    fd = os.open(dest, os.O_WRONLY)
+    tasks = [asyncio.ensure_future(
+                 fetch_slice(ns, stripe, fd, bytes, pw, port, control,
+                             size, verify, limiter, procs, stall,
+                             transport))
+             for stripe in make_stripes(num_slices, size, layout)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        # one failed slice stops the rest
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        for p in procs:
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+        os.close(fd)
+
+
+def dl_file(src, dest, num_slices, bytes, pw, port, size=None,
+            layout='interleave', control=None, verify=False, stall=None,
+            transport=None):
+    """Perform a parallel download of a file, with one event loop
+
+    The arguments are those of splitcpy.dl_file(). The chunks are always
+    written directly, so there is no 'shm' or 'direct'.
+    """
+    loop = asyncio.new_event_loop()
+
+    # before Python 3.8, child processes are only watched for the current
+    # loop
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(download(src, dest, num_slices, bytes, pw,
+                                         port, size, layout, control, verify,
+                                         stall, transport))
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
@@ -20,178 +20,2096 @@
 import argparse
 import sys
 import re
-from multiprocessing import Process, Queue
+from multiprocessing import Process, Queue, Event, Value, Lock, Array
+try:
+    from multiprocessing import shared_memory
+except ImportError:                 # Python < 3.8
+    shared_memory = None
 import subprocess
+import socket
+import io
+import threading
 import pexpect
 import getpass
 import os
 import shutil
-import uuid
 import time
 import tempfile
 import glob
 import json
 import itertools
+import collections
+import errno
+import fcntl
+import stat
+import struct
+import hashlib
+from shlex import quote
+try:
+    import zstandard
+except ImportError:                 # optional, for --compress
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:                 # optional, for --compress
+    lz4 = None
+
+from queue import Empty
+from collections import namedtuple
+from distutils.version import LooseVersion
+
+import locale
+import gettext
+
+locale.setlocale(locale.LC_ALL, '')
+gettext.textdomain('splitcpy')
+_ = gettext.gettext
+
+
+"""
+Copy file over split multiple SSH streams
+
+Main entry points:
+
+    establish_ssh_cred()
+        Verify ssh connectivity and determine pw, if needed
+
+    output_split()
+        write out one of the stripes for a file, for transmisison
+
+    dl_file()
+        retrieve a file from a remote host using multiple ssh streams
+"""
+
+
+def parse_net_spec(spec):
+    """Parse user@host:path into user, host, path"""
+
+    PathSpec = namedtuple('PathSpec', "user, host, path")
+
+    fullre = re.search('^(.+?)@(.+?):(.+)$', spec)
+    smallre = re.search('^(.+?):(.+)$', spec)
+
+    values = None
+    if fullre:
+        values = [fullre.group(x) for x in range(1, 4)]
+    elif smallre:
+        user = getpass.getuser()
+        values = [user] + [smallre.group(x) for x in range(1, 3)]
+    else:
+        values = None, None, spec
+
+    return PathSpec(*values)
+
+
+def is_net_spec(spec):
+    """Is the path spec of the form user@host:path?"""
+    return parse_net_spec(spec).user is not None
+
+
+def make_net_spec(user, host, path):
+    return "{0}@{1}:{2}".format(user, host, path)
+
+def slice_iter(fp, num_slices, slice_num, bytes, offset=0, length=None):
+    """Iterator returning packets of an interleaved slice of a file
+
+    The interleave covers the 'length' bytes starting at 'offset', or the
+    rest of the file if length is None.
+    """
+    pos = slice_num*bytes
+    fp.seek(offset + pos, 0)
+
+    while length is None or pos < length:
+        count = bytes if length is None else min(bytes, length - pos)
+        buf = fp.read(count)
+
+        if not buf:
+            break
+
+        yield buf
+
+        pos += num_slices*bytes
+        if num_slices > 1:
+            fp.seek((num_slices-1)*bytes, 1)
+
+
+def stripe_extents(size, num_slices):
+    """Split 'size' bytes into num_slices contiguous (offset, length) ranges"""
+    bounds = [i*size//num_slices for i in range(num_slices + 1)]
+    return [(a, b - a) for a, b in zip(bounds, bounds[1:])]
+
+
+def slice_extents(size, num_slices, slice_num, bytes, offset=0, length=None):
+    """Iterator returning the (offset, count) of each packet of a slice"""
+    end = size if length is None else min(size, offset + length)
+    pos = offset + slice_num*bytes
+
+    while pos < end:
+        yield pos, min(bytes, end - pos)
+        pos += num_slices*bytes
+
+
+def sendfile_fd(dst):
+    """Return the fd of dst, if it is a pipe or socket usable by sendfile"""
+    if not hasattr(os, 'sendfile'):
+        return None
+
+    try:
+        fd = dst.fileno()
+        mode = os.fstat(fd).st_mode
+    except (AttributeError, TypeError, ValueError, OSError):
+        return None
+
+    if stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode):
+        return fd
+
+    return None
+
+
+def sendfile_split(src, dst_fd, extents):
+    """sendfile() each extent of src to dst_fd
+
+    Returns False, having sent nothing, if the kernel can't sendfile
+    between these descriptors.
+    """
+    started = False
+    for pos, count in extents:
+        while count:
+            try:
+                sent = os.sendfile(dst_fd, src.fileno(), pos, count)
+            except OSError as e:
+                if not started and e.errno in (errno.EINVAL, errno.ENOSYS):
+                    return False
+                raise
+
+            if not sent:
+                return True         # the file shrank
+
+            started = True
+            pos += sent
+            count -= sent
+
+    return True
+
+
+def output_split(srcfile, num_slices, slice, bytes, dst, offset=0,
+                 length=None, trailer=False):
+    """Send an interleave slice of srcfile to dst
+
+    When dst is a pipe or socket, the chunks are passed with sendfile(),
+    without copying through Python.
+
+    With 'trailer', the slice is hashed as it is sent, and followed by a
+    TRAILER of its byte count and digest. This needs the data in Python,
+    so sendfile() is not used.
+    """
+    with open(srcfile, 'rb') as src:
+        dst_fd = None if trailer else sendfile_fd(dst)
+        if dst_fd is not None:
+            dst.flush()
+            size = os.fstat(src.fileno()).st_size
+            extents = slice_extents(size, num_slices, slice, bytes, offset,
+                                    length)
+            if sendfile_split(src, dst_fd, extents):
+                return
+
+        if not trailer:
+            for pkt in slice_iter(src, num_slices, slice, bytes, offset,
+                                  length):
+                dst.write(pkt)
+            return
+
+        count, hash = 0, stripe_hash()
+        for pkt in slice_iter(src, num_slices, slice, bytes, offset, length):
+            dst.write(pkt)
+            count += len(pkt)
+            hash.update(pkt)
+
+        dst.write(TRAILER.pack(count, hash.digest()))
+
+
+def input_split(dstfile, num_slices, slice, bytes, size, src, trailer=False):
+    """Write an interleave slice of a 'size' byte file, read from src
+
+    The counterpart of output_split(), for uploads. dstfile is created or
+    resized as needed, so the slices can arrive in any order. With
+    'trailer', the slice is checked against the TRAILER that follows it,
+    and TransferError is raised for a mismatch.
+    """
+    fd = os.open(dstfile, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+    if trailer:
+        src = StripeReader(src, slice_length(size, num_slices, slice, bytes))
+
+    write_direct(src, num_slices, slice, bytes, dstfile)
+
+    if trailer:
+        src.verify()
+
+
+# --serve response frames - type, file offset, payload length
+FRAME = struct.Struct('!cQI')
+
+FRAME_DATA = b'D'
+FRAME_END = b'E'
+FRAME_ERROR = b'X'
+FRAME_HASH = b'K'
+FRAME_COMPRESSED = b'Z'
+
+# block digests per hash frame
+HASH_BATCH = 4096
+DIGEST_SIZE = 16
+
+# end of slice - byte count, and the digest of the bytes
+TRAILER = struct.Struct('!Q%ds' % DIGEST_SIZE)
+
+
+def has_blake2b():
+    """Can this Python make block digests, and trailers? (3.6 or later)"""
+    return hasattr(hashlib, 'blake2b')
+
+
+def block_digest(buf):
+    return hashlib.blake2b(buf, digest_size=DIGEST_SIZE).digest()
+
+
+def stripe_hash():
+    """Return a new hash object, for the running digest of a slice"""
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def check_trailer(trailer, count, digest):
+    """Return an error message if the TRAILER doesn't match, or None"""
+    if len(trailer) < TRAILER.size:
+        return _("the stream was cut short after %d bytes") % count
+
+    sent, sent_digest = TRAILER.unpack(trailer)
+    if sent != count:
+        return _("received %d bytes of %d") % (count, sent)
+    if sent_digest != digest:
+        return _("checksum mismatch")
+
+    return None
+
+
+Codec = namedtuple('Codec', "name, compress, decompress")
+
+# in order of preference, for '--compress auto'
+CODECS = ['zstd', 'lz4']
+ZSTD_LEVEL = 3
+
+
+def available_codecs():
+    """Return the names of the compression codecs installed here"""
+    return [x for x in CODECS if {'zstd': zstandard, 'lz4': lz4}[x]]
+
+
+def make_codec(name):
+    """Return the Codec called 'name'
+
+    Raises ValueError if it is unknown, or its module isn't installed.
+    """
+    if name not in available_codecs():
+        raise ValueError(_("Compression '%s' is not available") % name)
+
+    if name == 'zstd':
+        return Codec(name,
+                     zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress,
+                     zstandard.ZstdDecompressor().decompress)
+
+    return Codec(name, lz4.frame.compress, lz4.frame.decompress)
+
+
+def pick_codec(choice, remote_codecs):
+    """Return the codec name to use for a --compress choice, or None"""
+    if choice == 'none':
+        return None
+    if choice == 'auto':
+        common = [x for x in available_codecs() if x in remote_codecs]
+        return common[0] if common else None
+
+    return choice if choice in remote_codecs else None
+
+
+def write_frame(dst, type, offset, payload=b''):
+    dst.write(FRAME.pack(type, offset, len(payload)))
+    dst.write(payload)
+
+
+def read_frame(fp):
+    """Return the next (type, offset, payload) frame from fp, None at EOF"""
+    hdr = fp.read(FRAME.size)
+    if len(hdr) < FRAME.size:
+        return None
+
+    type, offset, length = FRAME.unpack(hdr)
+    payload = fp.read(length)
+    if len(payload) < length:
+        return None
+
+    return type, offset, payload
+
+
+def serve_requests(src, dst):
+    """Answer block requests read from src, until EOF
+
+    Each request is a line of JSON, giving the 'path', 'offset', 'length'
+    and 'bytes' (chunk size) to send. The reply is a data frame for each
+    chunk, followed by an end frame, or an error frame and an end frame.
+    The end frame of a data reply carries a TRAILER for the data sent, if
+    this Python has blake2b.
+
+    For an 'op' of 'hash', the reply has hash frames in place of the data
+    frames, each carrying the digests of up to HASH_BATCH chunks.
+
+    A request with a 'compress' codec name gets a compressed frame in
+    place of each data frame whose chunk shrinks. The trailer is always
+    for the uncompressed data.
+    """
+    codecs = {}
+    for line in iter(src.readline, b''):
+        req = json.loads(line.decode())
+        offset = req['offset']
+        count, hash = 0, stripe_hash() if has_blake2b() else None
+        codec = None
+
+        try:
+            name = req.get('compress')
+            if name and name not in codecs:
+                codecs[name] = make_codec(name)
+            codec = codecs.get(name)
+
+            with open(req['path'], 'rb') as fp:
+                pkts = slice_iter(fp, 1, 0, req['bytes'], offset,
+                                  req['length'])
+                if req.get('op', 'data') == 'hash':
+                    while True:
+                        digests = [block_digest(x) for x in
+                                   itertools.islice(pkts, HASH_BATCH)]
+                        if not digests:
+                            break
+                        write_frame(dst, FRAME_HASH, offset, b''.join(digests))
+                        offset += len(digests)*req['bytes']
+                else:
+                    pos = offset
+                    for pkt in pkts:
+                        packed = codec.compress(pkt) if codec else pkt
+                        if len(packed) < len(pkt):
+                            write_frame(dst, FRAME_COMPRESSED, pos, packed)
+                        else:
+                            write_frame(dst, FRAME_DATA, pos, pkt)
+                        pos += len(pkt)
+                        if hash:
+                            hash.update(pkt)
+                    count = pos - offset
+        except (IOError, OSError, ValueError) as e:
+            write_frame(dst, FRAME_ERROR, offset, str(e).encode())
+
+        trailer = b''
+        if req.get('op', 'data') == 'data' and hash:
+            trailer = TRAILER.pack(count, hash.digest())
+        write_frame(dst, FRAME_END, req['offset'], trailer)
+        dst.flush()
+
+
+# bytes of kernel buffer to ask for, on each slice's stdout pipe
+PIPE_SIZE = 1024*1024
+
+
+def grow_pipe(fd, size=PIPE_SIZE):
+    """Enlarge the kernel buffer of a pipe, if F_SETPIPE_SZ is available"""
+    setpipe = getattr(fcntl, 'F_SETPIPE_SZ',
+                      1031 if sys.platform.startswith('linux') else None)
+    if setpipe is None:
+        return
+
+    try:
+        fcntl.fcntl(fd, setpipe, size)
+    except (IOError, OSError):      # not a pipe, or over pipe-max-size
+        pass
+
+
+RING_SLOTS = 10
+
+Ring = namedtuple('Ring', "shm, size, free")
+
+
+def make_ring(bytes, slots=RING_SLOTS):
+    """Allocate a shared memory ring of 'slots' buffers of 'bytes' each"""
+    shm = shared_memory.SharedMemory(create=True, size=bytes*slots)
+    free = Queue()
+    for slot in range(slots):
+        free.put(slot)
+
+    return Ring(shm, bytes, free)
+
+
+def del_ring(ring):
+    ring.shm.close()
+    ring.shm.unlink()
+
+
+def ring_view(ring, slot, count):
+    """Return a memoryview of the first 'count' bytes of a ring slot"""
+    return ring.shm.buf[slot*ring.size:slot*ring.size + count]
+
+
+def read_full(fp, view):
+    """Fill view from fp, returning the byte count (short only at EOF)"""
+    count = 0
+    while count < len(view):
+        n = fp.readinto(view[count:])
+        if not n:
+            break
+        count += n
+
+    return count
+
+
+def read_ring(fp, num_slices, slice, bytes, queue, ring, offset=0):
+    """Read fp into free ring slots, queueing (slice, offset, (slot, count))
+    for each chunk. Returns the number of bytes read."""
+    total = 0
+    for k in itertools.count():
+        slot = ring.free.get()
+
+        view = ring_view(ring, slot, bytes)
+        try:
+            count = read_full(fp, view)
+        finally:
+            view.release()
+
+        if not count:
+            ring.free.put(slot)
+            break
+
+        queue.put((slice, chunk_offset(num_slices, slice, bytes, k, offset),
+                   (slot, count)))
+        total += count
+
+    return total
+
+
+def read_chunks(fp, num_slices, slice, bytes, queue, offset=0):
+    """Queue (slice, offset, data) for each chunk of an interleave slice
+    read from fp. Returns the number of bytes read."""
+    total = 0
+    for k in itertools.count():
+        buf = fp.read(bytes)
+
+        if not buf:
+            break
+
+        queue.put((slice, chunk_offset(num_slices, slice, bytes, k, offset),
+                   buf))
+        total += len(buf)
+
+    return total
+
+
+def chunk_offset(num_slices, slice, bytes, k, offset=0):
+    """File offset of the k'th chunk of an interleave slice"""
+    return offset + slice*bytes + k*num_slices*bytes
+
+
+def write_direct(fp, num_slices, slice, bytes, dest, offset=0):
+    """Write the chunks of an interleave slice at their offsets in dest,
+    returning the number of bytes written"""
+    total = 0
+    fd = os.open(dest, os.O_WRONLY)
+    try:
+        for k in itertools.count():
+            buf = fp.read(bytes)
+
+            if not buf:
+                break
+
+            os.pwrite(fd, buf,
+                      chunk_offset(num_slices, slice, bytes, k, offset))
+            total += len(buf)
+    finally:
+        os.close(fd)
+
+    return total
+
+
+def preallocate(path, size, sparse=False):
+    """Create or truncate path, reserving 'size' bytes if it is known
+
+    A 'sparse' file is only extended to 'size', leaving it all a hole, so
+    that the regions that are never written take no space.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        if size and sparse:
+            os.ftruncate(fd, size)
+        elif size:
+            try:
+                os.posix_fallocate(fd, 0, size)
+            except (AttributeError, OSError):   # no fallocate support
+                os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def make_control():
+    """Return a fresh path for an ssh ControlMaster socket"""
+    return os.path.join(tempfile.mkdtemp(), 'control')
+
+
+def close_control(user, host, port, control):
+    """Stop the ControlMaster listening on 'control', and remove the socket"""
+    with open(os.devnull, 'w') as devnull:
+        subprocess.call(["ssh", "-o", "ControlPath=%s" % control, "-O", "exit",
+                         "-p", str(port), "%s@%s" % (user, host)],
+                        stdout=devnull, stderr=devnull)
+
+    shutil.rmtree(os.path.dirname(control), ignore_errors=True)
+
+
+def ssh_argv(user, host, port, control=None):
+    """Return the ssh command for user@host, as an argument list
+
+    With a ControlMaster socket path, the session runs as a channel of the
+    already-authenticated master connection.
+    """
+    argv = ["ssh", "-p", str(port)]
+    if control:
+        argv += ["-o", "ControlMaster=no", "-o", "ControlPath=%s" % control]
+
+    return argv + ["%s@%s" % (user, host)]
+
+
+class Transport(object):
+    """How the remote splitcpy is run
+
+    The 'ssh' transport runs it on the remote host. 'local' runs it as a
+    local subprocess, and 'inproc' in a thread of the calling process,
+    whatever the host, so that the striping and reassembly can be tested
+    and benchmarked without an sshd.
+    """
+
+    multiplex = False       # supports -M
+
+    def argv(self, user, host, port, pw, control, args):
+        """Return the argument list and environment to run 'splitcpy args'
+        """
+        raise NotImplementedError
+
+    def popen(self, user, host, port, pw, control, args, **kwargs):
+        """Start 'splitcpy args', returning a Popen, or a work-alike"""
+        argv, env = self.argv(user, host, port, pw, control, args)
+        return subprocess.Popen(argv, env=env, **kwargs)
+
+    def establish(self, user, host, port, pathlist, control=None):
+        """Return the password to use, and the remote's -f info for
+        pathlist"""
+        with open(os.devnull, 'r') as devnull:
+            p = self.popen(user, host, port, None, None, ['-f'] + pathlist,
+                           stdin=devnull, stdout=subprocess.PIPE)
+
+        out = p.stdout.read()
+        p.stdout.close()
+        if p.wait():
+            raise CredException
+
+        return None, json.loads(out.decode())
+
+    def close(self, user, host, port, control):
+        pass
+
+
+class SshTransport(Transport):
+
+    multiplex = True
+
+    def argv(self, user, host, port, pw, control, args):
+        """The args are quoted for the remote shell. The environment is
+        None, unless it has to carry the password for sshpass."""
+        argv = ssh_argv(user, host, port, control) + \
+            ["splitcpy"] + [quote(x) for x in args]
+
+        env = None
+        if pw is not None and not control:
+            argv = ["sshpass", "-e"] + argv
+            env = dict(os.environ, SSHPASS=pw)
+
+        return argv, env
+
+    def establish(self, user, host, port, pathlist, control=None):
+        return establish_ssh_cred(user, host, port, pathlist, control=control)
+
+    def close(self, user, host, port, control):
+        close_control(user, host, port, control)
+
+
+class LocalTransport(Transport):
+
+    def argv(self, user, host, port, pw, control, args):
+        """Run this copy of splitcpy, with this Python"""
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        path = [root] + [x for x in [os.environ.get('PYTHONPATH')] if x]
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+
+        return [sys.executable, "-m", "splitcpy"] + list(args), env
+
+
+class InprocTransport(Transport):
+
+    def argv(self, user, host, port, pw, control, args):
+        raise TransferError(_("The inproc transport has no command line"))
+
+    def popen(self, user, host, port, pw, control, args, **kwargs):
+        return InprocProcess(args)
+
+
+class InprocProcess(object):
+    """A Popen work-alike, running the remote side in a thread
+
+    The thread reads stdin, and writes stdout and stderr, as a subprocess
+    would. They are socket pairs rather than pipes, so that either end
+    can be shut down, even while a forked process holds a copy of it. A
+    thread can't be killed, so kill() only shuts down stdin, and stops
+    waiting for it.
+    """
+
+    def __init__(self, args):
+        self.args = list(args)
+        self.returncode = None
+
+        pairs = [socket.socketpair() for n in range(3)]
+        self.socks = [x[0] for x in pairs]
+        self.stdin = InprocStdin(self.socks[0])
+        self.stdout = self.socks[1].makefile('rb')
+        self.stderr = self.socks[2].makefile('rb')
+
+        self.thread = threading.Thread(target=self.run,
+                                       args=[x[1] for x in pairs])
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, insock, outsock, errsock):
+        status = 1
+        try:
+            with insock.makefile('rb') as infp, \
+                    outsock.makefile('wb') as outfp, \
+                    errsock.makefile('wb') as errfp:
+                run_remote(parse_args(self.args), infp, outfp, errfp)
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except Exception:           # as a crashed remote would
+            pass
+        finally:
+            for sock in (insock, outsock, errsock):
+                shutdown(sock)
+                sock.close()
+
+        if self.returncode is None:
+            self.returncode = status
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self):
+        if self.returncode is None:
+            self.thread.join()
+
+        return self.returncode
+
+    def kill(self):
+        if self.returncode is None:
+            self.returncode = -9
+        shutdown(self.socks[0])
+
+
+class InprocStdin(io.BufferedWriter):
+    """The stdin of an InprocProcess, which the far end sees end on close"""
+
+    def __init__(self, sock):
+        io.BufferedWriter.__init__(self, socket.SocketIO(sock, 'wb'))
+        self.sock = sock
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+            finally:
+                shutdown(self.sock, socket.SHUT_WR)
+                io.BufferedWriter.close(self)
+
+
+def shutdown(sock, how=socket.SHUT_RDWR):
+    """Shut down a socket, which may already be closed"""
+    try:
+        sock.shutdown(how)
+    except (IOError, OSError):
+        pass
+
+
+TRANSPORTS = {
+    'ssh': SshTransport(),
+    'local': LocalTransport(),
+    'inproc': InprocTransport(),
+}
+
+
+def remote_argv(user, host, port, pw, control, args, transport=None):
+    """Return the argument list and environment to run 'splitcpy args' on
+    the remote, with 'transport' (ssh by default)"""
+    transport = transport or TRANSPORTS['ssh']
+    return transport.argv(user, host, port, pw, control, args)
+
+
+def remote_popen(user, host, port, pw, control, args, transport=None,
+                 **kwargs):
+    """Start 'splitcpy args' on the remote, with 'transport' (ssh by
+    default), returning a Popen or work-alike. The kwargs are those of
+    Popen."""
+    transport = transport or TRANSPORTS['ssh']
+    return transport.popen(user, host, port, pw, control, args, **kwargs)
+
+
+def slice_args(path, num_slices, slice, bytes, extent=None, trailer=False):
+    """Return the remote splitcpy arguments to send a slice of path"""
+    spec = "%d,%d,%d" % (num_slices, slice, bytes)
+    if extent:
+        spec += ",%d,%d" % extent
+
+    return [path, "-s", spec] + (["--trailer"] if trailer else [])
+
+
+def slice_length(size, num_slices, slice, bytes, extent=None):
+    """Return the number of bytes in a slice of a 'size' byte file"""
+    offset, length = extent or (0, None)
+    return sum(x[1] for x in slice_extents(size, num_slices, slice, bytes,
+                                           offset, length))
+
+
+class StartLimiter(object):
+    """Pace new ssh connections, to stay under the server's MaxStartups
+
+    Up to BURST connections start at once, and the rest follow at 'rate'
+    per second. The rate is halved each time the server turns a
+    connection away, and grows again as connections are accepted. The
+    state is shared, so the limiter can be passed to slice processes.
+    """
+    BURST = 10              # sshd's default MaxStartups begins at 10
+    RATE = 40.0
+    MIN_RATE = 1.0
+    MAX_RATE = 1000.0
+    GAIN = 1.1
+
+    def __init__(self, burst=BURST, rate=RATE):
+        self.burst = burst
+        self.lock = Lock()
+        self.rate = Value('d', rate, lock=False)
+        self.tokens = Value('d', burst, lock=False)
+        self.stamp = Value('d', time.time(), lock=False)
+
+    def reserve(self):
+        """Claim the next start, returning the seconds to wait for it"""
+        with self.lock:
+            now = time.time()
+            tokens = min(self.burst, self.tokens.value +
+                         (now - self.stamp.value)*self.rate.value) - 1
+            self.tokens.value, self.stamp.value = tokens, now
+
+            return max(0.0, -tokens/self.rate.value)
+
+    def wait(self):
+        time.sleep(self.reserve())
+
+    def rejected(self):
+        with self.lock:
+            self.rate.value = max(self.MIN_RATE, self.rate.value/2)
+            self.tokens.value = min(self.tokens.value, 0)   # no more bursts
+
+    def accepted(self):
+        with self.lock:
+            self.rate.value = min(self.MAX_RATE, self.rate.value*self.GAIN)
+
+
+# ssh's exit status when it can't connect, or is disconnected
+SSH_FAILED = 255
+START_RETRIES = 5
+
+
+def start_slice(user, host, port, pw, control, args, limiter=None,
+                stall=None, transport=None):
+    """Start a remote 'splitcpy args' slice, once its connection is
+    accepted
+
+    The connection is retried, up to START_RETRIES times, if ssh fails
+    before any data arrives. Returns the Popen object, or raises
+    TransferError. StreamError is raised if no data arrives for 'stall'
+    seconds.
+    """
+    for attempt in range(START_RETRIES):
+        if limiter:
+            limiter.wait()
+
+        p = remote_popen(user, host, port, pw, control, args, transport,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                         stdin=subprocess.PIPE)
+
+        grow_pipe(p.stdout.fileno())
+
+        watchdog = None
+        if stall:
+            watchdog = Watchdog(p, stall)
+            watchdog.arm()
+        try:
+            started = p.stdout.peek(1) or p.wait() != SSH_FAILED
+        finally:
+            if watchdog:
+                watchdog.stop()
+
+        if watchdog and watchdog.stalled:
+            p.wait()
+            raise StreamError(_("The stream stalled"), 0)
+
+        if started:
+            if limiter:
+                limiter.accepted()
+            return p
+
+        if limiter:
+            limiter.rejected()
+
+    raise TransferError(_("The server refused %d connections") %
+                        START_RETRIES)
+
+
+# a slice whose ssh dies is resumed up to RETRY_LIMIT times, waiting
+# RETRY_DELAY seconds at first, and twice as long each time after
+RETRY_LIMIT = 5
+RETRY_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# a slow slice is re-rolled up to REROLL_LIMIT times, then left to finish
+REROLL_LIMIT = 3
+
+
+def retry_delay(attempt):
+    """Seconds to wait before the attempt'th retry of a slice (from 0)"""
+    return min(RETRY_MAX_DELAY, RETRY_DELAY * 2**attempt)
+
+
+def resume_extent(size, num_slices, bytes, extent, done):
+    """Return the extent of a slice that is left after 'done' chunks
+
+    The interleave of the returned (offset, length) extent continues
+    where the slice left off, so the same num_slices and slice number
+    are used to fetch it.
+    """
+    offset, length = extent or (0, size)
+    skip = min(length, done*num_slices*bytes)
+    return (offset + skip, length - skip)
+
+
+def make_stripes(num_slices, size, layout='interleave'):
+    """Return the (num_slices, slice, extent) of each slice to download"""
+    if layout == 'range':
+        return [(1, 0, x) for x in stripe_extents(size, num_slices) if x[1]]
+
+    return [(num_slices, n, None) for n in range(num_slices)]
+
+
+class StripeReader(object):
+    """Read the 'length' bytes of a slice from fp, then check its trailer
+
+    The data is hashed as it is read, so verify() costs no extra pass.
+    """
+
+    def __init__(self, fp, length):
+        self.fp = fp
+        self.left = length
+        self.count = 0
+        self.hash = stripe_hash()
+
+    def _add(self, buf):
+        self.left -= len(buf)
+        self.count += len(buf)
+        self.hash.update(buf)
+
+    def read(self, size):
+        buf = self.fp.read(min(size, self.left))
+        self._add(buf)
+        return buf
+
+    def readinto(self, view):
+        count = self.fp.readinto(view[:min(len(view), self.left)])
+        self._add(view[:count])
+        return count
+
+    def verify(self):
+        """Raise TransferError if the slice doesn't match its trailer"""
+        trailer = self.fp.read(TRAILER.size)
+        error = check_trailer(trailer, self.count, self.hash.digest())
+        if error is None and self.left:
+            error = _("received %d bytes of %d") % (self.count,
+                                                    self.count + self.left)
+        if error:
+            raise TransferError(error)
+
+
+def run_slice(ns, num_slices, slice, bytes, queue, pw, port, ring=None,
+              dest=None, extent=None, control=None, length=None,
+              limiter=None, stall=None, flow=None, transport=None):
+    """Fetch one stream of a slice, for dl_slice()
+
+    The options are those of dl_slice(), with the 'length' of the slice
+    to verify, if any.
+
+    Returns if the whole slice arrived. Raises StreamError, with the byte
+    count delivered, if ssh failed part way or the stream stalled,
+    StreamRerolled if its Flow flag was raised, or TransferError.
+    """
+    offset = extent[0] if extent else 0
+    if flow and flow.flags is not None:
+        flow.flags[flow.index] = 0
+    p = start_slice(ns.user, ns.host, port, pw, control,
+                    slice_args(ns.path, num_slices, slice, bytes, extent,
+                               length is not None),
+                    limiter, stall, transport)
+    watchdog = None
+
+    try:
+        fp = p.stdout
+        if stall or flow:
+            watchdog = Watchdog(p, stall, flow)
+            watchdog.arm()
+            fp = watchdog.reader(fp)
+        if length is not None:
+            fp = StripeReader(fp, length)
+
+        if dest:
+            count = write_direct(fp, num_slices, slice, bytes, dest, offset)
+        elif ring:
+            count = read_ring(fp, num_slices, slice, bytes, queue, ring,
+                              offset)
+        else:
+            count = read_chunks(fp, num_slices, slice, bytes, queue, offset)
+
+        status = p.wait()
+        if watchdog and watchdog.stalled:
+            raise StreamError(_("The stream stalled"), count)
+        if watchdog and watchdog.rerolled:
+            raise StreamRerolled(_("The stream was re-rolled"), count)
+        if status == SSH_FAILED:
+            raise StreamError(_("The connection was lost"), count)
+        if status:
+            raise TransferError(_("A slice exited with status %d") % status)
+
+        if length is not None:
+            fp.verify()
+    finally:
+        if watchdog:
+            watchdog.stop()
+        if p.poll() is None:
+            p.kill()
+
+
+# seconds without data before a stream is taken to have stalled
+STALL_TIMEOUT = 60.0
+
+
+# a slice's share of the shared per-slice byte counts and re-roll flags
+Flow = namedtuple('Flow', "counts, flags, index")
+
+
+class Watchdog(object):
+    """Kill a process that makes no progress for 'timeout' seconds
+
+    The process is only watched while armed, and its output is read
+    through reader(), so that each read counts as progress. The check
+    runs in a daemon thread, until stop().
+
+    With a Flow, the bytes read are added to its count, and the process
+    is also killed when its flag is raised, to re-roll the connection. A
+    Flow without flags only counts.
+    """
+
+    def __init__(self, proc, timeout=None, flow=None):
+        self.proc = proc
+        self.timeout = timeout
+        self.flow = flow
+        self.stamp = None
+        self.stalled = False
+        self.rerolled = False
+        self.done = threading.Event()
+
+        thread = threading.Thread(target=self.watch)
+        thread.daemon = True
+        thread.start()
+
+    def arm(self):
+        self.stamp = time.time()
+
+    def disarm(self):
+        self.stamp = None
+
+    def kick(self, count=0):
+        if self.stamp is not None:
+            self.stamp = time.time()
+        if self.flow:
+            self.flow.counts[self.flow.index] += count
+
+    def watch(self):
+        interval = min(1.0, self.timeout / 4.0) if self.timeout else 1.0
+        while not self.done.wait(interval):
+            stamp = self.stamp
+            if stamp is None:
+                continue
+
+            if self.timeout and time.time() - stamp >= self.timeout:
+                self.stalled = True
+            elif self.flow and self.flow.flags is not None and \
+                    self.flow.flags[self.flow.index]:
+                self.rerolled = True
+            else:
+                continue
+
+            self.proc.kill()
+            return
+
+    def stop(self):
+        self.done.set()
+
+    def reader(self, fp):
+        return WatchedReader(fp, self)
+
+
+class WatchedReader(object):
+    """Read a buffered file a pipe's worth at a time, kicking a Watchdog
+    as each piece arrives"""
+
+    def __init__(self, fp, watchdog):
+        self.fp = fp
+        self.watchdog = watchdog
+
+    def read(self, size):
+        bufs, count = [], 0
+        while count < size:
+            buf = self.fp.read1(min(size - count, PIPE_SIZE))
+            if not buf:
+                break
+
+            self.watchdog.kick(len(buf))
+            bufs.append(buf)
+            count += len(buf)
+
+        return b''.join(bufs)
+
+    def readinto(self, view):
+        count = self.fp.readinto1(view)
+        self.watchdog.kick(count)
+        return count
+
+
+class FlowMonitor(object):
+    """Pick out the slices that stay far slower than the rest
+
+    Every INTERVAL, the rate of each slice that is receiving data is
+    compared with the median. A slice that is below FRACTION of it for
+    STRIKES intervals in a row is re-rolled - closed and reopened, which
+    gets a new source port, and maybe a better path or shaping bucket.
+    At least MIN_FLOWS slices have to be running for a fair median.
+    """
+
+    INTERVAL = 5.0
+    FRACTION = 0.5
+    STRIKES = 3
+    MIN_FLOWS = 3
+
+    def __init__(self, count):
+        self.last = [0.0] * count
+        self.strikes = [0] * count
+
+    def update(self, totals):
+        """Take the per-slice byte counts - return the slices to re-roll"""
+        rates = [x - y for x, y in zip(totals, self.last)]
+        self.last = list(totals)
+
+        live = sorted(x for x in rates if x > 0)
+        if len(live) < self.MIN_FLOWS:
+            return []
+
+        median = live[len(live) // 2]
+        slow = []
+        for n, rate in enumerate(rates):
+            if 0 < rate < median * self.FRACTION:
+                self.strikes[n] += 1
+            else:
+                self.strikes[n] = 0
+
+            if self.strikes[n] >= self.STRIKES:
+                self.strikes[n] = 0
+                slow.append(n)
+
+        return slow
+
+
+def dl_slice(src_spec, num_slices, slice, bytes, queue, pw, port, ring=None,
+             dest=None, extent=None, control=None, size=None, limiter=None,
+             verify=False, stall=None, flow=None, transport=None):
+    """Call a remote interleave slice of a file to download
+
+    Each chunk is queued as (slice, file offset, data), and a None marks
+    the end of the slice. If the slice fails, (slice, None, message) is
+    queued instead.
+
+    If a shared memory ring is given, chunks are read directly into its
+    slots, and only the slot index and length are sent, as the data.
+
+    If dest is given, the chunks are written straight to their positions
+    in that (existing) file, and the queue only gets the end marker.
+
+    An (offset, length) extent limits the interleave to that byte range.
+
+    With a ControlMaster socket path, the slice is run over the shared
+    master connection, and no password is needed.
+
+    If the file 'size' is known, a slice whose ssh connection dies, or
+    that gets no data for 'stall' seconds, is resumed from its last whole
+    chunk, on a new connection, after a backoff. It fails after
+    RETRY_LIMIT retries. A slice with a Flow counts its bytes in it, and
+    is resumed the same way, but at once, when its flag is raised - up
+    to REROLL_LIMIT times, after which its flag is ignored. With
+    'verify', each stream is checked against the remote's trailer of its
+    byte count and digest.
+
+    A shared StartLimiter paces the ssh connections, and is told whether
+    they were accepted.
+    """
+
+    ns = parse_net_spec(src_spec)
+    retries = 0
+    rerolls = 0
+
+    try:
+        while True:
+            length = None
+            if verify:
+                length = slice_length(size, num_slices, slice, bytes, extent)
+
+            try:
+                run_slice(ns, num_slices, slice, bytes, queue, pw, port,
+                          ring=ring, dest=dest, extent=extent,
+                          control=control, length=length, limiter=limiter,
+                          stall=stall, flow=flow, transport=transport)
+                break
+            except StreamError as e:
+                rerolled = isinstance(e, StreamRerolled)
+                if size is None or (retries >= RETRY_LIMIT and not rerolled):
+                    raise
+
+                extent = resume_extent(size, num_slices, bytes, extent,
+                                       e.count // bytes)
+                if rerolled:
+                    rerolls += 1
+                    if rerolls >= REROLL_LIMIT:
+                        flow = flow._replace(flags=None)
+                else:
+                    time.sleep(retry_delay(retries))
+                    retries += 1
+    except TransferError as e:
+        queue.put((slice, None, str(e)))
+        return
+
+    queue.put(None)
+
+
+def dl_file(src, dest, num_slices, bytes, pw, port, shm=False, direct=False,
+            size=None, layout='interleave', control=None, verify=False,
+            stall=None, transport=None):
+    """Perform a parallel download of a file
+
+    The slices share one queue, and their chunks are written at their
+    offsets in whatever order they arrive, so that a slow slice does not
+    hold up the others.
+
+    With 'shm', each slice reads into its own shared memory ring, and the
+    file is written from the ring slots without copying through the queue.
+
+    With 'direct', each slice writes its own chunks into dest, which is
+    first preallocated to 'size' bytes (if known).
+
+    The 'range' layout sends each slice one contiguous range of the file,
+    rather than every num_slices'th chunk. It requires 'size', and implies
+    'direct'.
+
+    A ControlMaster socket path runs the slices as channels of that
+    connection. The slices are started together, paced by a StartLimiter.
+
+    With 'verify', each slice is checked against the byte count and
+    digest sent after it, and a TransferError is raised for a mismatch.
+    This needs 'size'. Given the 'size', a slice that loses its
+    connection, or gets nothing for 'stall' seconds, is resumed on a new
+    one while the others carry on. A FlowMonitor also compares the
+    slices' rates, and has the persistently slow ones re-rolled.
+
+    The remote slices are run with 'transport', over ssh by default.
+    """
+
+    slist = []
+    Slice = namedtuple("Slice", "proc, ring")
+
+    if layout == 'range':
+        direct = True
+    stripes = make_stripes(num_slices, size, layout)
+
+    if direct:
+        preallocate(dest, size)
+    q = Queue(RING_SLOTS*len(stripes))
+    limiter = StartLimiter()
+
+    # slices can only be re-rolled if they can be resumed
+    monitor = None
+    counts = Array('d', len(stripes), lock=False)
+    flags = Array('b', len(stripes), lock=False)
+    if size is not None:
+        monitor = FlowMonitor(len(stripes))
+
+    try:
+        for index, (nslices, n, extent) in enumerate(stripes):
+            ring = make_ring(bytes) if shm and not direct else None
+            flow = Flow(counts, flags, index) if monitor else None
+            p = Process(target=dl_slice,
+                        args=(src, nslices, n, bytes, q, pw, port),
+                        kwargs=dict(ring=ring,
+                                    dest=dest if direct else None,
+                                    extent=extent, control=control,
+                                    size=size, limiter=limiter,
+                                    verify=verify, stall=stall, flow=flow,
+                                    transport=transport)
+            )
+            slist.append(Slice(p, ring))
+            p.start()
+
+        # direct slices only report their end, or an error
+        with open(dest, 'r+b' if direct else 'wb') as dfp:
+            running = len(slist)
+            checked = time.time()
+            while running:
+                if monitor and time.time() - checked >= monitor.INTERVAL:
+                    for index in monitor.update(counts[:]):
+                        flags[index] = 1
+                    checked = time.time()
+
+                try:
+                    msg = q.get(timeout=1)
+                except Empty:
+                    if not any(s.proc.is_alive() for s in slist):
+                        raise TransferError(_("A slice exited unexpectedly"))
+                    continue
+
+                if msg is None:
+                    running -= 1
+                    continue
+
+                n, offset, data = msg
+                if offset is None:
+                    raise TransferError(data)
+
+                dfp.seek(offset)
+
+                ring = slist[n].ring
+                if ring:
+                    slot, count = data
+                    view = ring_view(ring, slot, count)
+                    try:
+                        dfp.write(view)
+                    finally:
+                        view.release()
+                    ring.free.put(slot)
+                else:
+                    dfp.write(data)
+    finally:
+        [s.proc.terminate() for s in slist if s.proc.is_alive()]
+        [s.proc.join() for s in slist]
+        [del_ring(s.ring) for s in slist if s.ring]
 
-from collections import namedtuple
-from distutils.version import LooseVersion
 
-import locale
-import gettext
+def ul_slice(src, dest_spec, num_slices, slice, bytes, queue, pw, port,
+             control=None, verify=False, limiter=None, transport=None):
+    """Send an interleave slice of a local file to a remote 'splitcpy -w'
 
-locale.setlocale(locale.LC_ALL, '')
-gettext.textdomain('splitcpy')
-_ = gettext.gettext
+    The outcome is queued as (slice, None), or (slice, error message).
+    With 'verify', the remote checks the slice against a trailer.
+    """
+    ns = parse_net_spec(dest_spec)
+    size = os.path.getsize(src)
+    p = None
+    error = None
 
+    try:
+        args = [ns.path, "-w", "%d,%d,%d,%d" % (num_slices, slice, bytes,
+                                               size)]
+        if limiter:
+            limiter.wait()
+
+        with open(os.devnull, 'w') as devnull:
+            p = remote_popen(ns.user, ns.host, port, pw, control,
+                             args + (["--trailer"] if verify else []),
+                             transport, stdin=subprocess.PIPE, stdout=devnull,
+                             stderr=subprocess.PIPE)
+
+        grow_pipe(p.stdin.fileno())
+        try:
+            output_split(src, num_slices, slice, bytes, p.stdin,
+                         trailer=verify)
+            p.stdin.close()
+        except (IOError, OSError) as e:     # the remote went away
+            error = str(e)
+
+        err = p.stderr.read()
+        if p.wait():
+            lines = err.decode('utf-8', 'replace').strip().splitlines()
+            error = lines[-1] if lines else \
+                _("The remote exited with status %d") % p.returncode
+    finally:
+        if p and p.poll() is None:
+            p.kill()
 
-"""
-Copy file over split multiple SSH streams
+    queue.put((slice, error))
 
-Main entry points:
 
-    establish_ssh_cred()
-        Verify ssh connectivity and determine pw, if needed
+def ul_file(src, dest_spec, num_slices, bytes, pw, port, control=None,
+            verify=False, transport=None):
+    """Perform a parallel upload of a local file
 
-    output_split()
-        write out one of the stripes for a file, for transmisison
+    Each slice process writes its interleave slice of src to its own ssh
+    stream, and the remote writes the chunks in place in the destination.
+    """
+    q = Queue()
+    limiter = StartLimiter()
+    procs = [Process(target=ul_slice,
+                     args=(src, dest_spec, num_slices, n, bytes, q, pw, port,
+                           control, verify, limiter, transport))
+             for n in range(num_slices)]
 
-    dl_file()
-        retrieve a file from a remote host using multiple ssh streams
-"""
+    try:
+        [p.start() for p in procs]
+
+        running = len(procs)
+        while running:
+            try:
+                slice, error = q.get(timeout=1)
+            except Empty:
+                if not any(p.is_alive() for p in procs):
+                    raise TransferError(_("A slice exited unexpectedly"))
+                continue
+
+            if error:
+                raise TransferError(error)
+            running -= 1
+    finally:
+        [p.terminate() for p in procs if p.is_alive()]
 
+    [p.join() for p in procs]
 
-def parse_net_spec(spec):
-    """Parse user@host:path into user, host, path"""
 
-    PathSpec = namedtuple('PathSpec', "user, host, path")
+Job = namedtuple('Job', "path, dest, offset, length")
 
-    fullre = re.search('^(.+?)@(.+?):(.+)$', spec)
-    smallre = re.search('^(.+?):(.+)$', spec)
 
-    values = None
-    if fullre:
-        values = [fullre.group(x) for x in range(1, 4)]
-    elif smallre:
-        user = getpass.getuser()
-        values = [user] + [smallre.group(x) for x in range(1, 3)]
-    else:
-        values = None, None, spec
+# jobs per stream's share of the transfer, for the streams to divide up
+UNITS_PER_STREAM = 4
 
-    return PathSpec(*values)
 
+def schedule_jobs(extents, num_streams, bytes):
+    """Pack Job extents of files into Jobs for num_streams streams
 
-def is_net_spec(spec):
-    """Is the path spec of the form user@host:path?"""
-    return parse_net_spec(spec).user is not None
+    Each extent (normally a whole file) is split, on chunk boundaries,
+    into a number of jobs in proportion to its share of the total size. A
+    small file is one job, and a large one is split into UNITS_PER_STREAM
+    jobs for each stream's share, so that the faster streams end up taking
+    on more of the jobs. The largest jobs are listed first, and the small
+    ones fill in around them.
+    """
+    total = sum(x.length for x in extents)
+    units = num_streams*UNITS_PER_STREAM
+    share = max(total // units, bytes)
 
+    jobs = []
+    for path, dest, start, size in extents:
+        if not size:
+            continue
 
-def make_net_spec(user, host, path):
-    return "{0}@{1}:{2}".format(user, host, path)
+        chunks = (size + bytes - 1) // bytes
+        parts = max(1, min(units, chunks, (size + share//2) // share))
+        for first, count in stripe_extents(chunks, parts):
+            offset = first*bytes
+            jobs.append(Job(path, dest, start + offset,
+                            min(count*bytes, size - offset)))
 
-def slice_iter(fp, num_slices, slice_num, bytes):
-    """Iterator returning packets of an interleaved slice of a file"""
-    fp.seek(slice_num*bytes, 0)
+    return sorted(jobs, key=lambda x: x.length, reverse=True)
 
-    while True:
-        buf = fp.read(bytes)
 
-        if not buf:
-            break
+class ChunkSizer(object):
+    """Choose the chunk size for a stream from its measured throughput
 
-        yield buf
+    The size doubles for as long as each doubling raises the throughput
+    by GAIN, and then settles on the best size found. The search starts
+    over if the throughput later falls to half of the best seen.
+    """
 
-        fp.seek((num_slices-1)*bytes, 1)
+    START = 64*1024
+    MAX = 4*1024*1024
+    GAIN = 1.1
 
+    def __init__(self):
+        self.size = self.START
+        self.best = 0
+        self.best_size = self.START
+        self.settled = False
 
-def output_split(srcfile, num_slices, slice, bytes, dst):
-    """Send an interleave slice of srcfile to dst"""
-    with open(srcfile, 'rb') as src:
-        for pkt in slice_iter(src, num_slices, slice, bytes):
-            dst.write(pkt)
+    def update(self, count, elapsed):
+        rate = count / max(elapsed, 1e-6)
 
+        if self.settled:
+            if rate < self.best / 2:
+                self.best = rate
+                self.best_size = self.size
+                self.settled = False
+            return
 
-def make_fifo():
-    fifo_path = os.path.join(tempfile.mkdtemp(), uuid.uuid4().__str__())
-    os.mkfifo(fifo_path)
-    return fifo_path
+        if rate > self.best * self.GAIN:
+            self.best = rate
+            self.best_size = self.size
+            if self.size < self.MAX:
+                self.size *= 2
+            else:
+                self.settled = True
+        else:
+            self.size = self.best_size
+            self.settled = True
 
 
-def del_fifo(path):
-    dir = '/'.join(path.split('/')[0:-1])
-    shutil.rmtree(dir)
+# chunks per request for -b auto, the most bytes requested at once
+# otherwise, and the requests kept in flight
+REQUEST_CHUNKS = 16
+MAX_REQUEST = 64*1024*1024
+PIPELINE = 2
 
 
-def dl_slice(src_spec, num_slices, slice, bytes, queue, pw, port):
-    """Call a remote interleave slice of a file to download"""
+def send_request(fp, path, offset, length, bytes, op='data', compress=None):
+    req = {'op': op, 'path': path, 'offset': offset, 'length': length,
+           'bytes': bytes}
+    if compress:
+        req['compress'] = compress
+    fp.write((json.dumps(req) + '\n').encode())
+    fp.flush()
 
-    ns = parse_net_spec(src_spec)
-    p = fifo_path = None
 
-    try:
-        fifo_path = make_fifo()
+def read_hashes(fp):
+    """Return the digests of one --serve hash reply from fp, and any error
 
-        spltcmd = "splitcpy \\'%s\\' -s %d,%d,%d" % (ns.path, num_slices,
-                                               slice, bytes)
-        sshcmd = "ssh -p %d %s@%s %s >%s" % (port, ns.user, ns.host, spltcmd,
-                                             fifo_path)
+    Raises EOFError if the stream ends before the end frame.
+    """
+    digests = []
+    error = None
+    while True:
+        frame = read_frame(fp)
+        if frame is None:
+            raise EOFError
+
+        type, offset, payload = frame
+        if type == FRAME_HASH:
+            digests += [payload[x:x + DIGEST_SIZE]
+                        for x in range(0, len(payload), DIGEST_SIZE)]
+        elif type == FRAME_ERROR:
+            error = payload.decode()
+        elif type == FRAME_END:
+            return digests, error
+
+
+def delta_runs(fd, offset, length, bytes, digests):
+    """Compare the local blocks of fd with the remote block digests
+
+    Returns a list of (offset, length, changed) runs, covering the range.
+    """
+    runs = []
+    end = offset + length
+    for n, pos in enumerate(range(offset, end, bytes)):
+        count = min(bytes, end - pos)
+        buf = os.pread(fd, count, pos)
+        changed = len(buf) < count or n >= len(digests) or \
+            block_digest(buf) != digests[n]
+
+        if runs and runs[-1][2] == changed:
+            runs[-1] = (runs[-1][0], runs[-1][1] + count, changed)
+        else:
+            runs.append((pos, count, changed))
 
-        if pw is not None:
-            sshcmd = "SSHPASS=%s sshpass -e %s" % (pw, sshcmd)
+    return runs
 
-        p = subprocess.Popen(sshcmd, shell=True, stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE,
-                             stdin=subprocess.PIPE
-                             )
 
-        fp = open(fifo_path, 'rb')
+def read_reply(fp, fd, length=None, codec=None):
+    """Write the data frames of one --serve reply from fp to fd
 
-        while True:
-            buf = fp.read(bytes)
+    Compressed frames are expanded with the Codec used for the request.
 
-            if not buf:
+    The data is checked against the trailer of the end frame, if there is
+    one, and against the 'length' requested.
+
+    Returns the message of an error frame or failed check, or None. Raises
+    EOFError if the stream ends before the end frame.
+    """
+    error = None
+    count, hash = 0, stripe_hash() if has_blake2b() else None
+    while True:
+        frame = read_frame(fp)
+        if frame is None:
+            raise EOFError
+
+        type, offset, payload = frame
+        if type == FRAME_COMPRESSED:
+            type, payload = FRAME_DATA, codec.decompress(payload)
+
+        if type == FRAME_DATA:
+            os.pwrite(fd, payload, offset)
+            count += len(payload)
+            if hash:
+                hash.update(payload)
+        elif type == FRAME_ERROR:
+            error = payload.decode()
+        elif type == FRAME_END:
+            if payload and hash and error is None:
+                error = check_trailer(payload, count, hash.digest())
+            if error is None and length is not None and count != length:
+                error = _("received %d bytes of %d") % (count, length)
+            return error
+
+
+def fetch_job(p, fd, job, bytes, sizer=None, counter=None, progress=None,
+              delta=None, codec=None):
+    """Request a Job over a --serve stream 'p', writing it to fd
+
+    The job is requested in pieces of up to MAX_REQUEST bytes, with the
+    next piece already in flight. With a ChunkSizer, each piece is sized
+    from the throughput measured so far.
+
+    With a 'delta' block size, the remote digests of the job's blocks are
+    fetched first, and only the blocks that differ from the current
+    contents of fd (which must be readable) are requested.
+
+    With a Codec, the data is requested compressed with it.
+
+    A shared counter Value is advanced by the bytes of each piece, and
+    progress(offset, length) is called as each piece lands (or is found
+    to be unchanged). Returns an error message, or None.
+    """
+    ranges = collections.deque([(job.offset, job.offset + job.length)])
+    pending = collections.deque()
+    error = None
+
+    if delta:
+        send_request(p.stdin, job.path, job.offset, job.length, delta, 'hash')
+        digests, error = read_hashes(p.stdout)
+        if error:
+            return error
+
+        ranges.clear()
+        for offset, length, changed in delta_runs(fd, job.offset, job.length,
+                                                  delta, digests):
+            if changed:
+                ranges.append((offset, offset + length))
+            elif progress:
+                progress(offset, length)
+
+    last = time.time()
+    while True:
+        while ranges and len(pending) < PIPELINE and error is None:
+            pos, end = ranges[0]
+            if sizer:
+                bytes = sizer.size
+                length = min(end - pos, bytes*REQUEST_CHUNKS)
+            else:
+                length = min(end - pos, bytes*max(1, MAX_REQUEST // bytes))
+
+            send_request(p.stdin, job.path, pos, length, bytes,
+                         compress=codec.name if codec else None)
+            pending.append((pos, length))
+
+            if pos + length < end:
+                ranges[0] = (pos + length, end)
+            else:
+                ranges.popleft()
+
+        if not pending:
+            return error
+
+        offset, length = pending.popleft()
+        msg = read_reply(p.stdout, fd, length, codec)
+        error = error or msg
+
+        now = time.time()
+        if sizer:
+            sizer.update(length, now - last)
+        if counter is not None:
+            counter.value += length
+        if progress and not msg:
+            progress(offset, length)
+        last = now
+
+
+def dl_stream(user, host, bytes, jobs, results, pw, port, control=None,
+              stop=None, counter=None, delta=None, compress=None,
+              limiter=None, stall=None, first=None, transport=None):
+    """Download Jobs through one persistent remote 'splitcpy --serve'
+
+    Jobs are taken from the 'jobs' queue until a None is found, starting
+    with the 'first' Job, if given. The data is written in place in each
+    job's (existing) dest, and the outcome is reported on 'results' as
+    ('done', job), ('error', job, msg), or ('failed', job, rest) if the
+    stream is lost, where 'rest' is the Job for the part not yet landed.
+    Each piece of a job is reported as ('progress', job, offset, length)
+    as it lands.
+
+    A job that gets no data for 'stall' seconds has its ssh killed, and
+    is reported as failed.
+
+    If bytes is None, the chunk size is adjusted to the measured
+    throughput of the stream.
+
+    The stream ends early, between jobs, once the 'stop' Event is set. A
+    'counter' Value tracks the bytes received.
+
+    With a 'delta' block size, only the blocks that differ from the
+    existing dest are transferred.
+
+    A 'compress' codec name has the chunks sent compressed, and they are
+    expanded by this stream's process.
+
+    A shared StartLimiter paces the start of the stream's connection.
+    """
+
+    sizer = ChunkSizer() if bytes is None else None
+    codec = make_codec(compress) if compress else None
+    p = None
+    watchdog = None
+    try:
+        if limiter:
+            limiter.wait()
+        p = remote_popen(user, host, port, pw, control, ["--serve"],
+                         transport, stdin=subprocess.PIPE,
+                         stdout=subprocess.PIPE)
+        if stall:
+            watchdog = Watchdog(p, stall)
+            p.stdout = watchdog.reader(p.stdout)
+
+        while not (stop and stop.is_set()):
+            job = first or jobs.get()
+            first = None
+            if job is None:
+                break
+
+            # the end of the part of the job that has landed so far
+            landed = [job.offset]
+
+            def progress(offset, length, job=job):
+                if offset == landed[0]:
+                    landed[0] += length
+                results.put(('progress', job, offset, length))
+
+            fd = os.open(job.dest, os.O_RDWR if delta else os.O_WRONLY)
+            try:
+                if watchdog:
+                    watchdog.arm()
+                error = fetch_job(p, fd, job, bytes, sizer, counter, progress,
+                                  delta, codec)
+            except (EOFError, IOError, OSError) as e:
+                if getattr(e, 'errno', errno.EPIPE) != errno.EPIPE:
+                    raise
+
+                rest = job._replace(offset=landed[0], length=job.offset +
+                                    job.length - landed[0])
+                results.put(('failed', job, rest))
                 break
+            finally:
+                if watchdog:
+                    watchdog.disarm()
+                os.close(fd)
 
-            queue.put(buf)
+            results.put(('error', job, error) if error else ('done', job))
     finally:
+        if watchdog:
+            watchdog.stop()
         if p and p.poll() is None:
             p.kill()
 
-        if fifo_path:
-            del_fifo(fifo_path)
 
-    queue.put(None)
+JOURNAL_SUFFIX = '.splitcpy-state'
 
 
-def dl_file(src, dest, num_slices, bytes, pw, port):
-    """Perform a parallel download of a file"""
+class Journal(object):
+    """Record of the blocks of a download that have landed
 
-    slist = []
-    Slice = namedtuple("Slice", "queue, proc")
+    It is kept next to the destination, as a line of JSON identifying the
+    source, followed by a bitmap with a bit for each 'bytes' block. The
+    source's 'mtime' is part of its identity, so that blocks of a file
+    rewritten since are not kept.
+    """
 
-    try:
-        for n in range(num_slices):
-            q = Queue(10)
-            p = Process(target=dl_slice,
-                        args=(src, num_slices, n, bytes, q, pw, port)
-            )
-            slist.append(Slice(q, p))
-            p.start()
-            time.sleep(0.025)
+    INTERVAL = 5.0
+
+    def __init__(self, dest, src, size, bytes, mtime=None):
+        self.dest = dest
+        self.path = dest + JOURNAL_SUFFIX
+        self.src = src
+        self.mtime = mtime
+        self.size = size
+        self.bytes = bytes
+        self.blocks = (size + bytes - 1) // bytes
+        self.bitmap = bytearray((self.blocks + 7) // 8)
+
+    @classmethod
+    def load(cls, dest, src, size, bytes, mtime=None):
+        """Return the saved Journal for this transfer, or None"""
+        journal = cls(dest, src, size, bytes, mtime)
+        try:
+            with open(journal.path, 'rb') as fp:
+                header = json.loads(fp.readline().decode())
+                bitmap = fp.read()
+        except (IOError, OSError, ValueError):
+            return None
+
+        if header != journal.header() or len(bitmap) != len(journal.bitmap):
+            return None
+
+        journal.bitmap = bytearray(bitmap)
+        return journal
+
+    def header(self):
+        return {'src': self.src, 'size': self.size, 'bytes': self.bytes,
+                'mtime': self.mtime}
+
+    def mark(self, offset, length):
+        """Record that the blocks within offset:offset+length have landed"""
+        end = offset + length
+        last = self.blocks if end >= self.size else end // self.bytes
+        for block in range((offset + self.bytes - 1) // self.bytes, last):
+            self.bitmap[block >> 3] |= 1 << (block & 7)
+
+    def landed(self, block):
+        return bool(self.bitmap[block >> 3] & (1 << (block & 7)))
+
+    def missing(self):
+        """Return the (offset, length) runs of blocks that haven't landed"""
+        runs = []
+        start = None
+        for block in range(self.blocks + 1):
+            if block < self.blocks and not self.landed(block):
+                if start is None:
+                    start = block
+            elif start is not None:
+                offset = start*self.bytes
+                end = min(block*self.bytes, self.size)
+                runs.append((offset, end - offset))
+                start = None
+
+        return runs
+
+    def save(self):
+        """Write the journal, after the data that it describes"""
+        if os.path.exists(self.dest):
+            fd = os.open(self.dest, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write((json.dumps(self.header()) + '\n').encode())
+            fp.write(self.bitmap)
+        os.rename(tmp, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def plan_download(path, dest, size, bytes, resume=False, delta=False,
+                  extents=None, mtime=None):
+    """Prepare dest for a pool download
+
+    Returns the Job extents to fetch, and a Journal if resuming. When an
+    earlier attempt left a journal for the same source, size and 'mtime',
+    only its missing blocks are fetched, into the existing dest.
+
+    For a delta download, an existing dest is kept, for comparison.
+
+    The (offset, length) data 'extents' of a sparse source limit the jobs
+    to those ranges, and dest is left with holes in between. They are
+    ignored for a delta download, which must overwrite the holes.
+    """
+    journal = None
+    if delta or extents is None:
+        extents, sparse = [(0, size)], False
+    else:
+        sparse = True
+
+    if resume:
+        journal = Journal.load(dest, path, size, bytes, mtime)
+        if journal and os.path.exists(dest):
+            with open(dest, 'r+b') as fp:
+                fp.truncate(size)
+
+            return [Job(path, dest, offset, length)
+                    for offset, length in journal.missing()], journal
+
+        journal = Journal(dest, path, size, bytes, mtime)
+        pos = 0
+        for offset, length in extents + [(size, 0)]:
+            journal.mark(pos, offset - pos)     # the holes never land
+            pos = offset + length
+
+    if delta and os.path.exists(dest):
+        with open(dest, 'r+b') as fp:
+            fp.truncate(size)
+    else:
+        preallocate(dest, size, sparse)
+
+    return [Job(path, dest, offset, length)
+            for offset, length in extents], journal
+
+
+class StreamGovernor(object):
+    """Grow the number of streams while the aggregate throughput rises
+
+    Starting from START streams, one more is added each INTERVAL for as
+    long as each addition raises the throughput by GAIN. An addition that
+    doesn't is retired again, and growth is retried every PROBE intervals,
+    to follow changes in the path.
+    """
+
+    START = 2
+    INTERVAL = 2.0
+    GAIN = 1.1
+    PROBE = 10
+
+    def __init__(self, maximum):
+        self.maximum = maximum
+        self.count = min(self.START, maximum)
+        self.base = None
+        self.probing = False
+        self.idle = 0
+
+    def update(self, rate, count=None):
+        """Take the last interval's rate - return +1 to add a stream, -1 to
+        retire one, or 0
+
+        'count' is the number of streams actually open, if the caller
+        couldn't follow every earlier answer, or lost some.
+        """
+        if count is not None:
+            self.count = count
+
+        if self.probing:
+            self.probing = False
+            if rate <= self.base * self.GAIN:
+                self.idle = 0
+                if self.count > 1:
+                    self.count -= 1
+                    return -1
+
+                self.base = rate
+                return 0
+        elif self.base is not None:
+            self.idle += 1
+            if self.idle < self.PROBE:
+                self.base = rate
+                return 0
+
+        self.base = rate
+        if self.count >= self.maximum:
+            return 0
+
+        self.count += 1
+        self.probing = True
+        self.idle = 0
+        return 1
+
+
+# the most streams that -n auto will open
+AUTO_MAX_STREAMS = 32
+
+
+def dl_pool(user, host, jobs, num_streams, bytes, pw, port, control=None,
+            journals=None, delta=None, compress=None, stall=None,
+            transport=None):
+    """Download Jobs over a pool of persistent streams
+
+    'jobs' may be a list, or any iterable. The jobs are fed to the streams
+    from a thread as they are produced, so the transfer can start while a
+    generator is still finding more work.
+
+    If num_streams is None, a StreamGovernor adds and retires streams as
+    the transfer runs. The remaining jobs are shared by whichever streams
+    are open.
+
+    'journals' maps dest paths to Journals, which record the progress
+    made. They are saved periodically, and removed on success.
+
+    With a 'delta' block size, only changed blocks are transferred.
+
+    A 'compress' codec name has the data sent compressed with it.
+
+    A stream that is lost, or stalls for 'stall' seconds, is replaced by a
+    new one after a backoff, which starts on the part of the job that
+    hadn't landed. The transfer fails once a job has been retried
+    RETRY_LIMIT times.
+
+    The streams are run with 'transport', over ssh by default.
+    """
+    journals = journals or {}
+
+    jobq = Queue()
+    results = Queue()
+    limiter = StartLimiter()
+    streams = []
+    Stream = namedtuple("Stream", "proc, stop, count")
+
+    governor = None
+    max_streams = num_streams or AUTO_MAX_STREAMS
+    if hasattr(jobs, '__len__'):
+        max_streams = min(max_streams, len(jobs))
+    if num_streams is None:
+        governor = StreamGovernor(max_streams)
+
+    def feed():
+        count = 0
+        try:
+            for job in jobs:
+                jobq.put(job)
+                count += 1
+        except (TransferError, IOError, OSError, ValueError) as e:
+            results.put(('error', None, str(e)))
+            return
+
+        # no stream is started twice, so this is a sentinel for every stream
+        for n in range(max_streams):
+            jobq.put(None)
+        results.put(('fed', count))
+
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+
+    def start_stream(first=None):
+        stop = Event()
+        count = Value('d', 0)
+        p = Process(target=dl_stream,
+                    args=(user, host, bytes, jobq, results, pw, port),
+                    kwargs=dict(control=control, stop=stop, counter=count,
+                                delta=delta, compress=compress,
+                                limiter=limiter, stall=stall, first=first,
+                                transport=transport)
+        )
+        streams.append(Stream(p, stop, count))
+        p.start()
 
-        with open(dest, 'wb') as dfp:
-            buf_iter = (s.queue.get() for s in itertools.cycle(slist))
-            for buf in itertools.takewhile(lambda x: x is not None, buf_iter):
-                dfp.write(buf)
+    try:
+        feeder.start()
+        for n in range(governor.count if governor else max_streams):
+            start_stream()
+
+        last, last_total = time.time(), 0
+        saved = time.time()
+        fed, done = None, 0
+        retries = {}        # by the dest and end of a job, across its rests
+        waiting = []        # (time due, rest) of the jobs of lost streams
+        while fed is None or done < fed:
+            for item in [x for x in waiting if x[0] <= time.time()]:
+                waiting.remove(item)
+                start_stream(item[1])
+
+            if journals and time.time() - saved >= Journal.INTERVAL:
+                [x.save() for x in list(journals.values())]
+                saved = time.time()
+
+            if governor and time.time() - last >= governor.INTERVAL:
+                now = time.time()
+                total = sum(x.count.value for x in streams)
+
+                # retired and lost streams don't count against the maximum
+                live = [x for x in streams
+                        if x.proc.is_alive() and not x.stop.is_set()]
+                change = governor.update((total - last_total) / (now - last),
+                                         len(live))
+                last, last_total = now, total
+
+                if change > 0:
+                    start_stream()
+                elif change < 0:
+                    live[-1].stop.set()
+
+            try:
+                status = results.get(timeout=1)
+            except Empty:
+                if not waiting and not any(x.proc.is_alive()
+                                           for x in streams):
+                    raise TransferError(_("All streams have exited"))
+                continue
+
+            if status[0] == 'progress':
+                if status[1].dest in journals:
+                    journals[status[1].dest].mark(status[2], status[3])
+                continue
+            elif status[0] == 'fed':
+                fed = status[1]
+                continue
+            elif status[0] == 'error':
+                raise TransferError(status[2])
+            elif status[0] == 'failed':
+                job, rest = status[1], status[2]
+                key = (job.dest, job.offset + job.length)
+                attempt = retries.get(key, 0)
+                if attempt >= RETRY_LIMIT:
+                    raise TransferError(_("Lost the stream for %s") %
+                                        job.path)
+
+                retries[key] = attempt + 1
+                if rest.length:
+                    waiting.append((time.time() + retry_delay(attempt), rest))
+                    continue
+
+            done += 1
     finally:
-        [s.proc.terminate() for s in slist if s.proc.is_alive()]
+        [x.proc.terminate() for x in streams if x.proc.is_alive()]
+        [x.save() for x in list(journals.values())]
 
-    [s.proc.join() for s in slist]
+    [x.proc.join() for x in streams]
+    [x.remove() for x in list(journals.values())]
 
 
 class CredException(Exception):
     pass
 
 
+class TransferError(Exception):
+    pass
+
+
+class StreamError(TransferError):
+    """A slice's ssh connection failed, after 'count' bytes arrived"""
+
+    def __init__(self, msg, count):
+        TransferError.__init__(self, msg)
+        self.count = count
+
+
+class StreamRerolled(StreamError):
+    """A slow slice's connection was closed, to be opened again"""
+    pass
+
+
 def quote_path(file):
     for char in '#;&"\',?$ *[]':
         file = re.sub("\\" + char, "\\" + char, file)
@@ -200,12 +2118,20 @@ def quote_path(file):
 
     return file
 
-def establish_ssh_cred(user, host, port, pathlist):
-    """Make a test ssh connection to determine the password, if needed"""
+def establish_ssh_cred(user, host, port, pathlist, control=None):
+    """Make a test ssh connection to determine the password, if needed
+
+    If a control socket path is given, the connection is left running in
+    the background as a ControlMaster on that socket.
+    """
 
     quotedlist = [quote_path(x) for x in pathlist]
     remote_cmd = "splitcpy -f " + " ".join(quotedlist)
-    cmd = "ssh -p %d %s@%s " % (port, user, host)
+    cmd = "ssh -p %d " % port
+    if control:
+        cmd += "-o ControlMaster=yes -o ControlPersist=yes "
+        cmd += "-o ControlPath=%s " % control
+    cmd += "%s@%s " % (user, host)
     cmd += remote_cmd
     password = None
 
@@ -239,24 +2165,163 @@ def establish_ssh_cred(user, host, port, pathlist):
             raise CredException
 
 
+# optional capabilities of this splitcpy, when acting as the remote
+FEATURES = ['range', 'serve', 'compress', 'upload'] + \
+    (['delta', 'verify'] if has_blake2b() else []) + \
+    (['walk'] if hasattr(os, 'scandir') else [])
+
+
+# holes smaller than this are sent as data, to keep the extent list short
+MIN_HOLE = 1024*1024
+
+
+def data_extents(path, min_hole=MIN_HOLE):
+    """Return the [offset, length] data extents of a sparse file
+
+    Returns None for a file without holes, or if the platform can't find
+    them with SEEK_DATA/SEEK_HOLE.
+    """
+    st = os.stat(path)
+    if not hasattr(os, 'SEEK_DATA') or \
+            getattr(st, 'st_blocks', st.st_size) * 512 >= st.st_size:
+        return None
+
+    extents = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        pos = 0
+        while pos < st.st_size:
+            try:
+                start = os.lseek(fd, pos, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO:      # only a hole remains
+                    break
+                return None
+
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            if extents and start - sum(extents[-1]) < min_hole:
+                extents[-1][1] = end - extents[-1][0]
+            else:
+                extents.append([start, end - start])
+            pos = end
+    finally:
+        os.close(fd)
+
+    return extents
+
+
 def eval_files(flist):
     info = {
                 'version': __version__,     # flake8: noqa
+                'features': FEATURES,
+                'codecs': available_codecs(),
                 'entries': [],
            }
 
     for spec in flist:
         for entry in glob.glob(spec):
-            type = 'f'
-            if os.path.isdir(entry):
-                type = 'd'
+            info['entries'].append(file_entry(entry))
+
+    return info
 
-            readable = os.access(entry, os.R_OK)
-            writeable = os.access(entry, os.W_OK)
 
-            info['entries'].append([type, readable, writeable, entry])
+def file_entry(path, name=None):
+    """Return the [type, readable, writeable, path, size, extents, name,
+    mtime] of path"""
+    type = 'f'
+    if os.path.isdir(path):
+        type = 'd'
 
-    return info
+    readable = os.access(path, os.R_OK)
+    writeable = os.access(path, os.W_OK)
+    size = os.path.getsize(path) if type == 'f' else 0
+    extents = data_extents(path) if type == 'f' and readable else None
+    mtime = os.path.getmtime(path) if os.path.exists(path) else None
+
+    return [type, readable, writeable, path, size, extents, name, mtime]
+
+
+# seconds between flushes of the --walk output
+WALK_FLUSH = 0.1
+
+
+def walk_files(flist, out):
+    """Write an entry line for every file and directory under flist
+
+    Each line is the JSON file_entry() of a path, with its name relative
+    to the parent of the top level match. A directory comes
+    before its contents. The output is flushed as the walk goes, so that
+    the reader can start on the first entries right away.
+    """
+    flushed = [time.time()]
+
+    def emit(path, base):
+        entry = file_entry(path, os.path.relpath(path, base or os.curdir))
+        out.write((json.dumps(entry) + '\n').encode())
+        if time.time() - flushed[0] >= WALK_FLUSH:
+            out.flush()
+            flushed[0] = time.time()
+
+    for spec in flist:
+        for top in glob.glob(spec):
+            base = os.path.dirname(os.path.normpath(top))
+            emit(top, base)
+
+            dirs = [top] if os.path.isdir(top) else []
+            while dirs:
+                try:
+                    found = os.scandir(dirs.pop())
+                except OSError:         # unreadable - skipped
+                    continue
+
+                for item in found:
+                    if item.is_dir(follow_symlinks=False):
+                        emit(item.path, base)
+                        dirs.append(item.path)
+                    elif item.is_file():
+                        emit(item.path, base)
+
+    out.flush()
+
+
+def walk_remote(user, host, port, pw, control, paths, transport=None):
+    """Start a remote 'splitcpy --walk', returning a generator of its
+    entries, as they arrive
+
+    The process is started here, rather than on first use, because the
+    generator is run in dl_pool()'s feeder thread, while the streams are
+    being forked. A Popen from that thread would wait on its exec status
+    pipe, which a forked stream may be holding open.
+    """
+    with open(os.devnull, 'r') as devnull:
+        p = remote_popen(user, host, port, pw, control, ["--walk"] + paths,
+                         transport, stdin=devnull, stdout=subprocess.PIPE)
+
+    def entries():
+        try:
+            for line in iter(p.stdout.readline, b''):
+                try:
+                    entry = json.loads(line.decode())
+                except ValueError:
+                    raise TransferError(_("Bad remote listing entry: %r") %
+                                        line)
+                yield entry
+
+            if p.wait():
+                raise TransferError(_("Listing the remote files failed"))
+        finally:
+            if p.poll() is None:
+                p.kill()
+
+    return entries()
+
+
+def auto_int(value):
+    """argparse type for an integer, or None for 'auto'"""
+    if value == 'auto':
+        return None
+
+    return int(value)
 
 
 def parse_args(args):
@@ -264,10 +2329,14 @@ def parse_args(args):
     parser = argparse.ArgumentParser(
                 usage="%(prog)s -h\n"
                       "       %(prog)s [options] [user@]host:path [path]\n"
-                      "       %(prog)s [options] [user@]host:path [...] [dir]",
+                      "       %(prog)s [options] [user@]host:path [...] "
+                      "[dir]\n"
+                      "       %(prog)s [options] path [...] [user@]host:path",
                 description=
-                      _('Copy a remote file using multiple SSH streams.'),
-                epilog=_("The source file is remote. "
+                      _('Copy a file to or from a remote host, using '
+                        'multiple SSH streams.'),
+                epilog=_("Either the source files or the destination are "
+                       "remote. "
                        "Remote files are specified as e.g. [user@]host:path. "
                        "'splitcpy' must be installed on both the local and "
                        "remote hosts."),
@@ -294,9 +2363,24 @@ def parse_args(args):
 
     parser.add_argument(
         '-s',
-        metavar='n,i,l',
+        metavar='n,i,l[,o,c]',
         help=_("(internal use only) Generate file interleave of 'l' "
-               "bytes for the 'i'th slice out of 'n'"),
+               "bytes for the 'i'th slice out of 'n', optionally over "
+               "the 'c' bytes starting at offset 'o'"),
+        )
+
+    parser.add_argument(
+        '--trailer',
+        action='store_true',
+        help=_("(internal use only) Follow the -s interleave with its byte "
+               "count and checksum, or expect them after the -w interleave"),
+        )
+
+    parser.add_argument(
+        '-w',
+        metavar='n,i,l,z',
+        help=_("(internal use only) Write the 'i'th interleave slice out of "
+               "'n', of 'l' byte chunks, from stdin into a 'z' byte file"),
         )
 
     parser.add_argument(
@@ -305,6 +2389,26 @@ def parse_args(args):
         help=_("(internal use only) Output far-side wildcard information"),
         )
 
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help=_("(internal use only) Serve block requests from stdin"),
+        )
+
+    parser.add_argument(
+        '--walk',
+        action='store_true',
+        help=_("(internal use only) List the files under the paths, as "
+               "lines of JSON"),
+        )
+
+    parser.add_argument(
+        '-r',
+        dest='recursive',
+        action='store_true',
+        help=_("copy directories, and everything under them"),
+        )
+
     parser.add_argument(
         '-p',
         metavar='port',
@@ -314,43 +2418,179 @@ def parse_args(args):
         help=_('ssh port to use (if not the default)'),
         )
 
+    parser.add_argument(
+        '-M',
+        dest='multiplex',
+        action='store_true',
+        help=_('run all slices as channels of one shared ssh connection'),
+        )
+
+    parser.add_argument(
+        '-P',
+        dest='persistent',
+        action='store_true',
+        help=_('keep the slice streams open for all files being copied'),
+        )
+
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help=_("journal the progress of each download, and resume an "
+               "interrupted one from its journal"),
+        )
+
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help=_("check each slice against a byte count and checksum sent "
+               "after it, at the cost of sendfile()"),
+        )
+
+    parser.add_argument(
+        '--delta',
+        action='store_true',
+        help=_("only copy the blocks that differ from an existing "
+               "destination file"),
+        )
+
+    parser.add_argument(
+        '--compress',
+        choices=['none', 'auto'] + CODECS,
+        default='none',
+        help=_("compress the data in transit, with the first codec "
+               "installed at both ends for 'auto' (default=none)"),
+        )
+
     parser.add_argument(
         '-n',
         metavar='num',
         dest='num_slices',
-        type=int,
+        type=auto_int,
         default=10,
-        help=_('number of parallel slices to run (default=10)'),
+        help=_("number of parallel slices to run, or 'auto' to adapt it to "
+               "the measured throughput (default=10)"),
         )
 
     parser.add_argument(
         '-b',
         metavar='bytes',
         dest='slice_size',
-        type=int,
+        type=auto_int,
         default=10000,
-        help=_("chunk size for slices (default=10,000)"),
+        help=_("chunk size for slices, or 'auto' to adapt it to the "
+               "measured throughput (default=10,000)"),
+        )
+
+    parser.add_argument(
+        '--shm',
+        action='store_true',
+        help=_("receive slices into shared memory buffers"),
+        )
+
+    parser.add_argument(
+        '--direct',
+        action='store_true',
+        help=_("write each slice directly into the destination file"),
+        )
+
+    parser.add_argument(
+        '--layout',
+        choices=['interleave', 'range'],
+        default='interleave',
+        help=_("interleave chunks across slices, or give each slice one "
+               "contiguous range (default=interleave)"),
+        )
+
+    parser.add_argument(
+        '--stall',
+        metavar='secs',
+        type=float,
+        default=STALL_TIMEOUT,
+        help=_("restart a stream that has received nothing for this long, "
+               "or 0 to wait forever (default=60)"),
+        )
+
+    parser.add_argument(
+        '--engine',
+        choices=['process', 'async'],
+        default='process',
+        help=_("run each slice in its own process, or read all of them "
+               "from one asyncio event loop (default=process)"),
+        )
+
+    parser.add_argument(
+        '--transport',
+        choices=sorted(TRANSPORTS),
+        default='ssh',
+        help=_("run the remote splitcpy over ssh, or, for testing, "
+               "locally in a subprocess or in this process (default=ssh)"),
         )
 
     args = parser.parse_args(args)
 
-    msg = validate_args(args)
+    msg = validate_args(args, parser.parse_args([]))
     if msg:
         parser.error(msg)
 
     return(args)
 
 
-def validate_args(args):
+# the options, by dest, that an upload can be given
+UPLOAD_OPTIONS = [
+    ('num_slices', '-n'),
+    ('slice_size', '-b'),
+    ('port', '-p'),
+    ('multiplex', '-M'),
+    ('verify', '--verify'),
+    ('transport', '--transport'),
+]
+
+
+def validate_upload(args, defaults):
+    """validate_args() for a copy of local files to a remote destination
+
+    Any option not in UPLOAD_OPTIONS must be left at its value in the
+    'defaults' args.
+    """
+    args.rawsrcs, args.rawdest = args.fileargs[:-1], args.fileargs[-1]
+
+    if not args.rawsrcs or not is_net_spec(args.rawdest) or \
+            any(is_net_spec(x) for x in args.rawsrcs):
+        return _("Either the sources or the destination must be remote")
+
+    for src in args.rawsrcs:
+        if not os.path.isfile(src):
+            return _("'%s' is not a local file") % src
+
+    allowed = dict(UPLOAD_OPTIONS)
+    if args.slice_size is None or args.num_slices is None or \
+            any(getattr(args, x) != y for x, y in vars(defaults).items()
+                if x not in allowed and x != 'fileargs'):
+        return _("Uploads only support the %s options, and not 'auto'") % \
+            ", ".join(x[1] for x in UPLOAD_OPTIONS)
+
+    return None
+
+
+def validate_args(args, defaults=None):
 
     if args.s:
         try:
             params = args.s.split(',')
-            assert(len(params) == 3)
+            assert(len(params) in (3, 5))
 
             setattr(args, 'num_slices', int(params[0]))
             setattr(args, 'slice', int(params[1]))
             setattr(args, 'bytes', int(params[2]))
+            setattr(args, 'offset', 0)
+            setattr(args, 'length', None)
+
+            if len(params) == 5:
+                setattr(args, 'offset', int(params[3]))
+                setattr(args, 'length', int(params[4]))
+
+                assert(args.offset >= 0)
+                assert(args.length >= 0)
 
             assert(args.bytes > 0)
             assert(args.slice >= 0)
@@ -359,15 +2599,80 @@ def validate_args(args):
         except (IndexError, ValueError, AssertionError):
             return _("Invalid interleave argument")
 
-    elif args.f:
+    elif args.w:
+        try:
+            params = [int(x) for x in args.w.split(',')]
+            assert(len(params) == 4)
+
+            args.num_slices, args.slice, args.bytes, args.size = params
+
+            assert(args.bytes > 0)
+            assert(args.size >= 0)
+            assert(0 <= args.slice < args.num_slices)
+        except (ValueError, AssertionError):
+            return _("Invalid interleave argument")
+
+        if len(args.fileargs) != 1:
+            return _("No files specified")
+
+    elif args.f or args.serve or args.walk:
         pass
 
     else:
         if len(args.fileargs) == 0:
             return _("No files specified")
 
-        if not is_net_spec(args.fileargs[0]):
-            return _("Currently only supports download copying")
+        args.upload = not is_net_spec(args.fileargs[0])
+        if args.upload:
+            return validate_upload(args, defaults)
+
+        if args.layout == 'range':
+            args.direct = True      # ranges are only written positionally
+
+        if args.shm and shared_memory is None:
+            return _("Shared memory receive requires Python 3.8 or later")
+
+        if args.direct and not hasattr(os, 'pwrite'):
+            return _("Direct writes are not supported on this platform")
+
+        if args.shm and args.direct:
+            return _("--shm and --direct cannot be used together")
+
+        if args.slice_size is None or args.num_slices is None or \
+                args.resume or args.delta:
+            args.persistent = True      # only persistent streams adapt
+
+        if args.compress != 'none':
+            args.persistent = True      # only --serve frames are compressed
+
+            if args.compress != 'auto' and \
+                    args.compress not in available_codecs():
+                return _("The '%s' module is not installed") % \
+                    {'zstd': 'zstandard', 'lz4': 'lz4'}[args.compress]
+
+        if args.delta and not has_blake2b():
+            return _("Delta copies require Python 3.6 or later")
+
+        if args.verify and not has_blake2b():
+            return _("Verified copies require Python 3.6 or later")
+
+        if args.persistent and args.shm:
+            return _("-P and --shm cannot be used together")
+
+        if args.persistent and args.direct:
+            return _("--direct and --layout range cannot be used with "
+                     "persistent streams")
+
+        if args.engine == 'async':
+            if sys.version_info < (3, 5):
+                return _("The async engine requires Python 3.5 or later")
+
+            if args.shm or args.persistent:
+                return _("The async engine does not support --shm, or "
+                         "persistent streams")
+
+            if args.transport == 'inproc':
+                return _("The async engine needs a subprocess transport")
 
         proclist = list(args.fileargs)
         args.rawsrcs = []
@@ -391,29 +2696,120 @@ def validate_args(args):
     return None
 
 
-def main(args=sys.argv[1:]):
-    args = parse_args(args)
+def tree_dest(dest, name, into_dir):
+    """Return the local path for the relative 'name' of a -r entry
 
-    if args.s:                      # download - remote side
-        outfp = sys.stdout
-        if sys.version_info >= (3, 0):
-            outfp = sys.stdout.buffer
+    The tree goes under dest if it is an existing directory, or else
+    becomes dest, as with 'cp -r'.
+
+    The name comes from the remote, so a TransferError is raised for one
+    that is empty, absolute or has a '..' component, rather than write
+    outside of dest.
+    """
+    parts = name.split(os.sep)
+    if not name or os.path.isabs(name) or os.pardir in parts:
+        raise TransferError(_("Unsafe remote path name: %r") % name)
+
+    if into_dir:
+        path = os.path.join(dest, name)
+    else:
+        parts = name.split(os.sep, 1)
+        path = os.path.join(dest, parts[1]) if len(parts) > 1 else dest
+
+    rel = os.path.relpath(os.path.normpath(path), os.path.normpath(dest))
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        raise TransferError(_("Unsafe remote path name: %r") % name)
 
+    return path
+
+
+def upload(args, ns, password, control, remote_info, transport=None):
+    """Copy the local args.rawsrcs to the remote destination 'ns'"""
+    features = remote_info.get('features', [])
+    if 'upload' not in features:
+        print(_("Remote splitcpy does not support uploads"))
+        sys.exit(1)
+
+    entries = remote_info['entries']
+    is_dir = bool(entries) and entries[0][0] == 'd'
+    if len(args.rawsrcs) > 1 and not is_dir:
+        print(_("The remote destination must be a directory"))
+        sys.exit(1)
+
+    for src in args.rawsrcs:
+        dest = ns.path
+        if is_dir:
+            dest = os.path.join(dest, os.path.basename(src))
+
+        ul_file(src, make_net_spec(ns.user, ns.host, dest), args.num_slices,
+                args.slice_size, password, args.port, control=control,
+                verify=args.verify, transport=transport)
+
+
+def is_remote(args):
+    """Are the parsed args for the remote side of a transfer?"""
+    return bool(args.s or args.w or args.f or args.serve or args.walk)
+
+
+def run_remote(args, infp, outfp, errfp):
+    """Run the remote side of a transfer, for the parsed args
+
+    The streams are binary files, standing in for stdin, stdout and
+    stderr.
+    """
+    if args.s:                      # download - remote side
         output_split(args.fileargs[0], args.num_slices, args.slice, args.bytes,
-                     outfp)
+                     outfp, args.offset, args.length, args.trailer)
+
+    elif args.w:                    # upload - remote side
+        try:
+            input_split(args.fileargs[0], args.num_slices, args.slice,
+                        args.bytes, args.size, infp, args.trailer)
+        except TransferError as e:
+            errfp.write(("%s\n" % e).encode())
+            errfp.flush()
+            sys.exit(1)
 
     elif args.f:                    # establish password, remote side
         info = eval_files(args.fileargs)
 
-        print(json.dumps(info, indent=2, separators=(',',':')))
+        outfp.write((json.dumps(info, indent=2, separators=(',', ':')) +
+                     "\n").encode())
+        outfp.flush()
+
+    elif args.serve:                # persistent download - remote side
+        serve_requests(infp, outfp)
+
+    elif args.walk:                 # recursive listing - remote side
+        walk_files(args.fileargs, outfp)
+
+
+def main(args=sys.argv[1:]):
+    args = parse_args(args)
+
+    if is_remote(args):
+        infp, outfp, errfp = sys.stdin.buffer, sys.stdout.buffer, \
+            sys.stderr.buffer
+
+        run_remote(args, infp, outfp, errfp)
+
+    else:                           # local side
+        transport = TRANSPORTS[args.transport]
+
+        ns = parse_net_spec(args.rawdest if args.upload else args.rawsrcs[0])
+        control = None
+        if args.multiplex and transport.multiplex:
+            control = make_control()
 
-    else:                           # download - local side
         try:
-            ns = parse_net_spec(args.rawsrcs[0])
-            localized_srcs = [parse_net_spec(x).path for x in args.rawsrcs]
-            password, remote_info = establish_ssh_cred(ns.user, ns.host,
-                                                       args.port,
-                                                       localized_srcs)
+            if args.upload:
+                remote_paths = [ns.path]
+            else:
+                remote_paths = [parse_net_spec(x).path for x in args.rawsrcs]
+            password, remote_info = transport.establish(ns.user, ns.host,
+                                                        args.port,
+                                                        remote_paths,
+                                                        control=control)
 
             remote_ver = remote_info['version']
             if LooseVersion(remote_ver) < LooseVersion(__VER_DL_MIN__):
@@ -424,21 +2820,135 @@ def main(args=sys.argv[1:]):
                 print(_("Remote splitcpy is too new - upgrade local copy"))
                 sys.exit(1)
 
-            for src in remote_info['entries']:
-                srcfile = src[3]
-                path = parse_net_spec(srcfile).path
+            features = remote_info.get('features', [])
+            if args.layout == 'range' and 'range' not in features:
+                print(_("Remote splitcpy does not support the range layout"))
+                sys.exit(1)
+
+            if args.persistent and 'serve' not in features:
+                print(_("Remote splitcpy does not support persistent streams"))
+                sys.exit(1)
+
+            if args.delta and 'delta' not in features:
+                print(_("Remote splitcpy does not support delta copies"))
+                sys.exit(1)
+
+            if args.verify and 'verify' not in features:
+                print(_("Remote splitcpy does not support verified copies"))
+                sys.exit(1)
+
+            if args.upload:
+                upload(args, ns, password, control, remote_info, transport)
+                return
 
-                dest = args.rawdest
-                if os.path.isdir(dest):
-                    dest = os.path.join(dest, os.path.basename(path))
+            compress = pick_codec(args.compress,
+                                  remote_info.get('codecs', []))
+            if args.compress not in ('none', 'auto') and not compress:
+                print(_("Remote splitcpy does not support %s compression") %
+                      args.compress)
+                sys.exit(1)
 
-                srcspec = make_net_spec(ns.user, ns.host, path)
-                dl_file(srcspec, dest, args.num_slices,
-                      args.slice_size, password, args.port)
+            entries = remote_info['entries']
+            if args.recursive:
+                if 'walk' not in features:
+                    print(_("Remote splitcpy does not support -r"))
+                    sys.exit(1)
+
+                entries = walk_remote(ns.user, ns.host, args.port, password,
+                                      control, remote_paths,
+                                      transport=transport)
+
+            # share one pool of streams between all of the files, if we can,
+            # and if no option of the per-file slices was asked for
+            classic = args.shm or args.direct or args.verify or \
+                args.engine == 'async'
+            persistent = args.persistent or \
+                ((args.recursive or len(entries) > 1) and
+                 'serve' in features and not classic)
+
+            # a tree is copied into a new dest, or under an existing one
+            into_dir = os.path.isdir(args.rawdest)
+
+            block = args.slice_size or ChunkSizer.START
+            num_streams = args.num_slices or AUTO_MAX_STREAMS
+            stall = args.stall or None
+            journals = {}
+
+            def plan():
+                """Yield the extents to fetch with the pool, for each file"""
+                for src in entries:
+                    srcfile = src[3]
+                    size = src[4] if len(src) > 4 else None
+                    data = src[5] if len(src) > 5 else None
+                    mtime = src[7] if len(src) > 7 else None
+                    path = parse_net_spec(srcfile).path
+
+                    dest = args.rawdest
+                    if args.recursive and len(src) > 6 and src[6]:
+                        dest = tree_dest(dest, src[6], into_dir)
+                    elif os.path.isdir(dest):
+                        dest = os.path.join(dest, os.path.basename(path))
+
+                    if src[0] == 'd':
+                        if args.recursive:
+                            if not os.path.isdir(dest):
+                                os.makedirs(dest)
+                        else:
+                            print(_("Skipping directory %s") % path)
+                        continue
+
+                    # a sparse file is only written where it has data
+                    if persistent or (data is not None and not classic):
+                        todo, journal = plan_download(path, dest, size,
+                                                      block, args.resume,
+                                                      args.delta, data, mtime)
+                        if journal:
+                            journals[dest] = journal
+                        yield todo
+                        continue
+
+                    srcspec = make_net_spec(ns.user, ns.host, path)
+                    verify = args.verify and size is not None
+                    if args.engine == 'async':
+                        from . import aio
+                        aio.dl_file(srcspec, dest, args.num_slices,
+                                    args.slice_size, password, args.port,
+                                    size=size, layout=args.layout,
+                                    control=control, verify=verify,
+                                    stall=stall, transport=transport)
+                        continue
+
+                    dl_file(srcspec, dest, args.num_slices,
+                          args.slice_size, password, args.port, shm=args.shm,
+                          direct=args.direct, size=size, layout=args.layout,
+                          control=control, verify=verify, stall=stall,
+                          transport=transport)
+
+            if args.recursive and persistent:
+                # start on the first files while the walk goes on
+                jobs = (job for todo in plan()
+                        for job in schedule_jobs(todo, num_streams, block))
+            else:
+                jobs = schedule_jobs([x for todo in plan() for x in todo],
+                                     num_streams, block)
+
+            if args.recursive and persistent or jobs:
+                dl_pool(ns.user, ns.host, jobs, args.num_slices,
+                        args.slice_size, password, args.port, control=control,
+                        journals=journals, delta=block if args.delta else None,
+                        compress=compress, stall=stall, transport=transport)
+            else:
+                [x.remove() for x in journals.values()]
 
         except CredException:
             print(_("Error establishing contact with remote splitcpy"))
             sys.exit(-1)
+        except TransferError as e:
+            print(_("Transfer failed: %s") % e)
+            sys.exit(1)
+        finally:
+            if control:
+                transport.close(ns.user, ns.host, args.port, control)
 
 
 if __name__ == '__main__':
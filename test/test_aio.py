@@ -0,0 +1,143 @@
+from mock import patch
+import pytest
+import sys
+import os
+
+import splitcpy
+
+aio = pytest.importorskip('splitcpy.aio')
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def local_argv(user, host, port, pw, control, args, transport=None):
+    """Run the 'remote' splitcpy locally, without ssh"""
+    argv = [sys.executable, '-c',
+            'import sys; from splitcpy import main; main(sys.argv[1:])']
+    return argv + args, dict(os.environ, PYTHONPATH=root)
+
+
+@pytest.fixture
+def testfile(tmpdir):
+    path = os.path.join(str(tmpdir), 'src')
+    with open(path, 'wb') as fp:
+        fp.write(os.urandom(100000))
+
+    return path
+
+
+@pytest.mark.parametrize("layout", ['interleave', 'range'])
+@pytest.mark.parametrize("verify", [False, True])
+@patch('splitcpy.aio.remote_argv', side_effect=local_argv)
+def test_aio_dl_file(argv, testfile, tmpdir, layout, verify):
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    aio.dl_file('user@host:' + testfile, dest, 3, 4096, None, 22,
+                size=100000, layout=layout, verify=verify)
+
+    assert argv.call_count == 3
+    assert ('--trailer' in argv.call_args[0][5]) == verify
+    with open(testfile, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+
+@pytest.mark.parametrize("verify", [False, True])
+@patch('splitcpy.aio.remote_argv', side_effect=local_argv)
+def test_aio_failed_slice(argv, tmpdir, verify):
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    with pytest.raises(splitcpy.TransferError):
+        aio.dl_file('user@host:/nonexistent', dest, 3, 4096, None, 22,
+                    size=100000, verify=verify)
+
+
+def test_remote_argv():
+    argv, env = splitcpy.remote_argv('user', 'host', 22, 'pw', None,
+                                     ["a file", '-s', '1,0,10'])
+
+    assert argv[:2] == ['sshpass', '-e']
+    assert argv[-4:] == ['splitcpy', "'a file'", '-s', '1,0,10']
+    assert env['SSHPASS'] == 'pw'
+
+    argv, env = splitcpy.remote_argv('user', 'host', 22, 'pw', '/tmp/ctl',
+                                     [])
+    assert argv[0] == 'ssh'
+    assert 'ControlPath=/tmp/ctl' in argv
+    assert env is None
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve', 'verify'],
+                            'entries': [['f', True, True, 'f1', 100],
+                                        ['f', True, True, 'f2', 100]]}))
+@patch('splitcpy.splitcpy.dl_pool')
+@patch('splitcpy.splitcpy.dl_file')
+@patch('splitcpy.aio.dl_file')
+def test_main_async(aio_dl_file, dl_file, dl_pool, cred, tmpdir):
+    cmd = "--engine async --verify -n 64 -b 20 user@host:remotefile " + \
+        str(tmpdir)
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert not dl_file.called
+    assert not dl_pool.called
+    assert aio_dl_file.call_count == 2
+    aio_dl_file.assert_called_with('user@host:f2', os.path.join(str(tmpdir),
+                                                                'f2'),
+                                   64, 20, None, 22, size=100,
+                                   layout='interleave', control=None,
+                                   verify=True, stall=60.0,
+                                   transport=splitcpy.TRANSPORTS['ssh'])
+
+
+@pytest.mark.parametrize("cmd", ["--shm", "-P", "-n auto"])
+@patch('splitcpy.splitcpy.sys.exit')
+def test_parse_async_conflicts(exit_mock, cmd):
+    splitcpy.splitcpy.parse_args(("--engine async %s h:f1" % cmd).split())
+
+    assert exit_mock.called
+
+
+@pytest.mark.parametrize("verify", [False, True])
+@patch('splitcpy.aio.retry_delay', return_value=0)
+@patch('splitcpy.aio.remote_argv')
+def test_aio_resume(argv, delay, testfile, tmpdir, verify):
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    # every slice's first connection is lost part way
+    def lossy(*args):
+        cmd, env = local_argv(*args)
+        if argv.call_count <= 3:
+            cmd = ['sh', '-c', '"$@" | head -c 5000; exit 255', 'sh'] + cmd
+        return cmd, env
+    argv.side_effect = lossy
+
+    aio.dl_file('user@host:' + testfile, dest, 3, 4096, None, 22,
+                size=100000, verify=verify)
+
+    assert argv.call_count == 6
+    assert len(argv.call_args[0][5][2].split(',')) == 5
+    with open(testfile, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+
+@patch('splitcpy.aio.retry_delay', return_value=0)
+@patch('splitcpy.aio.remote_argv')
+def test_aio_stall(argv, delay, testfile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    # the first slice to start hangs part way
+    def stalling(*args):
+        cmd, env = local_argv(*args)
+        if argv.call_count == 1:
+            cmd = ['sh', '-c', '"$@" | head -c 5000; exec sleep 30',
+                   'sh'] + cmd
+        return cmd, env
+    argv.side_effect = stalling
+
+    aio.dl_file('user@host:' + testfile, dest, 3, 4096, None, 22,
+                size=100000, stall=2)
+
+    assert argv.call_count == 4
+    with open(testfile, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
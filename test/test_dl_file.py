@@ -4,6 +4,11 @@ from mock import patch, Mock
 import pytest
 import tempfile
 import os
+import sys
+import fcntl
+import subprocess
+import threading
+import time
 
 import splitcpy
 
@@ -30,32 +35,591 @@ def testfile(request):
 @patch('splitcpy.splitcpy.Process', return_value=Mock())
 def test_dl_file(process, queue, testfile):
 
-    queue0 = Mock()
-    queue0.get.return_value = bytearray([0x01])
-    queue1 = Mock()
-    queue1.get.return_value = None
-    splitcpy.splitcpy.Queue.side_effect = [queue0, queue1]
+    # slice 1 finishes first, and slice 0 sends its chunks out of order
+    queue.return_value.get.side_effect = [
+        (1, 1, b'b'), (1, 3, b'd'), None,
+        (0, 2, b'c'), (0, 0, b'a'), None,
+    ]
 
     splitcpy.dl_file('src', testfile, 2, 1, None, 22)
 
+    with open(testfile, 'rb') as fp:
+        assert fp.read() == b'abcd'
+
+
+@patch('splitcpy.splitcpy.Queue')
+@patch('splitcpy.splitcpy.Process')
+def test_dl_file_dead_slice(process, queue, testfile):
+
+    queue.return_value.get.side_effect = [None, splitcpy.splitcpy.Empty]
+    process.return_value.is_alive.return_value = False
+
+    with pytest.raises(splitcpy.TransferError):
+        splitcpy.dl_file('src', testfile, 2, 1, None, 22)
+
+
+@patch('splitcpy.splitcpy.del_ring')
+@patch('splitcpy.splitcpy.make_ring')
+@patch('splitcpy.splitcpy.Queue')
+@patch('splitcpy.splitcpy.Process')
+def test_dl_file_error_rings(process, queue, make_ring, del_ring, testfile):
+
+    queue.return_value.get.side_effect = [(0, None, "boom")]
+
+    with pytest.raises(splitcpy.TransferError):
+        splitcpy.dl_file('src', testfile, 2, 1, None, 22, shm=True)
+
+    assert process.return_value.join.call_count == 2
+    assert del_ring.call_count == 2
+
 
 @patch('splitcpy.splitcpy.subprocess.Popen')
-@patch('splitcpy.splitcpy.make_fifo')
-@patch('splitcpy.splitcpy.del_fifo')
-def test_dl_slice(del_fifo, mkfifo, process, testfile):
+def test_dl_slice(process, testfile):
 
-    processmock = Mock()
+    processmock = Mock(**{'wait.return_value': 0})
     processmock.poll.return_value = None
+    processmock.stdout = open(testfile, 'rb')
     process.return_value = processmock
 
-    mkfifo.return_value = testfile
-
     queue = Mock()
 
     splitcpy.dl_slice('user@host:file', 2, 0, 1, queue, 'shhh', 22)
+    processmock.stdout.close()
 
     assert processmock.poll.called
     assert queue.put.call_count == filesize + 1
     assert processmock.kill.called
-    assert mkfifo.call_count == 1
-    assert del_fifo.call_count == 1
+
+    argv = process.call_args[0][0]
+    assert argv[:2] == ['sshpass', '-e']
+    assert argv[-3:] == ["file", '-s', '2,0,1']
+    assert process.call_args[1]['env']['SSHPASS'] == 'shhh'
+    assert 'shell' not in process.call_args[1]
+
+
+@pytest.mark.skipif(splitcpy.splitcpy.shared_memory is None,
+                    reason="requires multiprocessing.shared_memory")
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_dl_slice_ring(process, testfile):
+
+    process.return_value = Mock(**{'wait.return_value': 0})
+    process.return_value.stdout = open(testfile, 'rb')
+
+    queue = Mock()
+    ring = splitcpy.make_ring(16, slots=filesize // 16 + 1)
+
+    try:
+        splitcpy.dl_slice('user@host:file', 2, 0, 16, queue, None, 22, ring)
+
+        msgs = [x[0][0] for x in queue.put.call_args_list]
+        assert msgs[-1] is None
+        assert len(msgs) == filesize // 16 + 1
+
+        data = bytearray()
+        for n, (slice, offset, (slot, count)) in enumerate(msgs[:-1]):
+            assert slice == 0
+            assert offset == n * 32
+
+            view = splitcpy.ring_view(ring, slot, count)
+            data += view
+            view.release()
+
+        assert data == bytearray(range(filesize))
+    finally:
+        splitcpy.del_ring(ring)
+
+
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_dl_slice_direct(process, testfile, tmpdir):
+
+    process.return_value = Mock(**{'wait.return_value': 0})
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, filesize)
+
+    for slice in range(2):
+        (fd, path) = tempfile.mkstemp()
+        os.close(fd)
+        with open(path, 'wb') as fp:
+            with open(testfile, 'rb') as src:
+                for buf in splitcpy.slice_iter(src, 2, slice, 16):
+                    fp.write(buf)
+        process.return_value.stdout = open(path, 'rb')
+
+        queue = Mock()
+        splitcpy.dl_slice('user@host:file', 2, slice, 16, queue, None, 22,
+                          dest=dest)
+        process.return_value.stdout.close()
+        os.unlink(path)
+
+        queue.put.assert_called_once_with(None)
+
+    with open(dest, 'rb') as fp:
+        assert fp.read() == bytearray(range(filesize))
+
+
+@pytest.mark.parametrize('size', [None, 0, 100])
+def test_preallocate(size, tmpdir):
+    path = os.path.join(str(tmpdir), 'dest')
+    with open(path, 'wb') as fp:
+        fp.write(b'old contents')
+
+    splitcpy.preallocate(path, size)
+
+    assert os.path.getsize(path) == (size or 0)
+
+
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_dl_slice_control(process, testfile):
+
+    process.return_value = Mock(**{'wait.return_value': 0})
+    process.return_value.stdout = open(testfile, 'rb')
+
+    splitcpy.dl_slice('user@host:file', 2, 0, 1, Mock(), 'shhh', 22,
+                      control='/tmp/ctl')
+
+    sshcmd = process.call_args[0][0]
+    assert 'ControlPath=/tmp/ctl' in sshcmd
+    assert 'sshpass' not in sshcmd
+
+
+@pytest.mark.parametrize("damage, error", [
+    (None,                      None),
+    (lambda x: x[:-1],          'cut short'),
+    (lambda x: x[:40],          'cut short'),
+    (lambda x: b'x' + x[1:],    'checksum'),
+])
+@pytest.mark.parametrize("mode", ['queue', 'direct'])
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_dl_slice_verify(process, testfile, tmpdir, mode,
+                         damage, error):
+
+    process.return_value = Mock(**{'wait.return_value': 0})
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, filesize)
+
+    stream = os.path.join(str(tmpdir), 'stream')
+    with open(stream, 'wb') as fp:
+        splitcpy.output_split(testfile, 2, 1, 16, fp, trailer=True)
+    with open(stream, 'rb') as fp:
+        data = fp.read()
+    with open(stream, 'wb') as fp:
+        fp.write(damage(data) if damage else data)
+    process.return_value.stdout = open(stream, 'rb')
+
+    queue = Mock()
+    splitcpy.dl_slice('user@host:file', 2, 1, 16, queue, None, 22,
+                      dest=dest if mode == 'direct' else None, size=filesize,
+                      verify=True)
+
+    process.return_value.stdout.close()
+
+    assert '--trailer' in process.call_args[0][0]
+
+    msgs = [x[0][0] for x in queue.put.call_args_list]
+    if error:
+        assert msgs[-1][:2] == (1, None)
+        assert error in msgs[-1][2]
+    else:
+        assert msgs[-1] is None
+
+
+@patch('splitcpy.splitcpy.Queue')
+@patch('splitcpy.splitcpy.Process', return_value=Mock())
+def test_dl_file_verify_failed(process, queue, testfile):
+
+    queue.return_value.get.side_effect = [
+        (1, 1, b'b'), None, (0, None, 'checksum mismatch'),
+    ]
+
+    with pytest.raises(splitcpy.TransferError):
+        splitcpy.dl_file('src', testfile, 2, 1, None, 22, size=4,
+                         verify=True)
+
+    kwargs = process.call_args[1]['kwargs']
+    assert kwargs['size'] == 4
+    assert kwargs['verify'] is True
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason="F_SETPIPE_SZ is Linux only")
+def test_grow_pipe():
+    r, w = os.pipe()
+    try:
+        splitcpy.grow_pipe(r, 256*1024)
+        assert fcntl.fcntl(r, getattr(fcntl, 'F_GETPIPE_SZ', 1032)) == \
+            256*1024
+    finally:
+        os.close(r)
+        os.close(w)
+
+    with tempfile.TemporaryFile() as fp:
+        splitcpy.grow_pipe(fp.fileno())     # not a pipe - ignored
+
+
+def test_start_limiter(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(splitcpy.splitcpy.time, 'time', lambda: clock[0])
+
+    limiter = splitcpy.StartLimiter(burst=3, rate=10.0)
+
+    # the burst starts at once, and the rest are spaced at the rate
+    delays = [limiter.reserve() for n in range(5)]
+    assert delays[:3] == [0, 0, 0]
+    assert delays[3:] == pytest.approx([0.1, 0.2])
+
+    clock[0] += 10
+    assert limiter.reserve() == 0
+
+    limiter.rejected()
+    assert limiter.rate.value == 5.0
+    assert limiter.reserve() == pytest.approx(0.2)
+
+    limiter.accepted()
+    assert limiter.rate.value == pytest.approx(5.5)
+
+
+@pytest.mark.parametrize("statuses, starts, ok", [
+    ([0],                       1, True),
+    ([255, 255, 0],             3, True),
+    ([255] * 5,                 5, False),
+])
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_start_slice_retry(process, statuses, starts, ok, tmpdir):
+    empty = os.path.join(str(tmpdir), 'empty')
+    open(empty, 'wb').close()
+
+    procs = []
+    for status in statuses:
+        p = Mock()
+        p.stdout = open(empty, 'rb')
+        p.wait.return_value = status
+        procs.append(p)
+    process.side_effect = procs
+
+    limiter = Mock()
+    if ok:
+        assert splitcpy.start_slice('user', 'host', 22, None, None, [],
+                                    limiter) is procs[-1]
+        assert limiter.accepted.call_count == 1
+    else:
+        with pytest.raises(splitcpy.TransferError):
+            splitcpy.start_slice('user', 'host', 22, None, None, [],
+                                 limiter)
+
+    assert process.call_count == starts
+    assert limiter.wait.call_count == starts
+    assert limiter.rejected.call_count == statuses.count(255)
+
+    [x.stdout.close() for x in procs]
+
+
+@pytest.mark.parametrize("size, num_slices, bytes, extent, done, left", [
+    (100,   2,  10, None,       0,  (0, 100)),
+    (100,   2,  10, None,       3,  (60, 40)),
+    (100,   2,  10, None,       9,  (100, 0)),
+    (100,   1,  10, (20, 50),   2,  (40, 30)),
+])
+def test_resume_extent(size, num_slices, bytes, extent, done, left):
+    assert splitcpy.resume_extent(size, num_slices, bytes, extent, done) == \
+        left
+
+
+def slice_stream(path, num_slices, slice, bytes, extent, tmpdir, cut=None):
+    """Return an open file of the -s output of path, optionally cut short"""
+    stream = os.path.join(str(tmpdir), 'stream%d' % len(os.listdir(
+        str(tmpdir))))
+    with open(stream, 'wb') as fp:
+        splitcpy.output_split(path, num_slices, slice, bytes, fp,
+                              *(extent or ()))
+    with open(stream, 'rb') as fp:
+        data = fp.read()
+    with open(stream, 'wb') as fp:
+        fp.write(data[:cut])
+
+    return open(stream, 'rb')
+
+
+@pytest.mark.parametrize("mode", ['queue', 'direct'])
+@patch('splitcpy.splitcpy.time.sleep')
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_dl_slice_resume(process, sleep, testfile, tmpdir, mode):
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, filesize)
+
+    # the first stream dies part way into its fourth chunk
+    lost = Mock(**{'wait.return_value': 255})
+    lost.stdout = slice_stream(testfile, 2, 1, 16, None, tmpdir, cut=50)
+    rest = Mock(**{'wait.return_value': 0})
+    rest.stdout = slice_stream(testfile, 2, 1, 16, (96, filesize - 96),
+                               tmpdir)
+    process.side_effect = [lost, rest]
+
+    queue = Mock()
+    splitcpy.dl_slice('user@host:file', 2, 1, 16, queue, None, 22,
+                      dest=dest if mode == 'direct' else None, size=filesize)
+
+    assert process.call_args[0][0][-2:] == ['-s', '2,1,16,96,%d' %
+                                            (filesize - 96)]
+    sleep.assert_called_once_with(splitcpy.RETRY_DELAY)
+
+    msgs = [x[0][0] for x in queue.put.call_args_list]
+    assert msgs[-1] is None
+    with open(dest, 'r+b') as fp:
+        for slice, offset, data in msgs[:-1]:
+            fp.seek(offset)
+            fp.write(data)
+
+    with open(dest, 'rb') as fp, open(testfile, 'rb') as src:
+        data, expected = fp.read(), src.read()
+    for k in range(1, filesize // 16, 2):
+        assert data[k*16:(k+1)*16] == expected[k*16:(k+1)*16]
+
+    lost.stdout.close()
+    rest.stdout.close()
+
+
+@pytest.mark.parametrize("size", [None, 256])
+@patch('splitcpy.splitcpy.time.sleep')
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_dl_slice_retry_limit(process, sleep, testfile, tmpdir, size):
+    streams = []
+
+    def lost(*args, **kwargs):
+        p = Mock(**{'wait.return_value': 255})
+        p.stdout = slice_stream(testfile, 2, 0, 16, None, tmpdir, cut=20)
+        streams.append(p.stdout)
+        return p
+    process.side_effect = lost
+
+    queue = Mock()
+    splitcpy.dl_slice('user@host:file', 2, 0, 16, queue, None, 22, size=size)
+
+    msg = queue.put.call_args[0][0]
+    assert msg[:2] == (0, None)
+    assert process.call_count == (1 if size is None else
+                                  splitcpy.RETRY_LIMIT + 1)
+    assert [x[0][0] for x in sleep.call_args_list] == \
+        [splitcpy.retry_delay(n) for n in range(process.call_count - 1)]
+
+    [x.close() for x in streams]
+
+
+def test_retry_delay():
+    delays = [splitcpy.retry_delay(n) for n in range(10)]
+
+    assert delays[:3] == [1, 2, 4]
+    assert max(delays) == splitcpy.RETRY_MAX_DELAY
+    assert delays == sorted(delays)
+
+
+@pytest.mark.parametrize("armed", [True, False])
+def test_watchdog(armed):
+    p = subprocess.Popen(['sleep', '30'], stdout=subprocess.PIPE)
+    watchdog = splitcpy.Watchdog(p, 0.2)
+    if armed:
+        watchdog.arm()
+
+    try:
+        if armed:
+            assert watchdog.reader(p.stdout).read(10) == b''
+            assert watchdog.stalled
+        else:
+            time.sleep(0.5)
+            assert p.poll() is None
+            assert not watchdog.stalled
+    finally:
+        watchdog.stop()
+        p.kill()
+        p.wait()
+        p.stdout.close()
+
+
+def test_watched_reader(testfile):
+    watchdog = Mock()
+    with open(testfile, 'rb') as fp:
+        reader = splitcpy.splitcpy.WatchedReader(fp, watchdog)
+
+        assert reader.read(100) == bytearray(range(100))
+        view = memoryview(bytearray(200))
+        assert reader.readinto(view) == filesize - 100
+
+    assert watchdog.kick.called
+
+
+@pytest.mark.parametrize("verify", [False, True])
+@patch('splitcpy.splitcpy.time.sleep')
+@patch('splitcpy.splitcpy.SshTransport.argv')
+def test_dl_slice_stall(argv, sleep, testfile, tmpdir, verify):
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, filesize)
+
+    # the first stream hangs after three chunks
+    first = slice_stream(testfile, 2, 0, 16, None, tmpdir, cut=48)
+    first.close()
+    rest = os.path.join(str(tmpdir), 'rest')
+    with open(rest, 'wb') as fp:
+        splitcpy.output_split(testfile, 2, 0, 16, fp, 96, filesize - 96,
+                              trailer=verify)
+    argv.side_effect = [
+        (['sh', '-c', 'cat "$0"; exec sleep 30', first.name], None),
+        (['cat', rest], None),
+    ]
+
+    queue = Mock()
+    splitcpy.dl_slice('user@host:file', 2, 0, 16, queue, None, 22,
+                      dest=dest, size=filesize, verify=verify, stall=0.3)
+
+    queue.put.assert_called_once_with(None)
+    assert argv.call_count == 2
+    with open(dest, 'rb') as fp, open(testfile, 'rb') as src:
+        data, expected = fp.read(), src.read()
+    for k in range(0, filesize // 16, 2):
+        assert data[k*16:(k+1)*16] == expected[k*16:(k+1)*16]
+
+
+@patch('splitcpy.splitcpy.time.sleep')
+@patch('splitcpy.splitcpy.SshTransport.argv')
+def test_dl_slice_stall_first(argv, sleep, testfile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, filesize)
+
+    # the first stream connects, and then sends nothing at all
+    whole = os.path.join(str(tmpdir), 'whole')
+    with open(whole, 'wb') as fp:
+        splitcpy.output_split(testfile, 2, 0, 16, fp)
+    argv.side_effect = [
+        (['sleep', '30'], None),
+        (['cat', whole], None),
+    ]
+
+    start = time.time()
+    queue = Mock()
+    splitcpy.dl_slice('user@host:file', 2, 0, 16, queue, None, 22,
+                      dest=dest, size=filesize, stall=0.3)
+
+    assert time.time() - start < 10
+    queue.put.assert_called_once_with(None)
+    assert argv.call_count == 2
+
+
+def test_flow_monitor():
+    monitor = splitcpy.FlowMonitor(4)
+    totals = [0.0] * 4
+
+    # slice 3 runs at a quarter of the rate of the rest, and slice 2 ends
+    slow = []
+    for interval in range(splitcpy.FlowMonitor.STRIKES):
+        totals = [totals[0] + 100, totals[1] + 100,
+                  totals[2] + (100 if interval == 0 else 0), totals[3] + 25]
+        slow.append(monitor.update(totals))
+
+    assert slow == [[]] * (splitcpy.FlowMonitor.STRIKES - 1) + [[3]]
+    assert monitor.strikes == [0] * 4
+
+    # too few slices are still running to judge
+    monitor = splitcpy.FlowMonitor(4)
+    for interval in range(splitcpy.FlowMonitor.STRIKES + 1):
+        assert monitor.update([100 * interval, 10 * interval, 0, 0]) == []
+
+
+def test_watchdog_reroll(testfile):
+    p = subprocess.Popen(['sh', '-c', 'cat "$0"; exec sleep 30', testfile],
+                         stdout=subprocess.PIPE)
+    flow = splitcpy.Flow([0.0], [0], 0)
+    watchdog = splitcpy.Watchdog(p, flow=flow)
+    watchdog.arm()
+
+    try:
+        reader = watchdog.reader(p.stdout)
+        assert reader.read(filesize) == bytearray(range(filesize))
+        assert flow.counts[0] == filesize
+
+        flow.flags[0] = 1
+        assert reader.read(10) == b''
+        assert watchdog.rerolled
+        assert not watchdog.stalled
+    finally:
+        watchdog.stop()
+        p.kill()
+        p.wait()
+        p.stdout.close()
+
+
+@patch('splitcpy.splitcpy.time.sleep')
+@patch('splitcpy.splitcpy.SshTransport.argv')
+def test_dl_slice_reroll(argv, sleep, testfile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, filesize)
+
+    # the first stream is re-rolled after three chunks
+    first = slice_stream(testfile, 2, 1, 16, None, tmpdir, cut=48)
+    first.close()
+    rest = slice_stream(testfile, 2, 1, 16, (96, filesize - 96), tmpdir)
+    rest.close()
+    argv.side_effect = [
+        (['sh', '-c', 'cat "$0"; exec sleep 30', first.name], None),
+        (['cat', rest.name], None),
+    ]
+
+    flow = splitcpy.Flow([0.0], [0], 0)
+    timer = threading.Timer(0.2, flow.flags.__setitem__, (0, 1))
+    timer.start()
+
+    queue = Mock()
+    splitcpy.dl_slice('user@host:file', 2, 1, 16, queue, None, 22,
+                      dest=dest, size=filesize, flow=flow)
+    timer.join()
+
+    queue.put.assert_called_once_with(None)
+    assert argv.call_count == 2
+    assert not sleep.called
+    assert flow.counts[0] == filesize // 2
+    with open(dest, 'rb') as fp, open(testfile, 'rb') as src:
+        data, expected = fp.read(), src.read()
+    for k in range(1, filesize // 16, 2):
+        assert data[k*16:(k+1)*16] == expected[k*16:(k+1)*16]
+
+
+@patch('splitcpy.splitcpy.time.sleep')
+@patch('splitcpy.splitcpy.SshTransport.argv')
+def test_dl_slice_reroll_limit(argv, sleep, testfile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, filesize)
+
+    # each re-rolled stream sends one chunk, the last one pauses part way
+    streams = []
+    extent = None
+    for k in range(splitcpy.REROLL_LIMIT):
+        stream = slice_stream(testfile, 2, 1, 16, extent, tmpdir, cut=16)
+        stream.close()
+        streams.append((['sh', '-c', 'cat "$0"; exec sleep 30',
+                         stream.name], None))
+        extent = splitcpy.resume_extent(filesize, 2, 16, extent, 1)
+    rest = slice_stream(testfile, 2, 1, 16, extent, tmpdir)
+    rest.close()
+    streams.append((['sh', '-c', 'head -c 16 "$0"; sleep 1.5; '
+                     'tail -c +17 "$0"', rest.name], None))
+    argv.side_effect = streams
+
+    # the flag stays raised
+    flow = splitcpy.Flow([0.0], [1], 0)
+    done = threading.Event()
+
+    def raise_flag():
+        while not done.wait(0.05):
+            if flow.flags is not None:
+                flow.flags[0] = 1
+    thread = threading.Thread(target=raise_flag)
+    thread.start()
+
+    queue = Mock()
+    try:
+        splitcpy.dl_slice('user@host:file', 2, 1, 16, queue, None, 22,
+                          dest=dest, size=filesize, flow=flow)
+    finally:
+        done.set()
+        thread.join()
+
+    queue.put.assert_called_once_with(None)
+    assert argv.call_count == splitcpy.REROLL_LIMIT + 1
+    assert flow.counts[0] == filesize // 2
@@ -1,8 +1,10 @@
 
 import pytest
-from mock import Mock
+from mock import Mock, patch
 import tempfile
 import os
+import threading
+import io
 
 import splitcpy
 
@@ -25,3 +27,110 @@ def test_ld_send_sz_1(testfile):
     splitcpy.output_split(testfile, 2, 0, 1, dst)
 
     assert dst.write.call_count == 256 / 2
+
+
+@pytest.mark.parametrize("num_slices, slice, offset, length, expected", [
+    (2, 0, 0,   None, [x for x in range(256) if x % 2 == 0]),
+    (1, 0, 10,  20,   list(range(10, 30))),
+    (2, 1, 10,  5,    [11, 13]),
+    (1, 0, 250, 20,   list(range(250, 256))),
+])
+def test_ld_send_range(testfile, num_slices, slice, offset, length,
+                       expected):
+    dst = Mock()
+
+    splitcpy.output_split(testfile, num_slices, slice, 1, dst, offset, length)
+
+    sent = bytearray().join(x[0][0] for x in dst.write.call_args_list)
+    assert sent == bytearray(expected)
+
+
+@pytest.mark.parametrize("size, num_slices", [
+    (256, 1), (256, 3), (2, 3), (0, 2),
+])
+def test_stripe_extents(size, num_slices):
+    extents = splitcpy.stripe_extents(size, num_slices)
+
+    assert len(extents) == num_slices
+    assert extents[0][0] == 0
+    assert sum(x[1] for x in extents) == size
+    for a, b in zip(extents, extents[1:]):
+        assert a[0] + a[1] == b[0]
+
+
+@pytest.mark.parametrize("num_slices, slice, offset, length", [
+    (2, 0, 0,  None),
+    (3, 2, 0,  None),
+    (1, 0, 10, 20),
+    (2, 1, 10, 300),
+])
+def test_slice_extents(testfile, num_slices, slice, offset, length):
+    with open(testfile, 'rb') as fp:
+        pkts = list(splitcpy.slice_iter(fp, num_slices, slice, 7, offset,
+                                        length))
+
+    extents = list(splitcpy.slice_extents(256, num_slices, slice, 7, offset,
+                                          length))
+
+    assert [len(x) for x in pkts] == [x[1] for x in extents]
+    assert [x[0] for x in pkts] == [x[0] for x in extents]
+
+
+def test_ld_send_pipe(testfile):
+    rfd, wfd = os.pipe()
+
+    # small sendfile() chunks can fill the pipe - drain it concurrently
+    sent = []
+
+    def drain():
+        with os.fdopen(rfd, 'rb') as src:
+            sent.append(src.read())
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+
+    with os.fdopen(wfd, 'wb') as dst:
+        assert splitcpy.sendfile_fd(dst) == wfd
+        splitcpy.output_split(testfile, 2, 1, 4, dst)
+
+    reader.join()
+    sent = sent[0]
+
+    with open(testfile, 'rb') as fp:
+        expected = b''.join(splitcpy.slice_iter(fp, 2, 1, 4))
+
+    assert sent == expected
+
+
+def test_sendfile_fd_file(testfile):
+    with open(testfile, 'rb') as fp:
+        assert splitcpy.sendfile_fd(fp) is None
+
+    assert splitcpy.sendfile_fd(Mock()) is None
+
+
+@pytest.mark.parametrize("num_slices, slice", [(1, 0), (2, 1), (3, 2)])
+def test_ld_send_trailer(testfile, num_slices, slice):
+    dst = io.BytesIO()
+
+    splitcpy.output_split(testfile, num_slices, slice, 4, dst, trailer=True)
+
+    data = dst.getvalue()[:-splitcpy.TRAILER.size]
+    trailer = dst.getvalue()[-splitcpy.TRAILER.size:]
+    with open(testfile, 'rb') as fp:
+        assert data == b''.join(splitcpy.slice_iter(fp, num_slices, slice, 4))
+
+    hash = splitcpy.stripe_hash()
+    hash.update(data)
+    assert splitcpy.TRAILER.unpack(trailer) == (len(data), hash.digest())
+
+
+@patch('splitcpy.splitcpy.stripe_hash', side_effect=AttributeError)
+def test_ld_send_no_hash(stripe_hash, testfile):
+    """Without a trailer, nothing needs blake2b, which is new in 3.6"""
+    dst = io.BytesIO()
+
+    splitcpy.output_split(testfile, 2, 1, 4, dst)
+
+    with open(testfile, 'rb') as fp:
+        assert dst.getvalue() == b''.join(splitcpy.slice_iter(fp, 2, 1, 4))
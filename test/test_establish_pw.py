@@ -46,3 +46,15 @@ def test_get_pw(getpass, pexpect, val, cept, sendlines, tpw):
     assert 'user' in spawnarg
     assert 'host' in spawnarg
     assert '22' in spawnarg
+
+
+@patch('splitcpy.splitcpy.pexpect')
+def test_cred_control(pexpect):
+    pexpect.spawn.return_value = pexpect_session((1,))
+
+    splitcpy.splitcpy.establish_ssh_cred('user', 'host', 22, ['f1'],
+                                         control='/tmp/ctl')
+
+    spawnarg = pexpect.spawn.call_args[0][0]
+    assert 'ControlMaster=yes' in spawnarg
+    assert 'ControlPath=/tmp/ctl' in spawnarg
@@ -0,0 +1,190 @@
+
+from mock import patch
+import pytest
+import os
+
+import splitcpy
+
+
+@pytest.fixture
+def dest(tmpdir):
+    return os.path.join(str(tmpdir), 'dest')
+
+
+@pytest.mark.parametrize("marks, missing", [
+    ([],                    [(0, 95)]),
+    ([(0, 95)],             []),
+    ([(0, 10), (30, 20)],   [(10, 20), (50, 45)]),
+    ([(5, 20)],             [(0, 10), (20, 75)]),   # partial blocks
+    ([(90, 5)],             [(0, 90)]),             # the short last block
+    ([(80, 15), (0, 80)],   []),
+])
+def test_journal_missing(dest, marks, missing):
+    journal = splitcpy.Journal(dest, 'src', 95, 10)
+
+    for offset, length in marks:
+        journal.mark(offset, length)
+
+    assert journal.missing() == missing
+
+
+def test_journal_save_load(dest):
+    journal = splitcpy.Journal(dest, 'src', 1000, 10)
+    journal.mark(0, 500)
+    journal.save()
+
+    assert os.path.exists(dest + splitcpy.JOURNAL_SUFFIX)
+
+    loaded = splitcpy.Journal.load(dest, 'src', 1000, 10)
+    assert loaded.missing() == [(500, 500)]
+
+    assert splitcpy.Journal.load(dest, 'other', 1000, 10) is None
+    assert splitcpy.Journal.load(dest, 'src', 1001, 10) is None
+    assert splitcpy.Journal.load(dest, 'src', 1000, 20) is None
+    assert splitcpy.Journal.load(dest, 'src', 1000, 10, 1.0) is None
+
+    loaded.remove()
+    assert not os.path.exists(dest + splitcpy.JOURNAL_SUFFIX)
+    assert splitcpy.Journal.load(dest, 'src', 1000, 10) is None
+
+
+def test_plan_download(dest):
+    with open(dest, 'wb') as fp:
+        fp.write(b'x' * 200)
+
+    extents, journal = splitcpy.plan_download('src', dest, 100, 10)
+    assert journal is None
+    assert extents == [splitcpy.Job('src', dest, 0, 100)]
+    assert os.path.getsize(dest) == 100
+
+    extents, journal = splitcpy.plan_download('src', dest, 100, 10, True)
+    assert extents == [splitcpy.Job('src', dest, 0, 100)]
+    journal.mark(0, 50)
+    journal.save()
+
+    with open(dest, 'r+b') as fp:
+        fp.write(b'y' * 50)
+
+    extents, journal = splitcpy.plan_download('src', dest, 100, 10, True)
+    assert extents == [splitcpy.Job('src', dest, 50, 50)]
+    with open(dest, 'rb') as fp:
+        assert fp.read(50) == b'y' * 50
+
+
+def test_schedule_offset_extents():
+    extents = [splitcpy.Job('f', 'd', 100, 50), splitcpy.Job('f', 'd', 300, 7)]
+
+    jobs = splitcpy.schedule_jobs(extents, 2, 10)
+
+    covered = sorted((x.offset, x.offset + x.length) for x in jobs)
+    assert covered[0][0] == 100
+    assert covered[-1] == (300, 307)
+    assert sum(x.length for x in jobs) == 57
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve'],
+                            'entries': [['f', True, True, 'f1', 100]]}))
+@patch('splitcpy.splitcpy.dl_pool')
+def test_main_resume(dl_pool, cred, tmpdir):
+    dest = os.path.join(str(tmpdir), 'f1')
+    splitcpy.preallocate(dest, 100)
+    journal = splitcpy.Journal(dest, 'f1', 100, 20)
+    journal.mark(0, 60)
+    journal.save()
+
+    cmd = "--resume -b 20 user@host:remotefile " + str(tmpdir)
+    splitcpy.splitcpy.main(cmd.split())
+
+    jobs = dl_pool.call_args[0][2]
+    assert sorted((x.offset, x.length) for x in jobs) == [(60, 20), (80, 20)]
+    assert dest in dl_pool.call_args[1]['journals']
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve'],
+                            'entries': [['f', True, True, 'f1', 100, None,
+                                         None, 2.0]]}))
+@patch('splitcpy.splitcpy.dl_pool')
+def test_main_resume_changed(dl_pool, cred, tmpdir):
+    dest = os.path.join(str(tmpdir), 'f1')
+    splitcpy.preallocate(dest, 100)
+    journal = splitcpy.Journal(dest, 'f1', 100, 20, 1.0)
+    journal.mark(0, 60)
+    journal.save()
+
+    cmd = "--resume -b 20 user@host:remotefile " + str(tmpdir)
+    splitcpy.splitcpy.main(cmd.split())
+
+    jobs = dl_pool.call_args[0][2]
+    assert sum(x.length for x in jobs) == 100
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve', 'delta'],
+                            'entries': [['f', True, True, 'f1', 100]]}))
+@patch('splitcpy.splitcpy.dl_pool')
+def test_main_delta(dl_pool, cred, tmpdir):
+    dest = os.path.join(str(tmpdir), 'f1')
+    with open(dest, 'wb') as fp:
+        fp.write(b'x' * 150)
+
+    cmd = "--delta -b 20 user@host:remotefile " + str(tmpdir)
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert dl_pool.call_args[1]['delta'] == 20
+    assert os.path.getsize(dest) == 100
+    with open(dest, 'rb') as fp:
+        assert fp.read() == b'x' * 100
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve'],
+                            'entries': [['f', True, True, 'f1', 100]]}))
+@patch('splitcpy.splitcpy.dl_pool')
+def test_main_delta_unsupported(dl_pool, cred, tmpdir):
+    cmd = "--delta user@host:remotefile " + str(tmpdir)
+    with pytest.raises(SystemExit):
+        splitcpy.splitcpy.main(cmd.split())
+
+    assert not dl_pool.called
+
+
+@pytest.mark.parametrize("resume", [False, True])
+def test_plan_sparse(dest, resume):
+    extents = [[0, 100], [5000, 200]]
+
+    todo, journal = splitcpy.plan_download('src', dest, 10000, 100, resume,
+                                           extents=extents)
+
+    assert todo == [splitcpy.Job('src', dest, 0, 100),
+                    splitcpy.Job('src', dest, 5000, 200)]
+    assert os.path.getsize(dest) == 10000
+    if resume:
+        assert journal.missing() == [(0, 100), (5000, 200)]
+
+    # a delta download compares the whole file
+    todo, journal = splitcpy.plan_download('src', dest, 10000, 100,
+                                           delta=True, extents=extents)
+    assert todo == [splitcpy.Job('src', dest, 0, 10000)]
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve'],
+                            'entries': [['f', True, True, 'f1', 10000,
+                                         [[0, 100], [5000, 200]]]]}))
+@patch('splitcpy.splitcpy.dl_file')
+@patch('splitcpy.splitcpy.dl_pool')
+def test_main_sparse(dl_pool, dl_file, cred, tmpdir):
+    cmd = "-b 100 user@host:remotefile " + str(tmpdir)
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert not dl_file.called
+    jobs = dl_pool.call_args[0][2]
+    assert sorted((x.offset, x.length) for x in jobs) == \
+        [(0, 100), (5000, 100), (5100, 100)]
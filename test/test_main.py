@@ -20,9 +20,54 @@ def test_main_local_dl(dl_file, cred):
 
     assert dl_file.called
     dl_file.assert_called_with('user@host:f1',
-                               'localfile', 5, 20, None, 22)
+                               'localfile', 5, 20, None, 22, shm=False,
+                               direct=False, size=None,
+                               layout='interleave', control=None,
+                               verify=False, stall=60.0,
+                               transport=splitcpy.TRANSPORTS['ssh'])
     assert cred.called
-    cred.assert_called_with('user', 'host', 22, ['remotefile'])
+    cred.assert_called_with('user', 'host', 22, ['remotefile'],
+                            control=None)
+
+
+@pytest.mark.parametrize("features, rval", [
+    ([],        1),
+    (['range'], None),
+])
+@patch('splitcpy.splitcpy.dl_file')
+@patch('splitcpy.splitcpy.sys.exit')
+def test_main_range_feature(exit, dl_file, features, rval):
+    info = {'version': splitcpy.__version__, 'features': features,
+            'entries': [['f', True, True, 'f1', 100]]}
+
+    with patch('splitcpy.splitcpy.establish_ssh_cred',
+               return_value=(None, info)):
+        cmd = "--layout range user@host:remotefile localfile"
+        splitcpy.splitcpy.main(cmd.split())
+
+    if rval:
+        exit.assert_called_with(rval)
+    else:
+        assert not exit.called
+        assert dl_file.call_args[1]['layout'] == 'range'
+        assert dl_file.call_args[1]['size'] == 100
+        assert dl_file.call_args[1]['direct']
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'entries': [[None, None, None, 'f1']]}))
+@patch('splitcpy.splitcpy.dl_file')
+@patch('splitcpy.splitcpy.close_control')
+@patch('splitcpy.splitcpy.make_control', return_value='/tmp/ctl')
+def test_main_multiplex(make_control, close_control, dl_file, cred):
+
+    cmd = "-M user@host:remotefile localfile"
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert cred.call_args[1]['control'] == '/tmp/ctl'
+    assert dl_file.call_args[1]['control'] == '/tmp/ctl'
+    close_control.assert_called_with('user', 'host', 22, '/tmp/ctl')
 
 
 def test_main_remote_dl():
@@ -74,7 +119,11 @@ def test_dest_dir(dl_file, cred, testdir):
 
     dl_file.assert_called_with('user@host:f1',
                                os.path.join(testdir, 'f1'),
-                               5, 20, None, 22)
+                               5, 20, None, 22, shm=False,
+                               direct=False, size=None,
+                               layout='interleave', control=None,
+                               verify=False, stall=60.0,
+                               transport=splitcpy.TRANSPORTS['ssh'])
 
 
 @pytest.mark.parametrize("low, high, rval", [
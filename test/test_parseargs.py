@@ -16,6 +16,8 @@ import getpass
     "-s 1,1,1 user@host:remotefile",
     "-s 1,0,0 user@host:remotefile",
     "-s 0,0,1 user@host:remotefile",
+    "-s 1,0,1,0 user@host:remotefile",
+    "-s 1,0,1,-1,5 user@host:remotefile",
     "",
     "u@h:p localfile localdest",
 ])
@@ -27,6 +29,19 @@ def test_parse_exception(exit_mock, cmdstr):
     assert isinstance(exit_mock.call_args[0][0], int)
 
 
+@pytest.mark.parametrize("cmdstr, offset, length", [
+    ("-s 2,1,10 file",       0,  None),
+    ("-s 2,1,10,20,30 file", 20, 30),
+])
+@patch('splitcpy.splitcpy.sys.exit')
+def test_parse_interleave(exit_mock, cmdstr, offset, length):
+    args = splitcpy.splitcpy.parse_args(cmdstr.split())
+
+    assert not exit_mock.called
+    assert (args.num_slices, args.slice, args.bytes) == (2, 1, 10)
+    assert (args.offset, args.length) == (offset, length)
+
+
 @pytest.mark.parametrize("cmdstr, srclist, dest", [
     ("h:f1",           ['h:f1'],         '.'),
     ("h:f1 dest",      ['h:f1'],         'dest'),
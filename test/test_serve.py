@@ -0,0 +1,689 @@
+
+from mock import patch, Mock
+import pytest
+import tempfile
+import json
+import io
+import sys
+import os
+
+import splitcpy
+
+
+@pytest.fixture()
+def testfile(request):
+
+    (fd, path) = tempfile.mkstemp()
+    with open(path, 'wb') as fp:
+        fp.write(bytearray(range(256)))
+
+    request.addfinalizer(lambda: os.unlink(path))
+
+    return path
+
+
+def request(path, offset, length, bytes):
+    req = {'path': path, 'offset': offset, 'length': length, 'bytes': bytes}
+    return (json.dumps(req) + '\n').encode()
+
+
+def frames(buf):
+    fp = io.BytesIO(buf)
+    return list(iter(lambda: splitcpy.read_frame(fp), None))
+
+
+@pytest.mark.parametrize("offset, length, bytes", [
+    (0,   256, 256),
+    (0,   256, 7),
+    (100, 50,  16),
+    (250, 50,  16),
+])
+def test_serve_requests(testfile, offset, length, bytes):
+    src = io.BytesIO(request(testfile, offset, length, bytes))
+    dst = io.BytesIO()
+
+    splitcpy.serve_requests(src, dst)
+
+    flist = frames(dst.getvalue())
+    assert flist[-1][0] == splitcpy.FRAME_END
+
+    data = flist[:-1]
+    assert all(x[0] == splitcpy.FRAME_DATA for x in data)
+    assert all(len(x[2]) <= bytes for x in data)
+    for type, pos, payload in data:
+        assert payload == bytearray(range(pos, pos + len(payload)))
+
+    assert sum(len(x[2]) for x in data) == min(length, 256 - offset)
+
+
+def test_serve_error():
+    src = io.BytesIO(request('/nonexistent', 0, 10, 10) * 2)
+    dst = io.BytesIO()
+
+    splitcpy.serve_requests(src, dst)
+
+    types = [x[0] for x in frames(dst.getvalue())]
+    assert types == [splitcpy.FRAME_ERROR, splitcpy.FRAME_END] * 2
+
+
+def test_read_frame_short():
+    buf = io.BytesIO()
+    splitcpy.write_frame(buf, splitcpy.FRAME_DATA, 0, b'abcd')
+
+    assert splitcpy.read_frame(io.BytesIO(buf.getvalue()[:-1])) is None
+    assert splitcpy.read_frame(io.BytesIO(b'')) is None
+
+
+@pytest.mark.parametrize("truncate, status", [
+    (False, 'done'),
+    (True,  'failed'),
+])
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_dl_stream(popen, testfile, tmpdir, truncate, status):
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, 256)
+
+    reply = io.BytesIO()
+    splitcpy.serve_requests(io.BytesIO(request(testfile, 64, 128, 10)), reply)
+    reply = reply.getvalue()
+    if truncate:
+        reply = reply[:-1]
+
+    popen.return_value = Mock(stdout=io.BytesIO(reply))
+
+    job = splitcpy.Job(testfile, dest, 64, 128)
+    jobs = Mock()
+    jobs.get.side_effect = [job, None]
+    results = Mock()
+
+    splitcpy.dl_stream('user', 'host', 10, jobs, results, None, 22)
+
+    assert popen.call_args[0][0][-2:] == ['splitcpy', '--serve']
+    # nothing landed before the stream was cut, so all of the job is left
+    rest = (job,) if status == 'failed' else ()
+    assert results.put.call_args[0][0] == (status, job) + rest
+
+    with open(dest, 'rb') as fp:
+        data = fp.read()
+    assert data[64:192] == bytearray(range(64, 192))
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve'],
+                            'entries': [['f', True, True, 'f1', 100],
+                                        ['f', True, True, 'f2', 1]]}))
+@patch('splitcpy.splitcpy.dl_pool')
+@patch('splitcpy.splitcpy.dl_file')
+def test_main_persistent(dl_file, dl_pool, cred, tmpdir):
+    cmd = "-P -n 3 -b 20 user@host:remotefile " + str(tmpdir)
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert not dl_file.called
+
+    jobs = dl_pool.call_args[0][2]
+    assert [(x.path, x.offset, x.length) for x in jobs] == [
+        ('f1', 0, 20), ('f1', 20, 20), ('f1', 40, 20), ('f1', 60, 20),
+        ('f1', 80, 20), ('f2', 0, 1),
+    ]
+    assert os.path.getsize(os.path.join(str(tmpdir), 'f1')) == 100
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve'],
+                            'entries': [['f', True, True, 'f1', 100],
+                                        ['f', True, True, 'f2', 1]]}))
+@patch('splitcpy.splitcpy.dl_pool')
+@patch('splitcpy.splitcpy.dl_file')
+def test_main_multi_pool(dl_file, dl_pool, cred, tmpdir):
+    cmd = "user@host:remotefile " + str(tmpdir)
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert not dl_file.called
+    assert dl_pool.called
+
+
+@pytest.mark.parametrize("option", ["--direct", "--layout range", "--verify"])
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve', 'range', 'verify'],
+                            'entries': [['f', True, True, 'f1', 100],
+                                        ['f', True, True, 'f2', 1]]}))
+@patch('splitcpy.splitcpy.dl_pool')
+@patch('splitcpy.splitcpy.dl_file')
+def test_main_multi_classic(dl_file, dl_pool, cred, option, tmpdir):
+    cmd = "%s user@host:remotefile %s" % (option, tmpdir)
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert dl_file.call_count == 2
+    assert not dl_pool.called
+
+
+@pytest.mark.parametrize("cmd", [
+    "-P --direct",
+    "-P --layout range",
+    "--resume --direct",
+    "-n auto --layout range",
+])
+@patch('splitcpy.splitcpy.sys.exit')
+def test_parse_persistent_direct(exit_mock, cmd):
+    splitcpy.splitcpy.parse_args(cmd.split() + ["user@host:file"])
+    assert exit_mock.called
+
+
+@pytest.mark.parametrize("sizes, num_streams, bytes", [
+    ([100],              4,  10),
+    ([100, 1, 2, 3],     4,  10),
+    ([1000] + [5] * 20,  10, 7),
+    ([0, 0],             3,  10),
+    ([3],                8,  1),
+    ([10**9, 10**6],     10, 10000),
+])
+def test_schedule_jobs(sizes, num_streams, bytes):
+    files = [splitcpy.Job('f%d' % n, 'd%d' % n, 0, x)
+             for n, x in enumerate(sizes)]
+
+    jobs = splitcpy.schedule_jobs(files, num_streams, bytes)
+
+    assert [x.length for x in jobs] == sorted([x.length for x in jobs],
+                                              reverse=True)
+
+    for path, dest, offset, size in files:
+        fjobs = sorted([x for x in jobs if x.path == path],
+                       key=lambda x: x.offset)
+        assert len(fjobs) <= num_streams * splitcpy.UNITS_PER_STREAM
+        assert sum(x.length for x in fjobs) == size
+        assert all(x.offset % bytes == 0 for x in fjobs)
+        assert all(x.dest == dest for x in fjobs)
+        for a, b in zip(fjobs, fjobs[1:]):
+            assert a.offset + a.length == b.offset
+
+
+def test_schedule_small_files():
+    files = [splitcpy.Job('big', 'big', 0, 1000)] + \
+        [splitcpy.Job('f%d' % n, 'd', 0, 5) for n in range(9)]
+
+    jobs = splitcpy.schedule_jobs(files, 10, 10)
+
+    assert len([x for x in jobs if x.path == 'big']) == 38
+    assert len(jobs) == 47
+
+
+class Loopback(object):
+    """A '--serve' process stand-in, answering requests as they arrive"""
+
+    def __init__(self):
+        self.stdin = self
+        self.stdout = self
+        self.reply = bytearray()
+        self.requests = []
+
+    def write(self, buf):
+        self.requests.append(json.loads(buf.decode()))
+        out = io.BytesIO()
+        splitcpy.serve_requests(io.BytesIO(buf), out)
+        self.reply += out.getvalue()
+
+    def flush(self):
+        pass
+
+    def read(self, count):
+        buf = bytes(self.reply[:count])
+        del self.reply[:count]
+        return buf
+
+
+def test_fetch_job_auto(tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    with open(src, 'wb') as fp:
+        fp.write(os.urandom(3*1024*1024 + 5))
+
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, os.path.getsize(src))
+
+    job = splitcpy.Job(src, dest, 0, os.path.getsize(src))
+    p = Loopback()
+    sizer = splitcpy.ChunkSizer()
+
+    fd = os.open(dest, os.O_WRONLY)
+    try:
+        assert splitcpy.fetch_job(p, fd, job, None, sizer) is None
+    finally:
+        os.close(fd)
+
+    with open(src, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+    assert len(p.requests) > 1
+    assert all(x['length'] <= x['bytes'] * splitcpy.REQUEST_CHUNKS
+               for x in p.requests)
+
+
+def test_fetch_job_error(tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, 0)
+
+    job = splitcpy.Job('/nonexistent', dest, 0, 10**7)
+
+    fd = os.open(dest, os.O_WRONLY)
+    try:
+        error = splitcpy.fetch_job(Loopback(), fd, job, None,
+                                   splitcpy.ChunkSizer())
+    finally:
+        os.close(fd)
+
+    assert error
+
+
+@pytest.mark.parametrize("rates, size", [
+    ([1, 2, 4, 8],    16),      # still improving
+    ([1, 2, 2],       2),       # no gain from 4 - back to 2
+    ([1, 1],          1),
+    ([1, 2, 2, 0.5],  2),       # collapse - search restarts
+])
+def test_chunk_sizer(rates, size):
+    sizer = splitcpy.ChunkSizer()
+    unit = sizer.START
+
+    for rate in rates:
+        sizer.update(rate * 1000, 1.0)
+
+    assert sizer.size == size * unit
+
+
+def test_chunk_sizer_max():
+    sizer = splitcpy.ChunkSizer()
+    for n in range(20):
+        sizer.update(2**n, 1.0)
+
+    assert sizer.size == sizer.MAX
+    assert sizer.settled
+
+
+@patch('splitcpy.splitcpy.sys.exit')
+def test_parse_auto(exit_mock):
+    args = splitcpy.splitcpy.parse_args("-b auto h:f1".split())
+
+    assert not exit_mock.called
+    assert args.slice_size is None
+    assert args.persistent
+
+
+def test_stream_governor():
+    gov = splitcpy.StreamGovernor(5)
+    assert gov.count == 2
+
+    assert gov.update(100) == 1         # baseline - try a third
+    assert gov.update(150) == 1         # it helped - try a fourth
+    assert gov.update(155) == -1        # it didn't - retire it
+    assert gov.count == 3
+
+    for n in range(gov.PROBE - 1):
+        assert gov.update(150) == 0
+
+    assert gov.update(150) == 1         # probe again
+    assert gov.update(300) == 1
+    assert gov.count == 5
+    assert gov.update(600) == 0         # at the maximum
+
+
+def test_stream_governor_count():
+    gov = splitcpy.StreamGovernor(3)
+
+    assert gov.update(100) == 1
+    assert gov.update(100, 3) == -1     # the probe was started
+    assert gov.count == 2
+
+    # two streams were lost - the maximum is counted from those left
+    for n in range(gov.PROBE - 1):
+        assert gov.update(100, 1) == 0
+    assert gov.update(100, 1) == 1
+    assert gov.count == 2
+
+    assert gov.update(100, 1) == 0      # the probe wasn't started - no retire
+    assert gov.count == 1
+
+
+@patch('splitcpy.splitcpy.subprocess.Popen')
+def test_dl_stream_stop(popen):
+    popen.return_value = Mock()
+    stop = Mock()
+    stop.is_set.return_value = True
+    jobs = Mock()
+
+    splitcpy.dl_stream('user', 'host', 10, jobs, Mock(), None, 22, stop=stop)
+
+    assert not jobs.get.called
+
+
+@patch('splitcpy.splitcpy.sys.exit')
+def test_parse_auto_streams(exit_mock):
+    args = splitcpy.splitcpy.parse_args("-n auto h:f1".split())
+
+    assert not exit_mock.called
+    assert args.num_slices is None
+    assert args.persistent
+
+
+def test_fetch_job_progress(testfile, tmpdir, monkeypatch):
+    monkeypatch.setattr(splitcpy.splitcpy, 'MAX_REQUEST', 50)
+
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, 256)
+
+    progress = Mock()
+    fd = os.open(dest, os.O_WRONLY)
+    try:
+        job = splitcpy.Job(testfile, dest, 6, 250)
+        splitcpy.fetch_job(Loopback(), fd, job, 10, progress=progress)
+    finally:
+        os.close(fd)
+
+    calls = [x[0] for x in progress.call_args_list]
+    assert calls == [(6, 50), (56, 50), (106, 50), (156, 50), (206, 50)]
+
+
+@pytest.mark.parametrize("changes, old_size, requested", [
+    ([],         256, []),
+    ([0],        256, [(0, 16)]),
+    ([17, 18],   256, [(16, 16)]),
+    ([40, 250],  256, [(32, 16), (240, 16)]),
+    ([],         200, [(192, 64)]),     # short local file
+])
+def test_fetch_job_delta(testfile, tmpdir, changes, old_size, requested):
+    dest = os.path.join(str(tmpdir), 'dest')
+    with open(dest, 'wb') as fp:
+        fp.write(bytearray(range(old_size)))
+    with open(dest, 'r+b') as fp:
+        for pos in changes:
+            fp.seek(pos)
+            fp.write(b'\xff')
+        fp.truncate(256)
+
+    p = Loopback()
+    progress = Mock()
+    fd = os.open(dest, os.O_RDWR)
+    try:
+        error = splitcpy.fetch_job(p, fd, splitcpy.Job(testfile, dest, 0, 256),
+                                   16, progress=progress, delta=16)
+    finally:
+        os.close(fd)
+
+    assert error is None
+    assert p.requests[0]['op'] == 'hash'
+    assert [(x['offset'], x['length']) for x in p.requests[1:]] == requested
+    assert sum(x[0][1] for x in progress.call_args_list) == 256
+
+    with open(dest, 'rb') as fp:
+        assert fp.read() == bytearray(range(256))
+
+
+def test_serve_hashes(testfile):
+    src = io.BytesIO(json.dumps({'op': 'hash', 'path': testfile, 'offset': 32,
+                                 'length': 100, 'bytes': 16}).encode() + b'\n')
+    dst = io.BytesIO()
+
+    splitcpy.serve_requests(src, dst)
+
+    digests, error = splitcpy.read_hashes(io.BytesIO(dst.getvalue()))
+    assert error is None
+    assert len(digests) == 7
+    assert digests[0] == splitcpy.block_digest(bytearray(range(32, 48)))
+    assert digests[-1] == splitcpy.block_digest(bytearray(range(128, 132)))
+
+
+def damage_frame(type, offset, payload):
+    if type == splitcpy.FRAME_DATA and offset == 32:
+        return type, offset, b'x' + payload[1:]
+    return type, offset, payload
+
+
+def drop_frame(type, offset, payload):
+    if type == splitcpy.FRAME_DATA and offset == 32:
+        return None
+    return type, offset, payload
+
+
+def old_trailer(type, offset, payload):
+    if type == splitcpy.FRAME_END:
+        return type, offset, b''
+    return type, offset, payload
+
+
+@pytest.mark.parametrize("edit, length, error", [
+    (None,          100, None),
+    (damage_frame,  100, 'checksum'),
+    (drop_frame,    100, 'received 84 bytes of 100'),
+    (old_trailer,   100, None),                     # older remote
+    (None,          200, 'received 100 bytes of 200'),
+])
+def test_read_reply_verify(testfile, tmpdir, edit, length, error):
+    src = io.BytesIO(request(testfile, 0, 100, 16))
+    dst = io.BytesIO()
+    splitcpy.serve_requests(src, dst)
+
+    reply = io.BytesIO()
+    for frame in frames(dst.getvalue()):
+        frame = edit(*frame) if edit else frame
+        if frame:
+            splitcpy.write_frame(reply, *frame)
+    reply.seek(0)
+
+    fd = os.open(os.path.join(str(tmpdir), 'dest'), os.O_WRONLY | os.O_CREAT)
+    try:
+        msg = splitcpy.read_reply(reply, fd, length)
+    finally:
+        os.close(fd)
+
+    if error:
+        assert error in msg
+    else:
+        assert msg is None
+
+
+@patch('splitcpy.splitcpy.has_blake2b', return_value=False)
+def test_serve_no_blake2b(has_blake2b, testfile, tmpdir):
+    src = io.BytesIO(request(testfile, 0, 100, 16))
+    dst = io.BytesIO()
+    splitcpy.serve_requests(src, dst)
+
+    assert list(frames(dst.getvalue()))[-1] == (splitcpy.FRAME_END, 0, b'')
+
+    fd = os.open(os.path.join(str(tmpdir), 'dest'), os.O_WRONLY | os.O_CREAT)
+    try:
+        assert splitcpy.read_reply(io.BytesIO(dst.getvalue()), fd, 100) is None
+    finally:
+        os.close(fd)
+
+
+codecs = [pytest.param(x, marks=pytest.mark.skipif(
+              x not in splitcpy.available_codecs(),
+              reason="%s module not installed" % x))
+          for x in splitcpy.CODECS]
+
+
+@pytest.mark.parametrize("codec", codecs)
+def test_fetch_job_compressed(codec, tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    with open(src, 'wb') as fp:
+        fp.write(b'\0' * 4096 + os.urandom(4096))
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, 8192)
+
+    p = Loopback()
+    sent = []
+    serve = splitcpy.serve_requests
+
+    def record(src, dst):
+        serve(src, dst)
+        sent.extend(frames(dst.getvalue()))
+
+    fd = os.open(dest, os.O_WRONLY)
+    try:
+        with patch('splitcpy.serve_requests', record):
+            error = splitcpy.fetch_job(p, fd, splitcpy.Job(src, dest, 0, 8192),
+                                       1024, codec=splitcpy.make_codec(codec))
+    finally:
+        os.close(fd)
+
+    assert error is None
+    assert p.requests[0]['compress'] == codec
+
+    # the zeros shrink, and the random data is sent as it is
+    types = [x[0] for x in sent if x[0] != splitcpy.FRAME_END]
+    assert types == [splitcpy.FRAME_COMPRESSED] * 4 + [splitcpy.FRAME_DATA] * 4
+
+    with open(src, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_serve_unknown_codec(testfile, monkeypatch):
+    monkeypatch.setattr(splitcpy.splitcpy, 'available_codecs', lambda: [])
+    req = json.loads(request(testfile, 0, 10, 10).decode())
+    req['compress'] = 'zstd'
+    src = io.BytesIO((json.dumps(req) + '\n').encode())
+    dst = io.BytesIO()
+
+    splitcpy.serve_requests(src, dst)
+
+    flist = frames(dst.getvalue())
+    assert [x[0] for x in flist] == [splitcpy.FRAME_ERROR, splitcpy.FRAME_END]
+    assert 'zstd' in flist[0][2].decode()
+
+
+@pytest.mark.parametrize("choice, local, remote, codec", [
+    ('none', ['zstd'],        ['zstd'],        None),
+    ('auto', ['zstd', 'lz4'], ['lz4', 'zstd'], 'zstd'),
+    ('auto', ['lz4'],         ['zstd', 'lz4'], 'lz4'),
+    ('auto', ['zstd'],        [],              None),
+    ('lz4',  ['zstd', 'lz4'], ['lz4'],         'lz4'),
+    ('lz4',  ['lz4'],         ['zstd'],        None),
+])
+def test_pick_codec(choice, local, remote, codec, monkeypatch):
+    monkeypatch.setattr(splitcpy.splitcpy, 'available_codecs', lambda: local)
+
+    assert splitcpy.pick_codec(choice, remote) == codec
+
+
+@pytest.mark.parametrize("option, codecs, compress, rval", [
+    ('auto', [],        None,   None),
+    ('auto', ['zstd'],  'zstd', None),
+    ('zstd', ['zstd'],  'zstd', None),
+    ('zstd', ['lz4'],   None,   1),
+])
+@patch('splitcpy.splitcpy.dl_pool')
+@patch('splitcpy.splitcpy.sys.exit')
+def test_main_compress(exit, dl_pool, option, codecs, compress, rval, tmpdir,
+                       monkeypatch):
+    monkeypatch.setattr(splitcpy.splitcpy, 'available_codecs',
+                        lambda: ['zstd', 'lz4'])
+    info = {'version': splitcpy.__version__, 'features': ['serve'],
+            'codecs': codecs, 'entries': [['f', True, True, 'f1', 100]]}
+    exit.side_effect = SystemExit
+
+    cmd = "--compress %s user@host:remotefile %s" % (option, tmpdir)
+    with patch('splitcpy.splitcpy.establish_ssh_cred',
+               return_value=(None, info)):
+        try:
+            splitcpy.splitcpy.main(cmd.split())
+        except SystemExit:
+            pass
+
+    if rval:
+        exit.assert_called_with(rval)
+        assert not dl_pool.called
+    else:
+        assert dl_pool.call_args[1]['compress'] == compress
+
+
+@patch('splitcpy.splitcpy.sys.exit')
+def test_parse_compress_missing(exit_mock, monkeypatch):
+    monkeypatch.setattr(splitcpy.splitcpy, 'available_codecs', lambda: [])
+
+    args = splitcpy.splitcpy.parse_args("--compress lz4 h:f1".split())
+    assert exit_mock.called
+
+    exit_mock.reset_mock()
+    args = splitcpy.splitcpy.parse_args("--compress auto h:f1".split())
+    assert not exit_mock.called
+    assert args.persistent
+
+
+@patch('splitcpy.splitcpy.SshTransport.argv')
+def test_dl_pool_stall(argv, tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    with open(src, 'wb') as fp:
+        fp.write(os.urandom(100000))
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, 100000)
+
+    # the first stream to start never answers
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    marker = os.path.join(str(tmpdir), 'marker')
+    serve = ['sh', '-c', 'mkdir "$0" 2>/dev/null && exec sleep 30; '
+             'exec "$@"', marker, sys.executable, '-c',
+             'import sys; from splitcpy import main; main(sys.argv[1:])',
+             '--serve']
+    argv.return_value = (serve, dict(os.environ, PYTHONPATH=root))
+
+    jobs = splitcpy.schedule_jobs([splitcpy.Job(src, dest, 0, 100000)], 2,
+                                  4096)
+    splitcpy.dl_pool('user', 'host', jobs, 2, 4096, None, 22, stall=2)
+
+    assert os.path.isdir(marker)
+    with open(src, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+
+@pytest.mark.parametrize("drops, ok", [(10, True), (100, False)])
+@patch('splitcpy.splitcpy.retry_delay', return_value=0)
+@patch('splitcpy.splitcpy.SshTransport.argv')
+def test_dl_pool_drops(argv, retry_delay, drops, ok, tmpdir):
+    src = os.path.join(str(tmpdir), 'src')
+    with open(src, 'wb') as fp:
+        fp.write(os.urandom(100000))
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, 100000)
+
+    # the first 'drops' streams to start are lost at once
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    markers = tmpdir.mkdir('markers')
+    serve = ['sh', '-c', 'for i in $(seq %d); do mkdir "$0/$i" 2>/dev/null '
+             '&& exit 255; done; exec "$@"' % drops, str(markers),
+             sys.executable, '-c',
+             'import sys; from splitcpy import main; main(sys.argv[1:])',
+             '--serve']
+    argv.return_value = (serve, dict(os.environ, PYTHONPATH=root))
+
+    jobs = splitcpy.schedule_jobs([splitcpy.Job(src, dest, 0, 100000)], 4,
+                                  4096)
+    if ok:
+        splitcpy.dl_pool('user', 'host', jobs, 4, 4096, None, 22)
+        with open(src, 'rb') as a, open(dest, 'rb') as b:
+            assert a.read() == b.read()
+    else:
+        with pytest.raises(splitcpy.TransferError):
+            splitcpy.dl_pool('user', 'host', jobs, 4, 4096, None, 22)
+
+    # each job backs off on its own count of retries
+    attempts = [x[0][0] for x in retry_delay.call_args_list]
+    assert 0 in attempts
+    assert max(attempts) < splitcpy.RETRY_LIMIT
+    if ok:
+        assert len(attempts) == drops
+
+
+def test_dl_pool_feed_error(tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+    splitcpy.preallocate(dest, 10)
+
+    def jobs():
+        yield splitcpy.Job(dest, dest, 0, 10)
+        raise ValueError("a malformed entry")
+
+    with pytest.raises(splitcpy.TransferError) as e:
+        splitcpy.dl_pool('user', 'host', jobs(), 2, 4096, None, 22,
+                         transport=splitcpy.TRANSPORTS['inproc'])
+
+    assert 'malformed' in str(e.value)
@@ -0,0 +1,125 @@
+
+from mock import patch
+import pytest
+import socket
+import threading
+import time
+
+from benchmarks import run, shaper
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = shaper.TokenBucket(1000.0, 500, clock)
+
+    assert bucket.reserve(500) == 0.0
+    assert bucket.reserve(250) == 0.25
+    assert bucket.reserve(250) == 0.5
+
+    clock.now = 10.0            # idle, but only 'burst' is saved up
+    assert bucket.reserve(600) == pytest.approx(0.1)
+
+    assert shaper.TokenBucket().reserve(10**9) == 0.0
+
+
+@pytest.mark.parametrize("spec, addr", [
+    ('2222',            ('127.0.0.1', 2222)),
+    ('host:22',         ('host', 22)),
+    ('::1:22',          ('::1', 22)),
+])
+def test_parse_addr(spec, addr):
+    assert shaper.parse_addr(spec) == addr
+
+
+@pytest.fixture
+def echo():
+    """A server echoing everything on each connection"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(5)
+
+    def serve():
+        while True:
+            try:
+                conn, addr = sock.accept()
+            except (IOError, OSError):
+                break
+            for data in iter(lambda: conn.recv(65536), b''):
+                conn.sendall(data)
+            conn.close()
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    thread.start()
+
+    yield sock.getsockname()
+    sock.close()
+
+
+def roundtrip(address, data):
+    conn = socket.create_connection(address)
+    start = time.time()
+    conn.sendall(data)
+    conn.shutdown(socket.SHUT_WR)
+
+    got = b''.join(iter(lambda: conn.recv(65536), b''))
+    conn.close()
+    return got, time.time() - start
+
+
+def test_shaper(echo):
+    data = b'x' * 100000
+
+    with shaper.Shaper(echo, rate=500000.0, latency=0.05) as proxy:
+        got, elapsed = roundtrip(proxy.address, data)
+        assert got == data
+        # the rate applies in each direction, but they overlap
+        assert elapsed >= 0.2 + 0.1 - 0.05
+
+        roundtrip(proxy.address, b'abc')
+        assert len(proxy.flows) == 2
+        assert proxy.flows[0].sent == [100000, 100000]
+
+
+def test_shaper_refused():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    target = sock.getsockname()
+    sock.close()
+
+    with shaper.Shaper(target) as proxy:
+        got, elapsed = roundtrip(proxy.address, b'')
+
+    assert got == b''
+    assert proxy.flows == []
+
+
+@patch('benchmarks.run.time_download')
+def test_run_sweep(time_download):
+    args = run.parse_args("--size 1000 -n 1,4 -b 10,20 --repeat 3".split())
+    times = {1: [4.0, 5.0, 9.0], 4: [1.0, 3.0, 2.0]}
+    time_download.side_effect = lambda argv, *a: times[int(argv[6])].pop(0)
+    for x in times.values():
+        x *= 2
+
+    proxy = shaper.Shaper(('127.0.0.1', 22))
+    results = run.run_sweep(proxy, args, 'u@h:src', 'dest', 'digest')
+
+    assert [(x['slices'], x['bytes']) for x in results] == \
+        [(1, 10), (4, 10), (1, 20), (4, 20)]
+    assert results[0]['median'] == 5.0
+    assert results[0]['rate'] == 200.0
+    assert results[1]['median'] == 2.0
+    assert results[1]['speedup'] == 2.5
+
+    argv = time_download.call_args[0][0]
+    assert argv[argv.index('-p') + 1] == str(proxy.address[1])
+    assert argv[-2:] == ['u@h:src', 'dest']
@@ -0,0 +1,136 @@
+from mock import patch
+import pytest
+import io
+import os
+
+import splitcpy
+
+
+@pytest.fixture
+def testfile(tmpdir):
+    path = os.path.join(str(tmpdir), 'src')
+    with open(path, 'wb') as fp:
+        fp.write(os.urandom(300000))
+
+    return path
+
+
+def test_remote_argv():
+    argv, env = splitcpy.remote_argv('user', 'host', 22, None, None, ['a'])
+    assert argv[0] == 'ssh'
+
+    local = splitcpy.TRANSPORTS['local']
+    argv, env = splitcpy.remote_argv('user', 'host', 22, 'pw', None,
+                                     ['a file'], local)
+    assert argv[-3:] == ['-m', 'splitcpy', 'a file']
+    assert 'SSHPASS' not in env
+
+    with pytest.raises(splitcpy.TransferError):
+        splitcpy.remote_argv('user', 'host', 22, None, None, [],
+                             splitcpy.TRANSPORTS['inproc'])
+
+
+@pytest.mark.parametrize("name", ['local', 'inproc'])
+def test_establish(name, testfile):
+    transport = splitcpy.TRANSPORTS[name]
+    password, info = transport.establish('user', 'host', 22, [testfile])
+
+    assert password is None
+    assert info['version'] == splitcpy.__version__
+    assert info['entries'][0][3:5] == [testfile, 300000]
+
+
+@patch('splitcpy.splitcpy.LocalTransport.argv',
+       return_value=(['false'], None))
+def test_establish_failed(argv):
+    with pytest.raises(splitcpy.CredException):
+        splitcpy.TRANSPORTS['local'].establish('user', 'host', 22, ['file'])
+
+
+def test_inproc_process(testfile):
+    p = splitcpy.InprocProcess([testfile, '-s', '3,1,1000'])
+    data = p.stdout.read()
+
+    expected = io.BytesIO()
+    splitcpy.output_split(testfile, 3, 1, 1000, expected)
+    assert data == expected.getvalue()
+    assert p.wait() == 0
+    assert p.poll() == 0
+
+
+def test_inproc_process_failed(tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+    p = splitcpy.InprocProcess([dest, '-w', '1,0,10,100', '--trailer'])
+
+    p.stdin.write(b'x' * 50)
+    p.stdin.close()
+
+    assert p.wait() == 1
+    assert b'cut short' in p.stderr.read()
+
+
+def test_inproc_process_kill():
+    p = splitcpy.InprocProcess(['--serve'])
+    p.kill()
+
+    assert p.wait() == -9
+    p.thread.join(5)
+    assert not p.thread.is_alive()
+
+
+@pytest.mark.parametrize("name", ['local', 'inproc'])
+@pytest.mark.parametrize("options", ["", "-P", "--direct", "--resume",
+                                     "-n auto -b auto"])
+def test_main_download(name, options, testfile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    cmd = "--transport %s -n 3 -b 40000 %s user@host:%s %s" % (
+        name, options, testfile, dest)
+    splitcpy.splitcpy.main(cmd.split())
+
+    with open(testfile, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+
+@pytest.mark.parametrize("name", ['local', 'inproc'])
+def test_main_upload(name, testfile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    cmd = "--transport %s -n 3 %s user@host:%s" % (name, testfile, dest)
+    splitcpy.splitcpy.main(cmd.split())
+
+    with open(testfile, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+
+@pytest.mark.parametrize("name", ['local', 'inproc'])
+def test_main_recursive(name, testfile, tmpdir):
+    top = tmpdir.mkdir('top')
+    top.mkdir('sub').join('a').write('abc')
+    with open(testfile, 'rb') as fp:
+        top.join('b').write_binary(fp.read())
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    cmd = "--transport %s -n 3 -r user@host:%s %s" % (name, top, dest)
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert open(os.path.join(dest, 'sub', 'a')).read() == 'abc'
+    assert os.path.getsize(os.path.join(dest, 'b')) == 300000
+
+
+@patch('splitcpy.splitcpy.make_control')
+def test_main_no_control(make_control, testfile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    cmd = "--transport local -n 3 -M user@host:%s %s" % (testfile, dest)
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert not make_control.called
+
+
+@patch('splitcpy.splitcpy.sys.exit')
+def test_parse_inproc_async(exit_mock):
+    splitcpy.splitcpy.parse_args("--transport inproc --engine async "
+                                 "user@host:file .".split())
+
+    assert exit_mock.called
@@ -0,0 +1,159 @@
+from mock import patch
+import pytest
+import sys
+import io
+import os
+
+import splitcpy
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def local_argv(user, host, port, pw, control, args):
+    """Run the 'remote' splitcpy locally, without ssh"""
+    argv = [sys.executable, '-c',
+            'import sys; from splitcpy import main; main(sys.argv[1:])']
+    return argv + args, dict(os.environ, PYTHONPATH=root)
+
+
+@pytest.fixture
+def testfile(tmpdir):
+    path = os.path.join(str(tmpdir), 'src')
+    with open(path, 'wb') as fp:
+        fp.write(os.urandom(100000))
+
+    return path
+
+
+@pytest.mark.parametrize("trailer", [False, True])
+def test_input_split(testfile, tmpdir, trailer):
+    dest = os.path.join(str(tmpdir), 'dest')
+    with open(dest, 'wb') as fp:
+        fp.write(b'x' * 200000)     # longer than the new contents
+
+    for slice in (2, 0, 1):
+        buf = io.BytesIO()
+        splitcpy.output_split(testfile, 3, slice, 4096, buf, trailer=trailer)
+        buf.seek(0)
+
+        splitcpy.input_split(dest, 3, slice, 4096, 100000, buf, trailer)
+
+    with open(testfile, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+
+def test_input_split_short(testfile, tmpdir):
+    buf = io.BytesIO()
+    splitcpy.output_split(testfile, 3, 1, 4096, buf, trailer=True)
+    buf = io.BytesIO(buf.getvalue()[:5000])
+
+    with pytest.raises(splitcpy.TransferError):
+        splitcpy.input_split(os.path.join(str(tmpdir), 'dest'), 3, 1, 4096,
+                             100000, buf, True)
+
+
+@pytest.mark.parametrize("verify", [False, True])
+@patch('splitcpy.splitcpy.SshTransport.argv', side_effect=local_argv)
+def test_ul_file(argv, testfile, tmpdir, verify):
+    dest = os.path.join(str(tmpdir), 'dest')
+
+    splitcpy.ul_file(testfile, 'user@host:' + dest, 3, 4096, None, 22,
+                     verify=verify)
+
+    with open(testfile, 'rb') as a, open(dest, 'rb') as b:
+        assert a.read() == b.read()
+
+
+@patch('splitcpy.splitcpy.SshTransport.argv', side_effect=local_argv)
+def test_ul_file_error(argv, testfile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'nodir', 'dest')
+
+    with pytest.raises(splitcpy.TransferError) as e:
+        splitcpy.ul_file(testfile, 'user@host:' + dest, 2, 4096, None, 22)
+
+    assert 'No such file' in str(e.value)
+
+
+@pytest.mark.parametrize("cmd, error", [
+    ("{src} u@h:dest",              False),
+    ("{src} {src} u@h:dir",         False),
+    ("{src} -P u@h:dest",           True),
+    ("{src} -b auto u@h:dest",      True),
+    ("{src} --delta u@h:dest",      True),
+    ("{src} -r u@h:dest",           True),
+    ("{src} --stall 5 u@h:dest",    True),
+    ("--verify -n 3 -b 100 -p 2 -M --transport local {src} u@h:dest",
+     False),
+    ("{src} u@h:a u@h:dest",        True),
+    ("{src}/missing u@h:dest",      True),
+])
+@patch('splitcpy.splitcpy.sys.exit')
+def test_parse_upload(exit_mock, testfile, cmd, error):
+    args = splitcpy.splitcpy.parse_args(cmd.format(src=testfile).split())
+
+    assert exit_mock.called == error
+    if not error:
+        assert args.upload
+        assert args.rawdest.startswith('u@h:')
+
+
+@patch('splitcpy.splitcpy.argparse.ArgumentParser.error')
+def test_parse_upload_message(error, testfile):
+    splitcpy.splitcpy.parse_args(['--compress', 'auto', testfile, 'u@h:d'])
+
+    msg = error.call_args[0][0]
+    for dest, option in splitcpy.splitcpy.UPLOAD_OPTIONS:
+        assert option in msg
+
+
+@pytest.mark.parametrize("entries, dest", [
+    ([],                                    'remote'),
+    ([['f', True, True, 'remote', 10]],     'remote'),
+    ([['d', True, True, 'remote', 0]],      'remote/src'),
+])
+@pytest.mark.parametrize("verify", [False, True])
+@patch('splitcpy.splitcpy.ul_file')
+@patch('splitcpy.splitcpy.dl_file')
+def test_main_upload(dl_file, ul_file, testfile, entries, dest, verify):
+    info = {'version': splitcpy.__version__,
+            'features': ['upload', 'verify'], 'entries': entries}
+    with patch('splitcpy.splitcpy.establish_ssh_cred',
+               return_value=(None, info)) as cred:
+        cmd = "-n 4 -b 20 %s %s user@host:remote" % (
+            "--verify" if verify else "", testfile)
+        splitcpy.splitcpy.main(cmd.split())
+
+    assert cred.call_args[0][3] == ['remote']
+    assert not dl_file.called
+    ul_file.assert_called_with(testfile, 'user@host:' + dest, 4, 20, None,
+                               22, control=None, verify=verify,
+                               transport=splitcpy.TRANSPORTS['ssh'])
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['upload'],
+                            'entries': []}))
+@patch('splitcpy.splitcpy.ul_file')
+def test_main_verify_unsupported(ul_file, cred, testfile):
+    cmd = "--verify %s user@host:remote" % testfile
+    with pytest.raises(SystemExit):
+        splitcpy.splitcpy.main(cmd.split())
+
+    assert not ul_file.called
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['upload'],
+                            'entries': []}))
+@patch('splitcpy.splitcpy.ul_file')
+@patch('splitcpy.splitcpy.sys.exit')
+def test_main_upload_not_dir(exit, ul_file, cred, testfile):
+    exit.side_effect = SystemExit
+
+    cmd = "%s %s user@host:remote" % (testfile, testfile)
+    with pytest.raises(SystemExit):
+        splitcpy.splitcpy.main(cmd.split())
+
+    assert not ul_file.called
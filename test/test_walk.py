@@ -0,0 +1,191 @@
+
+from mock import patch
+import pytest
+import io
+import json
+import os
+
+import splitcpy
+
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'scandir'),
+                                reason="needs os.scandir")
+
+
+@pytest.fixture
+def tree(tmpdir):
+    top = tmpdir.mkdir('top')
+    top.join('a').write('abc')
+    sub = top.mkdir('sub')
+    sub.join('b').write('defgh')
+    sub.mkdir('empty')
+    return top
+
+
+def walk(specs):
+    out = io.BytesIO()
+    splitcpy.splitcpy.walk_files(specs, out)
+    return [json.loads(x) for x in out.getvalue().decode().splitlines()]
+
+
+def test_walk_files(tree):
+    entries = walk([str(tree)])
+
+    names = [x[6] for x in entries]
+    assert sorted(names) == ['top', 'top/a', 'top/sub', 'top/sub/b',
+                             'top/sub/empty']
+    assert names[0] == 'top'
+    assert names.index('top/sub') < names.index('top/sub/b')
+
+    sizes = dict((x[6], x[4]) for x in entries if x[0] == 'f')
+    assert sizes == {'top/a': 3, 'top/sub/b': 5}
+    assert all(x[0] == 'd' for x in entries if x[6] not in sizes)
+
+
+def test_walk_files_glob(tree):
+    entries = walk([os.path.join(str(tree), '*')])
+
+    assert sorted(x[6] for x in entries) == ['a', 'sub', 'sub/b',
+                                             'sub/empty']
+
+
+def test_walk_files_flush(tree, monkeypatch):
+    monkeypatch.setattr(splitcpy.splitcpy, 'WALK_FLUSH', 0)
+    out = io.BytesIO()
+
+    with patch.object(out, 'flush') as flush:
+        splitcpy.splitcpy.walk_files([str(tree)], out)
+
+    assert flush.call_count == 6
+
+
+@pytest.mark.parametrize("dest, name, into_dir, path", [
+    ('d',  'top',      True,  'd/top'),
+    ('d',  'top/x/y',  True,  'd/top/x/y'),
+    ('d',  'top',      False, 'd'),
+    ('d',  'top/x/y',  False, 'd/x/y'),
+])
+def test_tree_dest(dest, name, into_dir, path):
+    assert splitcpy.splitcpy.tree_dest(dest, name, into_dir) == path
+
+
+@pytest.mark.parametrize("into_dir", [True, False])
+@pytest.mark.parametrize("name", [
+    '', '/etc/cron.d/x', '..', '../../etc/cron.d/x', 'top/../../x',
+    'top/sub/../../..',
+])
+def test_tree_dest_unsafe(name, into_dir):
+    with pytest.raises(splitcpy.TransferError):
+        splitcpy.splitcpy.tree_dest('/tmp/dl', name, into_dir)
+
+
+WALK = [
+    ['d', True, True, '/r/top', None, None, 'top'],
+    ['f', True, True, '/r/top/a', 100, None, 'top/a'],
+    ['d', True, True, '/r/top/sub', None, None, 'top/sub'],
+    ['f', True, True, '/r/top/sub/b', 30, None, 'top/sub/b'],
+]
+
+INFO = {'version': splitcpy.__version__, 'features': ['serve', 'walk'],
+        'entries': [['d', True, True, '/r/top', None, None]]}
+
+
+@pytest.mark.parametrize("exists", [False, True])
+@patch('splitcpy.splitcpy.establish_ssh_cred', return_value=(None, INFO))
+@patch('splitcpy.splitcpy.walk_remote', side_effect=lambda *a, **k: iter(WALK))
+@patch('splitcpy.splitcpy.dl_file')
+@patch('splitcpy.splitcpy.dl_pool')
+def test_main_recursive(dl_pool, dl_file, walk_remote, cred, exists,
+                        tmpdir):
+    dest = os.path.join(str(tmpdir), 'dest')
+    if exists:
+        os.mkdir(dest)
+        base = os.path.join(dest, 'top')
+    else:
+        base = dest
+
+    fed = []
+    dl_pool.side_effect = lambda *a, **k: fed.extend(a[2])
+
+    cmd = "-r -b 20 user@host:/r/top " + dest
+    splitcpy.splitcpy.main(cmd.split())
+
+    assert walk_remote.call_args[0][-1] == ['/r/top']
+    assert not dl_file.called
+    assert os.path.isdir(os.path.join(base, 'sub'))
+    assert sorted((x.dest, x.offset, x.length) for x in fed) == [
+        (os.path.join(base, 'a'), x, 20) for x in range(0, 100, 20)
+    ] + [(os.path.join(base, 'sub', 'b'), 0, 20),
+         (os.path.join(base, 'sub', 'b'), 20, 10)]
+
+
+HOSTILE = [
+    ['d', True, True, '/r/top', None, None, 'top'],
+    ['d', True, True, '/r/top/x', None, None, 'top/../../escaped'],
+    ['f', True, True, '/r/top/a', 100, None, '../../escaped-file'],
+]
+
+
+@pytest.mark.parametrize("hostile", HOSTILE[1:])
+@pytest.mark.parametrize("exists", [False, True])
+@patch('splitcpy.splitcpy.establish_ssh_cred', return_value=(None, INFO))
+@patch('splitcpy.splitcpy.walk_remote')
+@patch('splitcpy.splitcpy.dl_file')
+@patch('splitcpy.splitcpy.dl_pool')
+def test_main_recursive_hostile(dl_pool, dl_file, walk_remote, cred, exists,
+                                hostile, tmpdir):
+    dest = os.path.join(str(tmpdir), 'a', 'b', 'dest')
+    os.makedirs(dest if exists else os.path.dirname(dest))
+    walk_remote.return_value = iter(HOSTILE[:1] + [hostile])
+    dl_pool.side_effect = lambda *a, **k: list(a[2])
+
+    cmd = "-r -b 20 user@host:/r/top " + dest
+    with pytest.raises(SystemExit):
+        splitcpy.splitcpy.main(cmd.split())
+
+    # nothing is made outside of dest
+    for path, dirs, files in os.walk(str(tmpdir)):
+        for name in dirs + files:
+            full = os.path.join(path, name)
+            assert full.startswith(dest) or dest.startswith(full + os.sep)
+
+
+@patch('splitcpy.splitcpy.establish_ssh_cred',
+       return_value=(None, {'version': splitcpy.__version__,
+                            'features': ['serve'], 'entries': []}))
+@patch('splitcpy.splitcpy.walk_remote')
+def test_main_recursive_unsupported(walk_remote, cred, tmpdir):
+    cmd = "-r user@host:/r/top " + str(tmpdir)
+    with pytest.raises(SystemExit):
+        splitcpy.splitcpy.main(cmd.split())
+
+    assert not walk_remote.called
+
+
+@pytest.mark.parametrize("status", [0, 1])
+@patch('splitcpy.splitcpy.SshTransport.argv')
+def test_walk_remote(argv, status):
+    line = json.dumps(WALK[1])
+    argv.return_value = (['sh', '-c', 'echo "$0"; exit %d' % status, line],
+                         None)
+
+    # the listing is started before the entries are asked for
+    entries = splitcpy.splitcpy.walk_remote('user', 'host', 22, None, None,
+                                            ['/r/top'])
+    assert argv.call_args[0][-1] == ['--walk', '/r/top']
+
+    assert next(entries) == WALK[1]
+    if status:
+        with pytest.raises(splitcpy.TransferError):
+            next(entries)
+    else:
+        assert list(entries) == []
+
+
+@patch('splitcpy.splitcpy.SshTransport.argv',
+       return_value=(['echo', '{"bad'], None))
+def test_walk_remote_bad_entry(argv):
+    entries = splitcpy.splitcpy.walk_remote('user', 'host', 22, None, None,
+                                            ['/r/top'])
+    with pytest.raises(splitcpy.TransferError):
+        next(entries)
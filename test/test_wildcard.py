@@ -8,12 +8,14 @@ from collections import namedtuple
 
 import splitcpy
 
-FSpec = namedtuple('FSpec', ['type', 'readable', 'writeable', 'path'])
+FSpec = namedtuple('FSpec',
+                   ['type', 'readable', 'writeable', 'path', 'size',
+                    'extents', 'name', 'mtime'])
 
 
-def touch(fname, readable=True, writeable=True):
-    with open(fname, 'a'):
-        pass
+def touch(fname, readable=True, writeable=True, size=0):
+    with open(fname, 'a') as fp:
+        fp.write('x' * size)
 
     perms = 0000
 
@@ -36,7 +38,7 @@ def testdir(request):
     os.mkdir(os.path.join(dir, 'bdir'))
 
     touch(os.path.join(adir, 'one.txt'))
-    touch(os.path.join(adir, 'two'))
+    touch(os.path.join(adir, 'two'), size=2)
     touch(os.path.join(bdir, 'one.doc'))
 
     touch(os.path.join(dir, 'noread'), readable=False)
@@ -78,6 +80,18 @@ def test_eval_type(testdir, spec, type):
     assert(fspec.type == type)
 
 
+@pytest.mark.parametrize("spec, size", [
+    ('adir',     0),
+    ('adir/two', 2),
+])
+def test_eval_size(testdir, spec, size):
+
+    info = splitcpy.splitcpy.eval_files([os.path.join(testdir, spec)])
+
+    fspec = FSpec(*info['entries'][0])
+    assert(fspec.size == size)
+
+
 @pytest.mark.parametrize("wildcards, expected", [
     ('*/*',      ['one.txt', 'two', 'one.doc']),
     ('*/one*',   ['one.txt', 'one.doc']),
@@ -121,3 +135,39 @@ def test_eval_main(capsys, testdir):
     localinfo = splitcpy.splitcpy.eval_files([path])
 
     assert(cmdinfo == localinfo)
+
+
+def sparse_file(path):
+    with open(path, 'wb') as fp:
+        fp.truncate(8*1024*1024)
+        fp.write(b'a' * 4096)
+        fp.seek(6*1024*1024)
+        fp.write(b'b' * 100)
+        fp.seek(6*1024*1024 + 512*1024)
+        fp.write(b'c')
+
+    if os.stat(path).st_blocks * 512 >= 8*1024*1024:
+        pytest.skip("the filesystem doesn't support holes")
+
+
+def test_eval_sparse(testdir):
+    path = os.path.join(testdir, 'sparse')
+    sparse_file(path)
+
+    info = splitcpy.splitcpy.eval_files([path, os.path.join(testdir, 'adir')])
+
+    entries = [FSpec(*x) for x in info['entries']]
+    assert entries[0].size == 8*1024*1024
+    assert entries[1].extents is None
+
+    # the small hole at 6M is merged into the data around it
+    extents = entries[0].extents
+    assert extents[0] == [0, 4096]
+    assert len(extents) == 2
+    assert extents[1][0] == 6*1024*1024
+    assert sum(extents[1]) > 6*1024*1024 + 512*1024
+
+
+def test_data_extents_dense(testdir):
+    assert splitcpy.splitcpy.data_extents(os.path.join(testdir, 'adir',
+                                                       'two')) is None